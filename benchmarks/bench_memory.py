@@ -0,0 +1,97 @@
+"""Peak memory of the serializers (and `main()`) on multi-million-row streams
+
+Each workload of tests/memprofile.py runs with `--rows / --growth` and with
+`--rows` rows, each run in its own process. Streaming serializers peak at the
+same memory no matter the number of rows, the script exits with 1 if any
+workload peaked more than `--tolerance` times higher on the bigger run.
+
+    python benchmarks/bench_memory.py --rows 2000000
+    python benchmarks/bench_memory.py --workloads delta_csv main --tracemalloc
+
+The peak RSS is measured by default, `--tracemalloc` measures the peak of the
+Python allocations instead (more precise, but several times slower).
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / 'tests'))
+
+from memprofile import WORKLOADS, peak_allocated  # noqa: E402
+
+
+def run_workload(name, rows, use_tracemalloc, results):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        if use_tracemalloc:
+            peak = peak_allocated(WORKLOADS[name], tmpdir, rows)
+        else:
+            WORKLOADS[name](tmpdir, rows)
+            # kilobytes on linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        wall = time.perf_counter() - start
+    results.put({'rows': rows, 'peak_mb': peak / 2 ** 20, 'wall': wall})
+
+
+def measure(context, name, rows, use_tracemalloc):
+    results = context.Queue()
+    process = context.Process(target=run_workload,
+                              args=(name, rows, use_tracemalloc, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return None
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workloads', nargs='*', choices=list(WORKLOADS),
+                        help="all of them by default")
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--growth', type=int, default=4,
+                        help="the smaller run has rows / growth rows")
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    parser.add_argument('--tracemalloc', action='store_true')
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    context = multiprocessing.get_context('fork')
+    report = {}
+    failed = []
+    for name in args.workloads or WORKLOADS:
+        runs = [measure(context, name, max(1, args.rows // args.growth), args.tracemalloc),
+                measure(context, name, args.rows, args.tracemalloc)]
+        if None in runs:
+            print("{:<14} FAILED".format(name))
+            failed.append(name)
+            continue
+        small, big = runs
+        ratio = big['peak_mb'] / small['peak_mb']
+        report[name] = {'runs': runs, 'ratio': ratio}
+        grows = ratio > args.tolerance
+        if grows:
+            failed.append(name)
+        print("{:<14} {:>9} rows {:>8.1f} MB {:>7.1f}s | {:>9} rows {:>8.1f} MB {:>7.1f}s | x{:.2f}{}".format(
+            name, small['rows'], small['peak_mb'], small['wall'],
+            big['rows'], big['peak_mb'], big['wall'], ratio,
+            '  GROWS WITH ROWS' if grows else ''))
+
+    if args.json:
+        with open(args.json, 'w') as outf:
+            json.dump(report, outf, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
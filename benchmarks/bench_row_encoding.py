@@ -0,0 +1,109 @@
+"""Micro-benchmark of encoding rows with nested cells into csv
+
+Compares the original DictWriter + json.dumps loop with CsvTableWriter and
+RowEncoder (with each available json backend)
+
+    python benchmarks/bench_row_encoding.py [--rows 50000]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ttdex.encoding import JSON_BACKENDS, RowEncoder, get_dumps  # noqa: E402
+from ttdex.writers import CsvTableWriter  # noqa: E402
+
+
+def adgroup_template(i):
+    """Roughly the shape of an adgroup from adgroup/query/campaign"""
+    return {
+        "AdGroupId": "ag{}".format(i),
+        "CampaignId": "camp{}".format(i // 100),
+        "AdGroupName": "Adgroup number {}".format(i),
+        "Description": None,
+        "IsEnabled": True,
+        "IndustryCategoryId": 42,
+        "RTBAttributes": {
+            "BudgetSettings": {
+                "Budget": {"Amount": 1000.0 + i, "CurrencyCode": "USD"},
+                "DailyBudget": {"Amount": 100.0, "CurrencyCode": "USD"},
+                "PacingMode": "PaceAhead",
+            },
+            "BaseBidCPM": {"Amount": 1.5, "CurrencyCode": "USD"},
+            "MaxBidCPM": {"Amount": 5.0, "CurrencyCode": "USD"},
+            "AudienceTargeting": {"AudienceId": "aud{}".format(i), "AudienceExcluderEnabled": False},
+            "SiteTargeting": {"SiteListIds": ["sl{}".format(j) for j in range(20)]},
+            "ROIGoal": {"CPAInAdvertiserCurrency": {"Amount": 0.5, "CurrencyCode": "USD"}},
+            "FrequencySettings": {"FrequencyCap": 5, "FrequencyPeriodInMinutes": 1440},
+        },
+        "Availability": "Available",
+        "CreativeIds": ["cr{}".format(j) for j in range(10)],
+        "AssociatedBidLists": [{"BidListId": "bl{}".format(j), "IsEnabled": True} for j in range(5)],
+    }
+
+
+def legacy(rows, outpath):
+    header = rows[0].keys()
+    with open(outpath, 'w') as outf:
+        writer = csv.DictWriter(outf, fieldnames=header)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {
+                    key: (json.dumps(value) if isinstance(value, (dict, list)) else value)
+                    for key, value
+                    in row.items()
+                }
+            )
+
+
+def table_writer(backend):
+    def run(rows, outpath):
+        with CsvTableWriter(outpath, encoder=RowEncoder(dumps=get_dumps(backend))) as writer:
+            for row in rows:
+                writer.writerow(row)
+    return run
+
+
+def available_backends():
+    for name in JSON_BACKENDS:
+        try:
+            get_dumps(name)
+        except ImportError:
+            continue
+        yield name
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = [adgroup_template(i) for i in range(args.rows)]
+    candidates = [("legacy DictWriter + json", legacy)]
+    candidates += [("CsvTableWriter + {}".format(name), table_writer(name))
+                   for name in available_backends()]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outpath = os.path.join(tmpdir, 'out.csv')
+        baseline = None
+        for name, func in candidates:
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                func(rows, outpath)
+                best = min(best, time.perf_counter() - start)
+            rows_per_second = args.rows / best
+            baseline = baseline or rows_per_second
+            print("{:<32} {:>10.0f} rows/s  {:>5.2f}x".format(
+                name, rows_per_second, rows_per_second / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""End to end throughput of each `main()` section against the local mock API
+
+Every section runs in its own process so that the peak RSS is its own
+
+    python benchmarks/bench_sections.py --advertisers 50 --latency 0.02
+    python benchmarks/bench_sections.py --sections delta_campaigns --max-workers 8
+"""
+import argparse
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / 'tests'))
+
+from mockapi import MockTTDApi  # noqa: E402
+
+
+def section_configs(api):
+    advertisers = api.advertiser_ids()
+    campaign_ids = [campaign['CampaignId']
+                    for advertiser_id in advertisers[:5]
+                    for campaign in api.campaigns(advertiser_id)]
+    return {
+        'campaign_templates': {
+            'extract_predefined': {'campaign_templates': {'campaign_ids': campaign_ids}}},
+        'adgroup_templates': {
+            'extract_predefined': {'adgroup_templates': {'campaign_ids': campaign_ids}}},
+        'sitelists_summary': {
+            'extract_predefined': {'sitelists_summary': {
+                'iterations': [{'AdvertiserId': a} for a in advertisers]}}},
+        'sitelist_lines': {
+            'extract_predefined': {'sitelist_lines': {
+                'iterations': [{'AdvertiserId': a} for a in advertisers]}}},
+        'all_advertisers': {
+            'extract_predefined': {'all_advertisers': {'partner_id': 'partner'}}},
+        'all_campaigns_all_advertisers': {
+            'extract_predefined': {'all_campaigns_all_advertisers': {'partner_id': 'partner'}}},
+        'all_adgroups_all_advertisers': {
+            'extract_predefined': {'all_adgroups_all_advertisers': {'partner_id': 'partner'}}},
+        'custom_post_paginated_queries': {
+            'extract_predefined': {},
+            'custom_post_paginated_queries': [
+                {'endpoint': 'adgroup/query/advertiser',
+                 'payload': {'AdvertiserId': a},
+                 'filename': 'custom_{}.csv'.format(a)}
+                for a in advertisers[:5]]},
+        'delta_campaigns': {
+            'extract_predefined': {'delta_campaigns': {'partner_id': 'partner'}}},
+        'delta_adgroups': {
+            'extract_predefined': {'delta_adgroups': {'partner_id': 'partner'}}},
+        'poll_cloned_campaign_get_details': {
+            'extract_predefined': {},
+            'clone_references': ['ref{}'.format(i) for i in range(20)]},
+    }
+
+
+def prepare_datadir(datadir, config):
+    for folder in ('in/tables', 'out/tables', 'out/files'):
+        (datadir / folder).mkdir(parents=True, exist_ok=True)
+    with open(datadir / 'in/state.json', 'w') as state:
+        json.dump({}, state)
+    references = config.pop('clone_references', None)
+    if references:
+        with open(datadir / 'in/tables/poll_cloned_campaign_get_details.csv', 'w') as inf:
+            writer = csv.writer(inf)
+            writer.writerow(['ReferenceId'])
+            writer.writerows([ref] for ref in references)
+
+
+def count_output(outtables):
+    rows = 0
+    size = 0
+    for path in outtables.rglob('*'):
+        if path.is_file() and not path.name.endswith('.manifest'):
+            size += path.stat().st_size
+            if path.suffix == '.csv':
+                with open(path) as f:
+                    # minus the header
+                    rows += max(0, sum(1 for _ in csv.reader(f)) - 1)
+            elif path.name.endswith('.csv.gz'):
+                # a slice of a sliced table, without a header
+                with gzip.open(str(path), 'rt') as f:
+                    rows += sum(1 for _ in csv.reader(f))
+    return rows, size
+
+
+def run_section(base_url, config, extra_params, results):
+    from ttdex.extractor import main
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = Path(tmpdir)
+        prepare_datadir(datadir, config)
+        params = dict({'login': 'login',
+                       '#password': 'password',
+                       'base_url': base_url},
+                      **extra_params)
+        params.update(config)
+        start = time.perf_counter()
+        main(str(datadir), params)
+        wall = time.perf_counter() - start
+        rows, size = count_output(datadir / 'out/tables')
+    results.put({
+        'wall': wall,
+        'rows': rows,
+        'bytes': size,
+        # kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', nargs='*', help="all of them by default")
+    parser.add_argument('--advertisers', type=int, default=20)
+    parser.add_argument('--campaigns', type=int, default=10)
+    parser.add_argument('--adgroups', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--max-page-size', type=int, default=100)
+    parser.add_argument('--row-padding', type=int, default=0)
+    parser.add_argument('--throttle-every', type=int)
+    parser.add_argument('--params', default='{}',
+                        help="extra extractor config as json, eg. '{\"max_workers\": 8}'")
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    extra_params = json.loads(args.params)
+    if args.max_workers:
+        extra_params['max_workers'] = args.max_workers
+
+    api = MockTTDApi(
+        advertisers=args.advertisers,
+        campaigns_per_advertiser=args.campaigns,
+        adgroups_per_campaign=args.adgroups,
+        latency=args.latency,
+        max_page_size=args.max_page_size,
+        row_padding=args.row_padding,
+        throttle_every=args.throttle_every,
+        retry_after=0,
+        clone_polls={'ref{}'.format(i): i % 4 for i in range(20)})
+
+    report = {}
+    context = multiprocessing.get_context('fork')
+    with api:
+        configs = section_configs(api)
+        for name in args.sections or configs:
+            requests_before = api.requests_total
+            bytes_before = api.bytes_sent
+            results = context.Queue()
+            process = context.Process(
+                target=run_section,
+                args=(api.base_url, configs[name], extra_params, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print("{:<34} FAILED".format(name))
+                continue
+            result = results.get()
+            result['requests'] = api.requests_total - requests_before
+            result['bytes_received'] = api.bytes_sent - bytes_before
+            result['requests_per_second'] = result['requests'] / result['wall']
+            result['rows_per_second'] = result['rows'] / result['wall']
+            report[name] = result
+            print("{:<34} {:>8.2f}s {:>6} req {:>8.1f} req/s {:>8} rows {:>10.0f} rows/s {:>7.1f} MB RSS".format(
+                name, result['wall'], result['requests'], result['requests_per_second'],
+                result['rows'], result['rows_per_second'], result['peak_rss_mb']))
+
+    if args.json:
+        with open(args.json, 'w') as outf:
+            json.dump(report, outf, indent=2)
+
+
+if __name__ == '__main__':
+    main()
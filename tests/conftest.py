@@ -0,0 +1,17 @@
+import json
+import pytest
+from mockapi import MockTTDApi
+
+
+@pytest.fixture
+def mock_api():
+    with MockTTDApi(clone_polls={"ref1": 2}) as api:
+        yield api
+
+
+@pytest.fixture
+def datadir(tmpdir):
+    for folder in ("in/tables", "out/tables", "out/files"):
+        tmpdir.join(folder).ensure(dir=True)
+    tmpdir.join("in/state.json").write(json.dumps({}))
+    return tmpdir
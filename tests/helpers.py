@@ -0,0 +1,8 @@
+"""Helpers shared by the tests"""
+import csv
+
+
+def read_csv(path):
+    """The rows of a csv file with a header, as dicts"""
+    with open(str(path)) as fin:
+        return list(csv.DictReader(fin))
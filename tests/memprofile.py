@@ -0,0 +1,177 @@
+"""Synthetic workloads for checking that the serializers stream
+
+Used by tests/test_memory.py (small runs) and benchmarks/bench_memory.py
+(multi-million-row runs). The rows are generated lazily, so whatever memory a
+workload takes is held by the code under test. A workload is called as
+`workload(outdir, rows)` and pushes about `rows` rows through one serializer
+(or `main()` against the mock API).
+
+    peak = peak_allocated(WORKLOADS['csv_nested'], outdir, 100000)
+"""
+import gc
+import json
+import tracemalloc
+from collections import OrderedDict
+from pathlib import Path
+
+from ttdex.checkpoint import AdvertiserDone
+from ttdex.extractor import TTDExtractor, main
+from ttdex.flatten import Flattener
+
+from mockapi import MockTTDApi
+
+
+def wide_rows(rows, width=100):
+    """Flat rows with `width` scalar columns"""
+    for i in range(rows):
+        row = {'Id': 'id{}'.format(i)}
+        row.update(('column{}'.format(c), i + c) for c in range(width))
+        yield row
+
+
+def _nested(i, depth):
+    cell = {'Value': i, 'Tags': ['t{}'.format(j) for j in range(5)]}
+    for level in range(depth):
+        cell = {'Level{}'.format(level): cell, 'Amount': {'Amount': 1.5, 'CurrencyCode': 'USD'}}
+    return cell
+
+
+def nested_rows(rows, depth=10):
+    """Rows with deeply nested dict/list cells, like the TTD templates"""
+    for i in range(rows):
+        yield {
+            'CampaignId': 'camp{}'.format(i),
+            'AdvertiserId': 'adv{}'.format(i // 1000),
+            'RTBAttributes': _nested(i, depth),
+            'AdGroups': [{'AdGroupId': 'ag{}-{}'.format(i, j), 'Bid': _nested(j, 2)}
+                         for j in range(3)],
+        }
+
+
+def delta_stream(rows, leading_nones=None, advertiser_rows=1000):
+    """A delta stream starting with a long run of `(None, version)` (advertisers
+    without changes), then `rows` changed rows with an AdvertiserDone after
+    every `advertiser_rows` of them"""
+    leading_nones = rows if leading_nones is None else leading_nones
+    for i in range(leading_nones):
+        yield None, {'quiet{}'.format(i % 1000): i}
+    for i, row in enumerate(nested_rows(rows, depth=3)):
+        advertiser_id = row['AdvertiserId']
+        yield row, {advertiser_id: i}
+        if (i + 1) % advertiser_rows == 0:
+            yield AdvertiserDone(advertiser_id), {advertiser_id: i}
+
+
+def run_csv_wide(outdir, rows):
+    TTDExtractor.serialize_response_to_json(wide_rows(rows), Path(outdir) / 'wide.csv')
+
+
+def run_csv_nested(outdir, rows):
+    TTDExtractor.serialize_response_to_json(nested_rows(rows), Path(outdir) / 'nested.csv')
+
+
+def run_csv_sliced(outdir, rows):
+    TTDExtractor.serialize_response_to_json(
+        nested_rows(rows), Path(outdir) / 'sliced.csv',
+        sliced={'slice_rows': 50000, 'writers': 2, 'compresslevel': 1})
+
+
+def run_csv_flatten(outdir, rows):
+    flatten = Flattener(
+        [{'path': 'AdGroups', 'table': 'adgroups', 'parent_keys': ['CampaignId']}],
+        outdir)
+    TTDExtractor.serialize_response_to_json(
+        nested_rows(rows), Path(outdir) / 'flattened.csv', flatten=flatten)
+
+
+def run_csv_pipeline(outdir, rows):
+    TTDExtractor.serialize_response_to_json(
+        nested_rows(rows), Path(outdir) / 'piped.csv',
+        pipeline={'batch_size': 100, 'queue_size': 4})
+
+
+def run_delta_csv(outdir, rows):
+    _, versions = TTDExtractor.serialize_delta_stream_to_csv(
+        delta_stream(rows), Path(outdir) / 'delta.csv')
+    assert versions
+
+
+def run_ndjson(outdir, rows):
+    TTDExtractor.serialize_to_ndjson(nested_rows(rows), Path(outdir) / 'nested.ndjson')
+
+
+def _datadir(outdir):
+    datadir = Path(outdir)
+    for folder in ('in/tables', 'out/tables', 'out/files'):
+        (datadir / folder).mkdir(parents=True, exist_ok=True)
+    (datadir / 'in/state.json').write_text('{}')
+    return datadir
+
+
+def run_main(outdir, rows, campaigns_per_advertiser=100):
+    """Delta and all campaigns of `rows / campaigns_per_advertiser` advertisers
+    through `main()` against the mock API"""
+    datadir = _datadir(outdir)
+    with MockTTDApi(advertisers=max(1, rows // campaigns_per_advertiser),
+                    campaigns_per_advertiser=campaigns_per_advertiser,
+                    max_page_size=100,
+                    delta_page_size=100) as api:
+        main(str(datadir), {
+            'login': 'login',
+            '#password': 'password',
+            'base_url': api.base_url,
+            'max_workers': 2,
+            'rate_limit': {'requests_per_minute': 10 ** 6, 'burst': 1000},
+            # the responses kept for the run are bounded by the cache size,
+            # not by the size of the run; keep the bound small so it's reached
+            'request_cache': {'max_mb': 0.25},
+            'extract_predefined': {
+                'delta_campaigns': {'partner_id': 'partner'},
+                'all_campaigns_all_advertisers': {'partner_id': 'partner'},
+            },
+        })
+    state = json.loads((datadir / 'out/state.json').read_text())
+    assert len(state['delta_campaigns']) == max(1, rows // campaigns_per_advertiser)
+
+
+def run_sitelist_lines(outdir, rows):
+    """Sitelists of 100 lines, `rows` in total, through `main()` against the
+    mock API"""
+    datadir = _datadir(outdir)
+    with MockTTDApi(advertisers=1, sitelists_per_advertiser=max(1, rows // 100),
+                    sitelist_lines=100) as api:
+        main(str(datadir), {
+            'login': 'login',
+            '#password': 'password',
+            'base_url': api.base_url,
+            'rate_limit': {'requests_per_minute': 10 ** 6, 'burst': 1000},
+            'request_cache': {'max_mb': 0.25},
+            'extract_predefined': {
+                'sitelist_lines': {'iterations': [{'AdvertiserId': 'adv0'}]},
+            },
+        })
+
+
+WORKLOADS = OrderedDict([
+    ('csv_wide', run_csv_wide),
+    ('csv_nested', run_csv_nested),
+    ('csv_sliced', run_csv_sliced),
+    ('csv_flatten', run_csv_flatten),
+    ('csv_pipeline', run_csv_pipeline),
+    ('delta_csv', run_delta_csv),
+    ('ndjson', run_ndjson),
+    ('main', run_main),
+    ('sitelist_lines', run_sitelist_lines),
+])
+
+
+def peak_allocated(workload, outdir, rows) -> int:
+    """Peak bytes allocated by Python (all threads) while running the workload"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        workload(outdir, rows)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
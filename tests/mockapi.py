@@ -0,0 +1,383 @@
+"""A local stand-in for the TTD v3 API
+
+Serves deterministic fake data so that the extractor can be tested and
+benchmarked without credentials
+
+    with MockTTDApi(advertisers=10, latency=0.01) as api:
+        main(datadir, {"base_url": api.base_url, ...})
+        print(api.requests_total)
+"""
+import gzip
+import json
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockTTDApi:
+    """Fake TTD API running in a background thread
+
+    Args:
+        advertisers: number of advertisers of the partner
+        campaigns_per_advertiser, adgroups_per_campaign,
+        sitelists_per_advertiser, sitelist_lines: size of the fake data
+        latency: seconds each response is delayed
+        max_page_size: the API never returns more than this many items in
+            one page no matter the PageSize in the request
+        delta_page_size: number of entities in one page of the delta endpoints
+        row_padding: length of an extra string field in each entity, to
+            simulate big rows
+        throttle_every: every n-th request is answered with a 429
+        retry_after: the Retry-After header of the 429 responses
+        clone_polls: how many times the clone status of a ReferenceId is
+            'InProgress' before it's 'Completed', {reference_id: polls}.
+            Unknown ReferenceIds complete right away, ReferenceIds starting
+            with 'fail' end with 'Failed'
+        unlisted_clone_adgroups: how many adgroups of a finished clone are in
+            its AdGroupIdMap but not (yet) listed by adgroup/query/campaign
+        report_executions: how many report executions there are, their ids
+            are 1..n and the files (gzipped csvs of `report_rows` rows) are
+            served with Range support
+        pending_report_executions: ids of the executions not complete yet
+        interrupted_report_downloads: how many downloads of a report file
+            are cut off in the middle, before it's served whole
+        gzip_responses: gzip the json responses of the clients accepting it
+    """
+    def __init__(
+            self,
+            advertisers=3,
+            campaigns_per_advertiser=5,
+            adgroups_per_campaign=3,
+            sitelists_per_advertiser=2,
+            sitelist_lines=10,
+            latency=0.0,
+            max_page_size=1000,
+            delta_page_size=100,
+            row_padding=0,
+            throttle_every=None,
+            retry_after=1,
+            clone_polls=None,
+            unlisted_clone_adgroups=0,
+            report_executions=0,
+            report_rows=100,
+            pending_report_executions=(),
+            interrupted_report_downloads=0,
+            gzip_responses=False):
+        self.advertisers = advertisers
+        self.campaigns_per_advertiser = campaigns_per_advertiser
+        self.adgroups_per_campaign = adgroups_per_campaign
+        self.sitelists_per_advertiser = sitelists_per_advertiser
+        self.sitelist_lines = sitelist_lines
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.delta_page_size = delta_page_size
+        self.row_padding = row_padding
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.clone_polls = clone_polls or {}
+        self.unlisted_clone_adgroups = unlisted_clone_adgroups
+        self.report_executions = report_executions
+        self.report_rows = report_rows
+        self.pending_report_executions = set(pending_report_executions)
+        self.interrupted_report_downloads = interrupted_report_downloads
+        self.report_ranges = []
+        # the TTD-Auth header of each report file request
+        self.report_auth_headers = []
+        self.gzip_responses = gzip_responses
+        self.logins = []
+
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self._clone_polled = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    # server lifecycle
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # otherwise every response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                api._handle(self, 'GET', None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                api._handle(self, 'POST', body)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/v3/'.format(self._server.server_address[1])
+
+    @property
+    def requests_total(self):
+        return sum(self.requests.values())
+
+    # fake data
+
+    def advertiser_ids(self):
+        return ['adv{}'.format(i) for i in range(self.advertisers)]
+
+    def _padding(self):
+        return {'Padding': 'x' * self.row_padding} if self.row_padding else {}
+
+    def advertiser(self, i):
+        return dict({'AdvertiserId': 'adv{}'.format(i),
+                     'PartnerId': 'partner',
+                     'AdvertiserName': 'Advertiser {}'.format(i),
+                     'Availability': 'Available'},
+                    **self._padding())
+
+    def campaign(self, advertiser_id, i):
+        return dict({'CampaignId': '{}-camp{}'.format(advertiser_id, i),
+                     'AdvertiserId': advertiser_id,
+                     'CampaignName': 'Campaign {}'.format(i),
+                     'Budget': {'Amount': 100.0 + i, 'CurrencyCode': 'USD'},
+                     'Availability': 'Available'},
+                    **self._padding())
+
+    def campaigns(self, advertiser_id):
+        return [self.campaign(advertiser_id, i)
+                for i in range(self.campaigns_per_advertiser)]
+
+    def adgroup(self, campaign_id, i):
+        return dict({'AdGroupId': '{}-ag{}'.format(campaign_id, i),
+                     'CampaignId': campaign_id,
+                     'AdGroupName': 'Adgroup {}'.format(i),
+                     'IsEnabled': True,
+                     'RTBAttributes': {
+                         'BudgetSettings': {'Budget': {'Amount': 10.0, 'CurrencyCode': 'USD'}},
+                         'BaseBidCPM': {'Amount': 1.0, 'CurrencyCode': 'USD'}}},
+                    **self._padding())
+
+    def adgroups_of_campaign(self, campaign_id):
+        return [self.adgroup(campaign_id, i) for i in range(self.adgroups_per_campaign)]
+
+    def adgroups(self, advertiser_id):
+        return [adgroup
+                for campaign in self.campaigns(advertiser_id)
+                for adgroup in self.adgroups_of_campaign(campaign['CampaignId'])]
+
+    def sitelists(self, advertiser_id):
+        return [{'SiteListId': '{}-sl{}'.format(advertiser_id, i),
+                 'AdvertiserId': advertiser_id,
+                 'SiteListName': 'Sitelist {}'.format(i),
+                 'SiteListLineCount': self.sitelist_lines,
+                 'Permissions': 'Global'}
+                for i in range(self.sitelists_per_advertiser)]
+
+    def sitelist(self, sitelist_id):
+        """GET sitelist/{id}, the lines come with the sitelist"""
+        advertiser_id, i = sitelist_id.rsplit('-sl', 1)
+        sitelist = dict(self.sitelists(advertiser_id)[int(i)])
+        sitelist['SiteListLines'] = [
+            {'Domain': 'site{}.{}.example.com'.format(line, sitelist_id), 'Adjustment': 1.0}
+            for line in range(self.sitelist_lines)]
+        return sitelist
+
+    def report_csv(self, execution_id):
+        lines = ['Date,AdvertiserId,Impressions']
+        lines.extend('2020-01-{:02d},adv{},{}'.format(i % 28 + 1, i % 3, i * execution_id)
+                     for i in range(self.report_rows))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def report_file(self, execution_id):
+        return gzip.compress(self.report_csv(execution_id), mtime=0)
+
+    def report_execution(self, execution_id):
+        complete = execution_id not in self.pending_report_executions
+        return {'ReportExecutionId': execution_id,
+                'ReportScheduleId': 42,
+                'ReportScheduleName': 'Daily performance',
+                'ReportExecutionState': 'Complete' if complete else 'Pending',
+                'ReportDeliveries': [{
+                    'ReportDestination': 'Download',
+                    'DownloadURL': (self.base_url + 'reports/{}.csv.gz'.format(execution_id)
+                                    if complete else None)}]}
+
+    # request handling
+
+    def _paginated(self, items, body):
+        start = int(body.get('PageStartIndex') or 0)
+        size = min(int(body.get('PageSize') or self.max_page_size), self.max_page_size)
+        page = items[start:start + size]
+        return {'Result': page,
+                'ResultCount': len(page),
+                'TotalFilteredCount': len(items),
+                'TotalUnfilteredCount': len(items)}
+
+    def _delta(self, items, key, body):
+        # entity i has tracking version i + 1, so that version 0 means "nothing yet"
+        since = body.get('LastChangeTrackingVersion') or 0
+        changed = items[since:since + self.delta_page_size]
+        version = since + len(changed)
+        return {key: changed,
+                'LastChangeTrackingVersion': version,
+                'MoreAvailable': version < len(items)}
+
+    def _authenticate(self, body):
+        with self._lock:
+            self.logins.append(body)
+        return {'Token': 'mock-token'}
+
+    def _clone_status(self, reference_id):
+        with self._lock:
+            self._clone_polled[reference_id] += 1
+            polled = self._clone_polled[reference_id]
+        if polled <= self.clone_polls.get(reference_id, 0):
+            return {'ReferenceId': reference_id, 'Status': 'InProgress'}
+        if reference_id.startswith('fail'):
+            return {'ReferenceId': reference_id, 'Status': 'Failed'}
+        campaign_id = 'clone-{}'.format(reference_id)
+        return {'ReferenceId': reference_id,
+                'Status': 'Completed',
+                'CampaignId': campaign_id,
+                'AdGroupIdMap': {
+                    'template-ag{}'.format(i): self.adgroup(campaign_id, i)['AdGroupId']
+                    for i in range(self.adgroups_per_campaign + self.unlisted_clone_adgroups)}}
+
+    def route(self, method, path, body):
+        """Returns (status_code, json response)"""
+        if method == 'POST':
+            routes = [
+                (r'authentication', lambda m: self._authenticate(body)),
+                (r'advertiser/query/partner', lambda m: self._paginated(
+                    [self.advertiser(i) for i in range(self.advertisers)], body)),
+                (r'campaign/query/advertiser', lambda m: self._paginated(
+                    self.campaigns(body['AdvertiserId']), body)),
+                (r'adgroup/query/advertiser', lambda m: self._paginated(
+                    self.adgroups(body['AdvertiserId']), body)),
+                (r'adgroup/query/campaign', lambda m: self._paginated(
+                    self.adgroups_of_campaign(body['CampaignId']), body)),
+                (r'sitelist/query/advertiser', lambda m: self._paginated(
+                    self.sitelists(body['AdvertiserId']), body)),
+                (r'myreports/reportexecution/query/advertisers', lambda m: self._paginated(
+                    [self.report_execution(i + 1) for i in range(self.report_executions)], body)),
+                (r'delta/campaign/query/advertiser', lambda m: self._delta(
+                    self.campaigns(body['AdvertiserId']), 'Campaigns', body)),
+                (r'delta/adgroup/query/advertiser', lambda m: self._delta(
+                    self.adgroups(body['AdvertiserId']), 'AdGroups', body)),
+            ]
+        else:
+            routes = [
+                (r'campaign/clone/status/(?P<ref>[^/]+)',
+                 lambda m: self._clone_status(m.group('ref'))),
+                (r'campaign/(?P<id>[^/]+)', lambda m: dict(
+                    self.campaign(m.group('id').split('-camp')[0], 0),
+                    CampaignId=m.group('id'))),
+                (r'sitelist/(?P<id>[^/]+)', lambda m: self.sitelist(m.group('id'))),
+                (r'adgroup/(?P<id>[^/]+)', lambda m: dict(
+                    self.adgroup(m.group('id').split('-ag')[0], 0),
+                    AdGroupId=m.group('id'))),
+            ]
+        for pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return 200, handler(match)
+        return 404, {'Message': 'No mock for {} {}'.format(method, path)}
+
+    def _handle(self, handler, method, body):
+        path = handler.path.split('?')[0]
+        path = re.sub(r'^/v3/', '', path).strip('/')
+        with self._lock:
+            self.requests[(method, re.sub(r'/[^/]*\d[^/]*$', '/<id>', path))] += 1
+            throttle = (self.throttle_every is not None
+                        and self.requests_total % self.throttle_every == 0)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not throttle and method == 'GET':
+            match = re.fullmatch(r'reports/(?P<id>\d+)\.csv\.gz', path)
+            if match:
+                self._send_report(handler, int(match.group('id')))
+                return
+
+        headers = {}
+        if throttle:
+            status, response = 429, {'Message': 'Too many requests'}
+            headers['Retry-After'] = str(self.retry_after)
+        else:
+            status, response = self.route(method, path, body or {})
+
+        payload = json.dumps(response).encode('utf-8')
+        if self.gzip_responses and 'gzip' in (handler.headers.get('Accept-Encoding') or ''):
+            payload = gzip.compress(payload)
+            headers['Content-Encoding'] = 'gzip'
+        with self._lock:
+            self.bytes_sent += len(payload)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _send_report(self, handler, execution_id):
+        content = self.report_file(execution_id)
+        match = re.fullmatch(r'bytes=(\d+)-', handler.headers.get('Range') or '')
+        start = int(match.group(1)) if match else 0
+        with self._lock:
+            self.report_ranges.append(start)
+            self.report_auth_headers.append(handler.headers.get('TTD-Auth'))
+            interrupt = self.interrupted_report_downloads > 0
+            if interrupt:
+                self.interrupted_report_downloads -= 1
+        if start >= len(content):
+            handler.send_response(416)
+            handler.send_header('Content-Range', 'bytes */{}'.format(len(content)))
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        body = content[start:]
+        handler.send_response(206 if match else 200)
+        handler.send_header('Content-Type', 'application/gzip')
+        handler.send_header('Content-Length', str(len(body)))
+        if match:
+            handler.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(content) - 1, len(content)))
+        handler.end_headers()
+        if interrupt:
+            # half of it, then the connection drops
+            handler.wfile.write(body[:len(body) // 2])
+            handler.wfile.flush()
+            handler.close_connection = True
+            handler.connection.shutdown(socket.SHUT_RDWR)
+            return
+        with self._lock:
+            self.bytes_sent += len(body)
+        handler.wfile.write(body)
@@ -0,0 +1,126 @@
+import json
+import pytest
+from ttdex.checkpoint import AdvertiserDone, Checkpoint
+from ttdex.extractor import TTDExtractor
+from ttdex.writers import CsvTableWriter
+from helpers import read_csv
+
+
+def delta_stream(advertisers, fail_at=None):
+    """Rows of the advertisers interleaved, like fan_out produces them"""
+    for version in range(3):
+        for adv in advertisers:
+            if (adv, version) == fail_at:
+                raise ConnectionError("network went away")
+            row = {"AdvertiserId": adv, "v": version}
+            if version == 2:
+                row["extra"] = "new column"
+            yield row, {adv: version}
+            if version == 2:
+                yield AdvertiserDone(adv), {adv: version}
+
+
+def test_writer_resumes_from_checkpoint(tmpdir):
+    outpath = tmpdir.join("out.csv").strpath
+    writer = CsvTableWriter(outpath, batch_size=2)
+    writer.writerow({"a": 1})
+    writer.writerow({"a": 2, "b": 2})
+    saved = writer.checkpoint()
+    writer.writerow({"a": "lost"})
+    writer.abort()
+
+    with CsvTableWriter(outpath, resume_from=saved) as writer:
+        writer.writerow({"a": 3, "c": 3})
+    assert writer.rows_written == 3
+    assert read_csv(outpath) == [
+        {"a": "1", "b": "", "c": ""},
+        {"a": "2", "b": "2", "c": ""},
+        {"a": "3", "b": "", "c": "3"}]
+
+
+def test_delta_section_resumes_without_duplicates(tmpdir):
+    outpath = tmpdir.join("delta.csv")
+    cp_path = tmpdir.join("checkpoint.jsonl")
+    advertisers = ["adv0", "adv1", "adv2"]
+    config = {"partner_id": "partner"}
+
+    section = Checkpoint(cp_path).section("delta_campaigns", config, outpath)
+    with pytest.raises(ConnectionError):
+        TTDExtractor.serialize_delta_stream_to_csv(
+            delta_stream(advertisers, fail_at=("adv1", 2)), outpath, checkpoint=section)
+
+    section = Checkpoint(cp_path).section("delta_campaigns", config, outpath)
+    assert section.done == {"adv0"}
+    assert section.tracking_versions == {"adv0": 2}
+    remaining = [adv for adv in advertisers if adv not in section.done]
+    _, tracking_versions = TTDExtractor.serialize_delta_stream_to_csv(
+        delta_stream(remaining), outpath, checkpoint=section)
+
+    assert tracking_versions == {"adv0": 2, "adv1": 2, "adv2": 2}
+    rows = read_csv(outpath)
+    assert sorted((row["AdvertiserId"], row["v"]) for row in rows) == [
+        (adv, str(v)) for adv in advertisers for v in range(3)]
+    assert list(rows[0].keys()) == ["AdvertiserId", "v", "extra"]
+
+
+def test_changed_config_or_missing_output_starts_afresh(tmpdir):
+    outpath = tmpdir.join("delta.csv")
+    cp_path = tmpdir.join("checkpoint.jsonl")
+    section = Checkpoint(cp_path).section("delta_campaigns", {"partner_id": "p"}, outpath)
+    with pytest.raises(ConnectionError):
+        TTDExtractor.serialize_delta_stream_to_csv(
+            delta_stream(["adv0", "adv1"], fail_at=("adv1", 2)), outpath, checkpoint=section)
+
+    assert Checkpoint(cp_path).section("delta_campaigns", {"partner_id": "other"}, outpath).done == set()
+    # the partial output didn't belong to the new config
+    assert not outpath.exists()
+
+    section = Checkpoint(cp_path).section("delta_campaigns", {"partner_id": "p"}, outpath)
+    assert section.done == set()
+    assert section.resume_from is None
+
+
+def test_checkpoint_is_cleared(tmpdir):
+    cp_path = tmpdir.join("checkpoint.jsonl")
+    checkpoint = Checkpoint(cp_path)
+    checkpoint.section("a", {}, tmpdir.join("a.csv")).advertiser_done("adv0", {})
+    assert Checkpoint(cp_path).section("a", {}, tmpdir.join("a.csv")).done == {"adv0"}
+    checkpoint.clear()
+    assert not cp_path.exists()
+
+
+def test_checkpoint_appends_progress_and_skips_a_cut_line(tmpdir):
+    cp_path = tmpdir.join("checkpoint.jsonl")
+    checkpoint = Checkpoint(cp_path)
+    section = checkpoint.section("a", {}, tmpdir.join("a.csv"))
+    for i in range(3):
+        section.advertiser_done("adv{}".format(i), {"adv{}".format(i): i})
+    checkpoint.close()
+    lines = cp_path.read().splitlines()
+    # the start of the section and one line per advertiser
+    assert len(lines) == 1 + 3
+    assert json.loads(lines[-1]) == {
+        "section": "a", "done": "adv2", "tracking_versions": {"adv2": 2}}
+
+    # a crash while writing the last line
+    cp_path.write(cp_path.read()[:-10], mode="w")
+    checkpoint = Checkpoint(cp_path)
+    section = checkpoint.section("a", {}, tmpdir.join("a.csv"))
+    assert section.done == {"adv0", "adv1"}
+    section.advertiser_done("adv2", {"adv2": 2})
+    checkpoint.close()
+    section = Checkpoint(cp_path).section("a", {}, tmpdir.join("a.csv"))
+    assert section.done == {"adv0", "adv1", "adv2"}
+    assert section.tracking_versions == {"adv0": 0, "adv1": 1, "adv2": 2}
+
+
+def test_warns_about_a_section_without_advertiser_ids(tmpdir, caplog):
+    outpath = tmpdir.join("adgroups.csv")
+    section = Checkpoint(tmpdir.join("checkpoint.jsonl")).section("delta_adgroups", {}, outpath)
+    with CsvTableWriter(outpath.strpath) as writer:
+        for i in range(2):
+            writer.writerow({"AdGroupId": i})
+            section.advertiser_done("adv{}".format(i), {}, writer)
+    warnings = [record for record in caplog.records if "from scratch" in record.getMessage()]
+    assert len(warnings) == 1
+    assert "delta_adgroups" in warnings[0].getMessage()
@@ -0,0 +1,138 @@
+import threading
+import time
+import pytest
+import requests
+from ttdex.coalesce import RequestCache, is_kept, request_key
+
+
+def make_response(body, status=200):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    return response
+
+
+def test_request_key_only_for_idempotent_calls():
+    url = "https://api/v3/campaign/c1"
+    assert request_key("GET", "campaign/c1", url, {}) is not None
+    assert request_key("GET", "campaign/c1", url, {}) == request_key("get", "campaign/c1", url, {})
+    query = "https://api/v3/delta/campaign/query/advertiser"
+    assert (request_key("POST", "delta/campaign/query/advertiser", query, {"json": {"a": 1, "b": 2}}) ==
+            request_key("POST", "delta/campaign/query/advertiser", query, {"json": {"b": 2, "a": 1}}))
+    assert (request_key("POST", "delta/campaign/query/advertiser", query, {"json": {"a": 1}}) !=
+            request_key("POST", "delta/campaign/query/advertiser", query, {"json": {"a": 2}}))
+
+    assert request_key("POST", "authentication", url, {"json": {}}) is None
+    assert request_key("POST", "campaign/clone", url, {"json": {}}) is None
+    assert request_key("PUT", "campaign", url, {"json": {}}) is None
+    assert request_key("GET", "campaign/clone/status/ref1", url, {}) is None
+    assert request_key("GET", "campaign/c1", url, {"stream": True}) is None
+
+
+def test_cache_serves_repeats_as_copies():
+    cache = RequestCache()
+    calls = []
+
+    def send():
+        calls.append(1)
+        return make_response(b'{"CampaignId": "c1"}')
+
+    first, hit = cache.fetch("k", send)
+    assert not hit
+    second, hit = cache.fetch("k", send)
+    assert hit
+    assert len(calls) == 1
+    assert second is not first
+    assert second.json() == first.json() == {"CampaignId": "c1"}
+    assert cache.hits == 1
+
+
+def test_cache_doesnt_keep_errors():
+    cache = RequestCache()
+    cache.fetch("k", lambda: make_response(b'', status=429))
+    response, hit = cache.fetch("k", lambda: make_response(b'{}'))
+    assert not hit
+    assert response.status_code == 200
+
+
+def test_only_entities_and_small_listings_are_kept():
+    assert is_kept("GET", "campaign/c1")
+    assert is_kept("POST", "/advertiser/query/partner")
+    assert is_kept("POST", "sitelist/query/advertiser")
+    assert not is_kept("POST", "delta/campaign/query/advertiser")
+    assert not is_kept("POST", "adgroup/query/advertiser")
+
+    cache = RequestCache()
+    cache.fetch("k", lambda: make_response(b'{}'), keep=False)
+    _, hit = cache.fetch("k", lambda: make_response(b'{}'), keep=False)
+    assert not hit
+    assert len(cache) == 0
+
+
+def test_cache_evicts_the_least_recently_used():
+    cache = RequestCache(max_entries=2, max_bytes=10)
+    cache.fetch("a", lambda: make_response(b'1'))
+    cache.fetch("b", lambda: make_response(b'2'))
+    cache.fetch("a", lambda: make_response(b'x'))
+    cache.fetch("c", lambda: make_response(b'3'))
+    assert len(cache) == 2
+    assert cache.fetch("a", lambda: make_response(b'x'))[0].content == b'1'
+    assert cache.fetch("b", lambda: make_response(b'y'))[0].content == b'y'
+
+    # bounded by bytes too
+    cache.fetch("big", lambda: make_response(b'0123456789'))
+    assert len(cache) == 1
+    cache.fetch("too big", lambda: make_response(b'0123456789a'))
+    assert len(cache) == 1
+
+
+def test_cache_coalesces_in_flight_requests():
+    cache = RequestCache(max_entries=0)
+    calls = []
+    results = []
+
+    def send():
+        calls.append(1)
+        time.sleep(0.05)
+        return make_response(b'{"a": 1}')
+
+    threads = [threading.Thread(target=lambda: results.append(cache.fetch("k", send)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True, True]
+    assert all(response.json() == {"a": 1} for response, _ in results)
+    # nothing is kept after the requests finished
+    assert len(cache) == 0
+
+
+def test_cache_shares_errors_of_in_flight_requests():
+    cache = RequestCache()
+    started = threading.Event()
+    errors = []
+
+    def send():
+        started.set()
+        time.sleep(0.05)
+        raise requests.ConnectionError("boom")
+
+    def fetch():
+        try:
+            cache.fetch("k", send)
+        except requests.ConnectionError as err:
+            errors.append(err)
+
+    owner = threading.Thread(target=fetch)
+    owner.start()
+    started.wait()
+    waiter = threading.Thread(target=fetch)
+    waiter.start()
+    owner.join()
+    waiter.join()
+    assert len(errors) == 2
+    with pytest.raises(requests.ConnectionError):
+        cache.fetch("k", send)
@@ -0,0 +1,65 @@
+import time
+import pytest
+from ttdex.concurrency import fan_out, prefetch_ordered
+
+
+def delta_stream(advertiser_id):
+    """Simulates fetch_all_delta_THING_for_advertiser + the {id: version} wrapping"""
+    for version in range(5):
+        time.sleep(0.001)
+        yield {"AdvertiserId": advertiser_id, "v": version}, {advertiser_id: version}
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_fan_out_keeps_per_item_order_and_tracking_versions(max_workers):
+    advertisers = ["adv{}".format(i) for i in range(20)]
+
+    tracking_versions = {}
+    seen = {}
+    for row, version in fan_out(delta_stream, advertisers, max_workers, buffer_size=3):
+        seen.setdefault(row["AdvertiserId"], []).append(row["v"])
+        tracking_versions.update(version)
+
+    assert tracking_versions == {adv: 4 for adv in advertisers}
+    assert all(versions == list(range(5)) for versions in seen.values())
+    assert set(seen) == set(advertisers)
+
+
+def test_fan_out_propagates_worker_errors():
+    def broken(item):
+        yield item
+        if item == 3:
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        list(fan_out(broken, range(10), max_workers=3))
+
+
+def test_fan_out_stops_when_consumer_stops():
+    started = []
+
+    def endless(item):
+        started.append(item)
+        while True:
+            yield item
+
+    stream = fan_out(endless, range(100), max_workers=2, buffer_size=1)
+    next(stream)
+    stream.close()
+    # only the running workers were started, the rest got cancelled
+    assert len(started) <= 4
+
+
+def test_prefetch_ordered_keeps_order_and_window():
+    running = []
+    max_running = []
+
+    def fetch(page):
+        running.append(page)
+        max_running.append(len(running))
+        time.sleep(0.001 * (10 - page % 10))
+        running.remove(page)
+        return page
+
+    assert list(prefetch_ordered(fetch, range(30), window=4)) == list(range(30))
+    assert max(max_running) <= 4
@@ -0,0 +1,54 @@
+import threading
+import time
+from ttdex.directory import AdvertiserDirectory, directory_key
+
+
+def test_directory_key_ignores_order():
+    assert (directory_key({"PartnerId": "p", "availabilities": ["Available", "Archived"]}) ==
+            directory_key({"availabilities": ["Archived", "Available"], "PartnerId": "p"}))
+    assert directory_key({"PartnerId": "p"}) != directory_key({"PartnerId": "q"})
+
+
+def test_directory_lists_once_for_concurrent_sections():
+    calls = []
+
+    def fetch(payload):
+        calls.append(payload)
+        time.sleep(0.05)
+        yield {"AdvertiserId": "a1"}
+        yield {"AdvertiserId": "a2"}
+
+    directory = AdvertiserDirectory()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            directory.advertisers({"PartnerId": "p"}, fetch)))
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [[{"AdvertiserId": "a1"}, {"AdvertiserId": "a2"}]] * 4
+
+
+def test_directory_disk_cache_expires(tmpdir):
+    now = [1000.0]
+    cache_path = tmpdir.join("store/advertisers.json")
+    calls = []
+
+    def fetch(payload):
+        calls.append(payload)
+        return [{"AdvertiserId": "a{}".format(len(calls))}]
+
+    def directory():
+        return AdvertiserDirectory(cache_path, ttl=60, clock=lambda: now[0])
+
+    assert directory().advertisers({"PartnerId": "p"}, fetch) == [{"AdvertiserId": "a1"}]
+    now[0] += 59
+    assert directory().advertisers({"PartnerId": "p"}, fetch) == [{"AdvertiserId": "a1"}]
+    assert len(calls) == 1
+    now[0] += 2
+    assert directory().advertisers({"PartnerId": "p"}, fetch) == [{"AdvertiserId": "a2"}]
+    assert len(calls) == 2
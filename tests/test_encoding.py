@@ -0,0 +1,48 @@
+import json
+import pytest
+from ttdex import encoding
+from ttdex.encoding import RowEncoder, get_dumps, set_default_backend
+
+
+@pytest.mark.parametrize("backend", ["auto", "json"])
+def test_dumps_backends_roundtrip(backend):
+    value = {"a": [1, "two", {"three": None}], "url": "https://x/y", "ü": 1.5}
+    assert json.loads(get_dumps(backend)(value)) == value
+
+
+def test_default_backend_is_the_standard_library():
+    value = {"a": [1, "ü"]}
+    assert get_dumps()(value) == json.dumps(value)
+
+
+def test_set_default_backend(monkeypatch):
+    monkeypatch.setattr(encoding, "_default_backend", encoding.DEFAULT_BACKEND)
+    set_default_backend("auto")
+    assert encoding.default_backend() == "auto"
+    with pytest.raises(ValueError):
+        set_default_backend("simplejson")
+
+
+def test_encoder_dumps_nested_values():
+    encoder = RowEncoder(dumps=json.dumps)
+    columns = ["id", "budget", "maybe"]
+    rows = [
+        {"id": 1, "budget": {"Amount": 1}, "maybe": None},
+        {"id": 2, "budget": None, "maybe": [1]},
+    ]
+    encoded = encoder.encode_batch(rows, columns)
+
+    assert encoded[0] == [1, '{"Amount": 1}', None]
+    assert encoded[1] == [2, None, "[1]"]
+
+
+def test_encoder_dumps_a_nested_value_in_a_scalar_column():
+    encoder = RowEncoder(dumps=json.dumps)
+    rows = [{"id": i, "value": i} for i in range(2000)] + [{"id": 2000, "value": {"x": 1}}]
+    assert encoder.encode_batch(rows, ["id", "value"])[-1] == [2000, '{"x": 1}']
+
+
+def test_encoder_handles_new_columns():
+    encoder = RowEncoder(dumps=json.dumps)
+    encoder.encode({"id": 1}, ["id"])
+    assert encoder.encode({"id": 2, "new": {"x": 1}}, ["id", "new"]) == [2, '{"x": 1}']
@@ -0,0 +1,61 @@
+import threading
+import pytest
+from ttdex.engine import run_sections_concurrently
+
+
+class FakeExtractor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Sections:
+    """Sections meeting at a barrier of `parties`, which breaks (and fails
+    the sections) if that many of them don't run at the same time"""
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=5)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.log = []
+
+    def section(self, ex):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            self.barrier.wait()
+        finally:
+            with self.lock:
+                self.running -= 1
+        self.log.append(threading.current_thread().name)
+
+
+def test_sections_run_concurrently():
+    sections = Sections(4)
+    run_sections_concurrently([("s{}".format(i), sections.section) for i in range(4)],
+                              FakeExtractor, max_concurrency=4)
+    assert len(sections.log) == 4
+    assert sections.peak == 4
+
+
+def test_concurrency_limit():
+    sections = Sections(2)
+    run_sections_concurrently([("s{}".format(i), sections.section) for i in range(4)],
+                              FakeExtractor, max_concurrency=2)
+    assert len(sections.log) == 4
+    assert sections.peak == 2
+
+
+def test_failing_section_doesnt_stop_the_others():
+    sections = Sections(1)
+
+    def broken(ex):
+        raise KeyError("boom")
+
+    with pytest.raises(KeyError):
+        run_sections_concurrently([("broken", broken), ("ok", sections.section)],
+                                  FakeExtractor, max_concurrency=2)
+    assert len(sections.log) == 1
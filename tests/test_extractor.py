@@ -1,4 +1,5 @@
 from ttdex.extractor import TTDExtractor
+from ttdex.store import TemplateStore
 import os
 import json
 import pytest
@@ -62,3 +63,157 @@ def test_extracting_adgroup_templates(extractor):
     assert templates[0]["CampaignId"] == ids[0]
     assert isinstance(templates[0]["template"], dict)
 
+
+def test_serializing_delta_stream_with_leading_empty_rows_and_new_columns(tmpdir):
+    def delta_stream():
+        for version in range(1000):
+            yield None, {"adv1": version}
+        yield {"CampaignId": "c1", "Budget": {"Amount": 1}}, {"adv2": 7}
+        yield {"CampaignId": "c2", "Optional": "field"}, {"adv2": 8}
+
+    outpath = tmpdir.join("delta.csv").strpath
+    returned_outpath, versions = TTDExtractor.serialize_delta_stream_to_csv(
+        delta_stream(), outpath)
+
+    assert returned_outpath == outpath
+    assert versions == {"adv1": 999, "adv2": 8}
+    with open(outpath) as fin:
+        rows = list(csv.DictReader(fin))
+    assert [row["CampaignId"] for row in rows] == ["c1", "c2"]
+    assert rows[0]["Optional"] == ""
+    assert rows[1]["Optional"] == "field"
+
+
+def test_serializing_delta_stream_without_data(tmpdir):
+    outpath = tmpdir.join("delta.csv")
+    stream = ((None, {"adv{}".format(i): i}) for i in range(3))
+    returned_outpath, versions = TTDExtractor.serialize_delta_stream_to_csv(
+        stream, outpath.strpath)
+    assert returned_outpath is None
+    assert versions == {"adv0": 0, "adv1": 1, "adv2": 2}
+    assert not outpath.exists()
+
+
+@pytest.mark.parametrize("page_size", [7, 1000])
+def test_prefetching_pages_keeps_the_order(mock_api, page_size):
+    mock_api.max_page_size = 10
+    mock_api.campaigns_per_advertiser = 20
+    kwargs = dict(login='login', password='password', base_url=mock_api.base_url)
+    serial = TTDExtractor(**kwargs)
+    prefetching = TTDExtractor(page_size=page_size, prefetch_pages=3, **kwargs)
+
+    payload = {"AdvertiserId": "adv0"}
+    with serial, prefetching:
+        expected = list(serial.post_paginated('adgroup/query/advertiser', payload, stream_items=True))
+        got = list(prefetching.post_paginated('adgroup/query/advertiser', payload, stream_items=True))
+
+    assert len(expected) == 20 * 3
+    assert got == expected
+
+
+def test_login_asks_for_the_token_lifetime(mock_api):
+    ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url,
+                      token_lifetime_minutes=1440)
+    with ex:
+        pass
+    assert mock_api.logins == [
+        {"Login": "login", "Password": "password", "TokenExpirationInMinutes": 1440}]
+    assert ex.headers[TTDExtractor.AUTH_HEADER] == "mock-token"
+
+
+def test_prefetched_pages_ask_for_the_size_of_the_first_page(mock_api):
+    mock_api.max_page_size = 10
+    mock_api.campaigns_per_advertiser = 20
+    ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url,
+                      page_size=1000, prefetch_pages=3)
+    payloads = []
+    post = ex.post
+
+    def recording_post(endpoint, json=None, **kwargs):
+        if endpoint == 'adgroup/query/advertiser':
+            payloads.append(json)
+        return post(endpoint, json=json, **kwargs)
+
+    ex.post = recording_post
+    with ex:
+        list(ex.post_paginated('adgroup/query/advertiser', {"AdvertiserId": "adv0"}))
+
+    assert [(p["PageStartIndex"], p["PageSize"]) for p in payloads] == [
+        (0, 1000)] + [(start, 10) for start in range(10, 60, 10)]
+
+
+def test_refreshing_only_changed_campaign_templates(mock_api, tmpdir):
+    campaign_ids = ["adv0-camp0", "adv0-camp1", "adv1-camp0"]
+    store_path = tmpdir.join("templates.sqlite").strpath
+    ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url)
+
+    def run():
+        with ex, TemplateStore(store_path) as store:
+            return list(ex.extract_changed_campaign_templates(campaign_ids, store))
+
+    first = run()
+    assert [t["CampaignId"] for t in first] == campaign_ids
+    assert mock_api.requests[("GET", "campaign/<id>")] == 3
+
+    # nothing changed
+    assert run() == first
+    assert mock_api.requests[("GET", "campaign/<id>")] == 3
+
+    # two new campaigns of adv0, the delta endpoint reports them (and only them)
+    mock_api.campaigns_per_advertiser += 2
+    campaign_ids.append("adv0-camp5")
+    assert [t["CampaignId"] for t in run()] == campaign_ids
+    # just the one new campaign, adv0-camp6 isn't configured
+    assert mock_api.requests[("GET", "campaign/<id>")] == 4
+
+
+def test_campaign_changed_while_not_configured_is_downloaded_again(mock_api, tmpdir):
+    store_path = tmpdir.join("templates.sqlite").strpath
+
+    def run(campaign_ids):
+        # a new extractor (and request cache) like in a new run
+        ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url)
+        with ex, TemplateStore(store_path) as store:
+            return list(ex.extract_changed_campaign_templates(campaign_ids, store))
+
+    run(["adv0-camp0", "adv0-camp1"])
+    assert mock_api.requests[("GET", "campaign/<id>")] == 2
+
+    # adv0-camp1 changes while it's not in the config
+    campaigns = mock_api.campaigns
+    mock_api.campaigns = lambda advertiser_id: campaigns(advertiser_id) + [
+        dict(campaigns(advertiser_id)[1], CampaignName="Renamed")]
+    run(["adv0-camp0"])
+    assert mock_api.requests[("GET", "campaign/<id>")] == 2
+    with TemplateStore(store_path) as store:
+        assert store.template("adv0-camp1") is None
+
+    # added again, it isn't taken from the store
+    assert [t["CampaignId"] for t in run(["adv0-camp0", "adv0-camp1"])] == [
+        "adv0-camp0", "adv0-camp1"]
+    assert mock_api.requests[("GET", "campaign/<id>")] == 3
+
+
+def test_unconfigured_extractor_doesnt_pace_requests(mock_api, monkeypatch):
+    ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url)
+
+    def sleep(seconds):
+        raise AssertionError("waited {}s for the rate limiter".format(seconds))
+
+    monkeypatch.setattr(ex.rate_limiter._global, "_sleep", sleep)
+    with ex:
+        for i in range(50):
+            ex.get("campaign/adv{}-camp0".format(i))
+    assert mock_api.requests[("GET", "campaign/<id>")] == 50
+
+
+def test_stored_template_without_advertiser(mock_api, tmpdir):
+    store_path = tmpdir.join("templates.sqlite").strpath
+    with TemplateStore(store_path) as store:
+        store.save_template("orphan", {"CampaignName": "no advertiser"})
+    ex = TTDExtractor(login='login', password='password', base_url=mock_api.base_url)
+    with ex, TemplateStore(store_path) as store:
+        templates = list(ex.extract_changed_campaign_templates(["orphan", "adv0-camp0"], store))
+    assert [t["CampaignId"] for t in templates] == ["orphan", "adv0-camp0"]
+    assert templates[0]["template"] == {"CampaignName": "no advertiser"}
+    assert mock_api.requests[("GET", "campaign/<id>")] == 1
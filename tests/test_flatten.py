@@ -0,0 +1,78 @@
+import json
+import pytest
+import voluptuous as vp
+from ttdex.extractor import TTDExtractor
+from ttdex.flatten import Flattener, FlattenSchema
+from helpers import read_csv
+
+
+SPECS = [{
+    "path": "AdGroups",
+    "table": "campaign_adgroups",
+    "parent_keys": ["CampaignId"],
+    "flatten": [{
+        "path": "RTBAttributes.BidLists",
+        "table": "adgroup_bidlists",
+        "parent_keys": ["AdGroupId"]
+    }]
+}, {
+    "path": "Budget",
+    "table": "campaign_budgets",
+    "parent_keys": ["CampaignId"]
+}]
+
+
+def campaigns():
+    for c in range(3):
+        yield {
+            "CampaignId": "c{}".format(c),
+            "Budget": {"Amount": c * 100, "CurrencyCode": "USD"},
+            "AdGroups": [{
+                "AdGroupId": "c{}-a{}".format(c, a),
+                "RTBAttributes": {"BidLists": ["bl1", "bl2"], "BaseBid": 1},
+            } for a in range(2)],
+        }
+
+
+def test_serializer_splits_nested_values_into_child_tables(tmpdir):
+    outpath = tmpdir.join("campaigns.csv")
+    with Flattener(FlattenSchema(SPECS), tmpdir.strpath) as flatten:
+        TTDExtractor.serialize_response_to_json(campaigns(), outpath, flatten=flatten)
+
+    assert [row["CampaignId"] for row in read_csv(outpath)] == ["c0", "c1", "c2"]
+    assert list(read_csv(outpath)[0]) == ["CampaignId"]
+
+    adgroups = read_csv(tmpdir.join("campaign_adgroups.csv"))
+    assert len(adgroups) == 3 * 2
+    assert adgroups[1]["CampaignId"] == "c0"
+    assert adgroups[1]["AdGroupId"] == "c0-a1"
+    assert adgroups[1]["_index"] == "1"
+    # the bid lists are gone, the rest of RTBAttributes stays a json string
+    assert json.loads(adgroups[1]["RTBAttributes"]) == {"BaseBid": 1}
+
+    bidlists = read_csv(tmpdir.join("adgroup_bidlists.csv"))
+    assert len(bidlists) == 3 * 2 * 2
+    assert bidlists[0] == {"AdGroupId": "c0-a0", "_index": "0", "value": "bl1"}
+
+    budgets = read_csv(tmpdir.join("campaign_budgets.csv"))
+    assert budgets[2] == {"CampaignId": "c2", "Amount": "200", "CurrencyCode": "USD"}
+    assert flatten.tables == {
+        "campaign_adgroups": 6, "adgroup_bidlists": 12, "campaign_budgets": 3}
+
+
+def test_flatten_config_is_validated():
+    with pytest.raises(vp.Invalid):
+        FlattenSchema([{"path": "AdGroups"}])
+    with pytest.raises(vp.Invalid):
+        FlattenSchema([{"path": "a", "table": "t", "flatten": [{"table": "t2"}]}])
+
+
+def test_flattening_leaves_the_rows_untouched(tmpdir):
+    # the rows can be shared with other sections, eg. the advertiser listing
+    rows = list(campaigns())
+    originals = json.loads(json.dumps(rows))
+    with Flattener(FlattenSchema(SPECS), tmpdir.strpath) as flatten:
+        flattened = [flatten(row) for row in rows]
+    assert rows == originals
+    assert set(flattened[0]) == {"CampaignId"}
+    assert len(read_csv(tmpdir.join("adgroup_bidlists.csv"))) == 3 * 2 * 2
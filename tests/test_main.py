@@ -1,6 +1,12 @@
+import csv
+import gzip
+import json
 import pytest
 import logging
+import voluptuous as vp
 from ttdex.extractor import main, validate_config, PredefinedTemplates
+from mockapi import MockTTDApi
+from helpers import read_csv
 
 @pytest.fixture
 def config_skeleton():
@@ -57,3 +63,297 @@ def test_validating_full_config(config_skeleton):
         }
 }
     assert validate_config(config_skeleton)
+
+
+@pytest.mark.parametrize("concurrent_sections,pipeline", [
+    (False, None),
+    (True, None),
+    (False, {"batch_size": 4, "encode_processes": 1}),
+])
+def test_main_against_mock_api(mock_api, datadir, concurrent_sections, pipeline):
+    datadir.join("in/tables/poll_cloned_campaign_get_details.csv").write(
+        "ReferenceId,note\nref1,first\nfail2,second\n")
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "rate_limit": {"requests_per_minute": 60000},
+        "clone_polling": {"max_delay": 0.1},
+        "concurrent_sections": concurrent_sections,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0", "adv1-camp1"]},
+            "adgroup_templates": {"campaign_ids": ["adv0-camp0"]},
+            "sitelists_summary": {"iterations": [{"AdvertiserId": "adv0"}]},
+            "all_advertisers": {"partner_id": "partner"},
+            "all_adgroups_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+        },
+        "custom_post_paginated_queries": [{
+            "endpoint": "campaign/query/advertiser",
+            "payload": {"AdvertiserId": "adv2"},
+            "filename": "adv2_campaigns.csv"}]
+    }
+    if pipeline is not None:
+        params["pipeline"] = pipeline
+    main(datadir.strpath, validate_config(params))
+
+    out = datadir.join("out/tables")
+    assert len(read_csv(out.join("campaign_templates.csv"))) == 2
+    assert len(read_csv(out.join("adgroup_templates.csv"))) == 3
+    assert len(read_csv(out.join("sitelists_summary.csv"))) == 2
+    assert len(read_csv(out.join("advertisers.csv"))) == 3
+    assert len(read_csv(out.join("all_adgroups_all_advertisers.csv"))) == 3 * 5 * 3
+    assert len(read_csv(out.join("adv2_campaigns.csv"))) == 5
+    assert len(read_csv(out.join("delta_campaigns.csv"))) == 3 * 5
+
+    cloned = {row["ReferenceId"]: row for row in read_csv(out.join("cloned_campaigns.csv"))}
+    assert cloned["ref1"]["CampaignId"] == "clone-ref1"
+    assert cloned["fail2"]["CampaignId"] == ""
+    assert len(read_csv(out.join("cloned_campaign_adgroups.csv"))) == 3
+    # the adgroups of the clone are listed at once
+    assert mock_api.requests[("GET", "adgroup/<id>")] == 0
+
+    state = json.loads(datadir.join("out/state.json").read())
+    assert state["delta_campaigns"] == {"adv0": 5, "adv1": 5, "adv2": 5}
+
+
+def test_main_logs_in_once_and_reuses_the_token(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0"]},
+            "all_advertisers": {"partner_id": "partner"},
+            "sitelists_summary": {"iterations": [{"AdvertiserId": "adv0"}]},
+        },
+    }
+    main(datadir.strpath, params)
+    assert mock_api.requests[("POST", "authentication")] == 1
+
+    state = json.loads(datadir.join("out/state.json").read())
+    assert state["auth"]["#token"] == "mock-token"
+
+    # the next run takes the token from the statefile
+    datadir.join("in/state.json").write(json.dumps(state))
+    main(datadir.strpath, params)
+    assert mock_api.requests[("POST", "authentication")] == 1
+
+
+def test_main_with_checkpoint_clears_it_after_success(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "checkpoint": True,
+        "max_workers": 3,
+        "extract_predefined": {
+            "all_adgroups_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+
+    out = datadir.join("out/tables")
+    assert len(read_csv(out.join("all_adgroups_all_advertisers.csv"))) == 3 * 5 * 3
+    assert len(read_csv(out.join("delta_campaigns.csv"))) == 3 * 5
+    assert not datadir.join("store/checkpoint.jsonl").exists()
+
+
+def test_main_builds_delta_snapshot(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "extract_predefined": {
+            "delta_campaigns": {"partner_id": "partner", "snapshot": True},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+    out = datadir.join("out/tables")
+    assert len(read_csv(out.join("delta_campaigns.csv"))) == 3 * 5
+    assert len(read_csv(out.join("delta_campaigns_snapshot.csv"))) == 3 * 5
+    assert json.loads(out.join("delta_campaigns_snapshot.csv.manifest").read()) == {
+        "incremental": False, "primary_key": ["AdvertiserId", "CampaignId"]}
+
+    # two new campaigns per advertiser, only those are downloaded
+    mock_api.campaigns_per_advertiser = 7
+    datadir.join("in/state.json").write(datadir.join("out/state.json").read())
+    main(datadir.strpath, validate_config(params))
+    assert len(read_csv(out.join("delta_campaigns.csv"))) == 3 * 2
+    snapshot = read_csv(out.join("delta_campaigns_snapshot.csv"))
+    assert len(snapshot) == 3 * 7
+    assert len({(row["AdvertiserId"], row["CampaignId"]) for row in snapshot}) == 3 * 7
+
+
+def test_main_downloads_everything_for_a_new_snapshot_store(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "extract_predefined": {
+            "delta_campaigns": {"partner_id": "partner", "snapshot": True},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+    state = json.loads(datadir.join("out/state.json").read())
+    assert state["delta_campaigns_snapshot"]
+
+    # the store is gone (a new store_dir), the tracking versions are still there
+    datadir.join("store/delta_campaigns_snapshot.sqlite").remove()
+    mock_api.campaigns_per_advertiser = 7
+    datadir.join("in/state.json").write(json.dumps(state))
+    main(datadir.strpath, validate_config(params))
+    out = datadir.join("out/tables")
+    assert len(read_csv(out.join("delta_campaigns.csv"))) == 3 * 7
+    assert len(read_csv(out.join("delta_campaigns_snapshot.csv"))) == 3 * 7
+    new_state = json.loads(datadir.join("out/state.json").read())
+    assert new_state["delta_campaigns_snapshot"] != state["delta_campaigns_snapshot"]
+
+
+def test_main_writes_sliced_tables(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "sliced_output": {"slice_rows": 10, "writers": 2},
+        "extract_predefined": {
+            "all_adgroups_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+
+    out = datadir.join("out/tables")
+    assert out.join("all_adgroups_all_advertisers.csv").isdir()
+    assert out.join("all_adgroups_all_advertisers.csv").listdir("*.csv.gz")
+    manifest = json.loads(out.join("delta_campaigns.csv.manifest").read())
+    assert manifest["incremental"] is True
+    assert "CampaignId" in manifest["columns"]
+
+
+def test_checkpoint_cant_be_combined_with_sliced_output(config_skeleton):
+    config_skeleton["extract_predefined"] = {}
+    config_skeleton.update(checkpoint=True, sliced_output={})
+    with pytest.raises(vp.Invalid):
+        validate_config(config_skeleton)
+
+
+def test_main_passes_raw_ndjson_through(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0"], "format": "ndjson"},
+            "adgroup_templates": {"campaign_ids": ["adv0-camp0"], "format": "ndjson"},
+        },
+        "custom_post_paginated_queries": [{
+            "endpoint": "campaign/query/advertiser",
+            "payload": {"AdvertiserId": "adv2"},
+            "filename": "adv2_campaigns.csv",
+            "format": "ndjson"}]
+    }
+    main(datadir.strpath, validate_config(params))
+
+    files = datadir.join("out/files")
+    campaigns = [json.loads(line) for line in files.join("adv2_campaigns.ndjson").readlines()]
+    assert len(campaigns) == 5
+    assert all(campaign["AdvertiserId"] == "adv2" for campaign in campaigns)
+    assert json.loads(files.join("adv2_campaigns.ndjson.manifest").read()) == {
+        "tags": ["adv2_campaigns"]}
+    adgroups = files.join("adgroup_templates.ndjson").readlines()
+    assert [json.loads(line)["CampaignId"] for line in adgroups] == ["adv0-camp0"] * 3
+    template, = files.join("campaign_templates.ndjson").readlines()
+    assert json.loads(template)["CampaignId"] == "adv0-camp0"
+    assert not datadir.join("out/tables").listdir()
+
+
+def test_main_lists_the_advertisers_once(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "concurrent_sections": True,
+        "advertiser_cache": {"ttl_minutes": 60},
+        "extract_predefined": {
+            "all_campaigns_all_advertisers": {"partner_id": "partner"},
+            "all_adgroups_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+            "delta_adgroups": {"partner_id": "partner"},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+    assert mock_api.requests[("POST", "advertiser/query/partner")] == 1
+
+    # the next run takes them from the cache in store_dir
+    main(datadir.strpath, validate_config(params))
+    assert mock_api.requests[("POST", "advertiser/query/partner")] == 1
+    out = datadir.join("out/tables")
+    assert len(read_csv(out.join("all_campaigns_all_advertisers.csv"))) == 3 * 5
+
+
+def test_main_sends_identical_requests_once(mock_api, datadir):
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0", "adv0-camp0", "adv1-camp1"]},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+    assert mock_api.requests[("GET", "campaign/<id>")] == 2
+    rows = read_csv(datadir.join("out/tables/campaign_templates.csv"))
+    assert [row["CampaignId"] for row in rows] == ["adv0-camp0", "adv0-camp0", "adv1-camp1"]
+    metrics = json.loads(datadir.join("metrics.json").read())
+    assert metrics["endpoints"]["GET campaign/{id}"]["cache_hits"] == 1
+
+
+def test_cloned_adgroups_missing_from_the_query_are_fetched_by_id(datadir):
+    datadir.join("in/tables/poll_cloned_campaign_get_details.csv").write(
+        "ReferenceId\nref1\n")
+    with MockTTDApi(unlisted_clone_adgroups=2) as mock_api:
+        params = {
+            "login": "login",
+            "#password": "password",
+            "base_url": mock_api.base_url,
+            "max_workers": 2,
+            "clone_polling": {"max_delay": 0.1},
+        }
+        main(datadir.strpath, validate_config(params))
+        assert mock_api.requests[("POST", "adgroup/query/campaign")] == 1
+        assert mock_api.requests[("GET", "adgroup/<id>")] == 2
+
+    adgroups = read_csv(datadir.join("out/tables/cloned_campaign_adgroups.csv"))
+    assert [row["AdGroupId"] for row in adgroups] == [
+        "clone-ref1-ag{}".format(i) for i in range(5)]
+    assert {row["CampaignId"] for row in adgroups} == {"clone-ref1"}
+
+
+def test_main_streams_sitelist_lines_into_a_sliced_table(datadir):
+    with MockTTDApi(sitelists_per_advertiser=3, sitelist_lines=250) as mock_api:
+        params = {
+            "login": "login",
+            "#password": "password",
+            "base_url": mock_api.base_url,
+            "max_workers": 2,
+            "extract_predefined": {
+                "sitelist_lines": {"iterations": [{"AdvertiserId": "adv0"}, {"AdvertiserId": "adv1"}]},
+            },
+        }
+        main(datadir.strpath, validate_config(params))
+        assert mock_api.requests[("GET", "sitelist/<id>")] == 2 * 3
+
+    out = datadir.join("out/tables")
+    table = out.join("sitelist_lines.csv")
+    assert table.isdir()
+    columns = json.loads(out.join("sitelist_lines.csv.manifest").read())["columns"]
+    assert columns[0] == "SiteListId"
+    rows = []
+    for part in table.listdir("*.csv.gz"):
+        with gzip.open(part.strpath, "rt") as inf:
+            rows.extend(dict(zip(columns, row)) for row in csv.reader(inf))
+    assert len(rows) == 2 * 3 * 250
+    assert len({row["SiteListId"] for row in rows}) == 6
+    assert all(row["Domain"].endswith(row["SiteListId"] + ".example.com") for row in rows)
@@ -0,0 +1,20 @@
+import pytest
+from memprofile import WORKLOADS, peak_allocated
+
+# rows of the small run, the big one has GROWTH times more; the small run
+# has to be big enough to fill the (bounded) write batches already
+ROWS = {'csv_wide': 1000, 'main': 1000}
+DEFAULT_ROWS = 2000
+GROWTH = 3
+# what the peak may grow by, besides noise
+SLACK_BYTES = 256 * 1024
+
+
+@pytest.mark.parametrize("name", list(WORKLOADS))
+def test_peak_memory_doesnt_grow_with_rows(tmpdir, name):
+    rows = ROWS.get(name, DEFAULT_ROWS)
+    small = peak_allocated(WORKLOADS[name], tmpdir.mkdir("small").strpath, rows)
+    big = peak_allocated(WORKLOADS[name], tmpdir.mkdir("big").strpath, rows * GROWTH)
+    assert big <= small * 1.25 + SLACK_BYTES, (
+        "{} rows peaked at {} kB, {} rows at {} kB".format(
+            rows, small // 1024, rows * GROWTH, big // 1024))
@@ -0,0 +1,83 @@
+import json
+import pstats
+from ttdex.extractor import main, validate_config
+from ttdex.metrics import Metrics, endpoint_key
+from mockapi import MockTTDApi
+
+
+def test_endpoint_key_hides_entity_ids():
+    assert endpoint_key("get", "/campaign/abc123") == "GET campaign/{id}"
+    assert endpoint_key("GET", "campaign/clone/status/ref1") == "GET campaign/clone/status/{id}"
+    assert endpoint_key("POST", "delta/campaign/query/advertiser") == "POST delta/campaign/query/advertiser"
+
+
+def test_metrics_histogram_and_tables(tmpdir):
+    metrics = Metrics()
+    for seconds in (0.001, 0.2, 0.3, 20):
+        metrics.request("GET campaign/{id}", seconds, 200)
+    metrics.request("GET campaign/{id}", 0.001, 429)
+    metrics.retried("GET campaign/{id}", 1.5)
+    outpath = tmpdir.join("out.csv")
+    outpath.write("a\n1\n")
+    metrics.table(outpath, 1)
+
+    data = metrics.to_dict()
+    campaign = data["endpoints"]["GET campaign/{id}"]
+    assert campaign["requests"] == 5
+    assert campaign["statuses"] == {"200": 4, "429": 1}
+    assert campaign["latency_seconds"]["histogram"]["0.01"] == 2
+    assert campaign["latency_seconds"]["histogram"]["0.25"] == 1
+    assert campaign["latency_seconds"]["histogram"]["inf"] == 1
+    assert campaign["latency_seconds"]["max"] == 20
+    assert campaign["retries"] == 1
+    assert campaign["throttled_seconds"] == 1.5
+    assert data["tables"][outpath.strpath] == {"rows": 1, "bytes": 4}
+
+
+def test_main_writes_metrics_and_profile(mock_api, datadir):
+    mock_api.throttle_every = 4
+    mock_api.retry_after = 0
+    params = {
+        "login": "login",
+        "#password": "password",
+        "base_url": mock_api.base_url,
+        "profile": True,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0", "adv1-camp1"]},
+            "all_adgroups_all_advertisers": {"partner_id": "partner"},
+        },
+    }
+    main(datadir.strpath, validate_config(params))
+
+    metrics = json.loads(datadir.join("metrics.json").read())
+    endpoints = metrics["endpoints"]
+    assert endpoints["GET campaign/{id}"]["statuses"]["200"] == 2
+    assert endpoints["GET campaign/{id}"]["bytes_received"] > 0
+    assert sum(endpoint["retries"] for endpoint in endpoints.values()) > 0
+    table = metrics["tables"][datadir.join("out/tables/all_adgroups_all_advertisers.csv").strpath]
+    assert table["rows"] == 3 * 5 * 3
+    assert table["bytes"] > 0
+
+    stats = pstats.Stats(datadir.join("profile.pstats").strpath)
+    assert stats.total_calls > 0
+
+
+def test_bytes_received_are_counted_as_sent_over_the_network(datadir):
+    with MockTTDApi(gzip_responses=True, row_padding=2000) as api:
+        params = {
+            "login": "login",
+            "#password": "password",
+            "base_url": api.base_url,
+            "extract_predefined": {
+                "all_campaigns_all_advertisers": {"partner_id": "partner"},
+            },
+        }
+        main(datadir.strpath, validate_config(params))
+        bytes_sent = api.bytes_sent
+
+    endpoints = json.loads(datadir.join("metrics.json").read())["endpoints"]
+    assert sum(endpoint["bytes_received"] for endpoint in endpoints.values()) == bytes_sent
+    # the padding compresses well, the table is much bigger than what came
+    table_bytes = sum(table["bytes"] for table in json.loads(
+        datadir.join("metrics.json").read())["tables"].values())
+    assert table_bytes > 10 * bytes_sent
@@ -0,0 +1,118 @@
+import json
+import threading
+
+import pytest
+
+from ttdex.checkpoint import AdvertiserDone
+from ttdex.extractor import TTDExtractor
+from ttdex.flatten import Flattener, FlattenSchema
+from ttdex.pipeline import Pipeline, encode_delta_items, encode_rows
+
+
+def rows(count):
+    for i in range(count):
+        yield {"Id": i, "Nested": {"Value": i, "Tags": ["a", "b"]}}
+
+
+def test_pipeline_keeps_the_order_and_encodes_nested_values():
+    items = list(rows(250)) + [AdvertiserDone("adv0")]
+    with Pipeline(iter(items), encode_rows, batch_size=7, queue_size=2) as pipeline:
+        out = list(pipeline)
+
+    assert [row["Id"] for row in out[:-1]] == list(range(250))
+    assert json.loads(out[0]["Nested"]) == {"Value": 0, "Tags": ["a", "b"]}
+    assert isinstance(out[-1], AdvertiserDone)
+
+
+def test_pipeline_encodes_in_processes():
+    with Pipeline(rows(500), encode_rows, batch_size=10, encode_processes=2) as pipeline:
+        out = list(pipeline)
+    with Pipeline(rows(500), encode_rows, batch_size=10) as pipeline:
+        assert out == list(pipeline)
+
+
+def test_pipeline_applies_backpressure():
+    consumed = []
+
+    def source():
+        for row in rows(10000):
+            consumed.append(row)
+            yield row
+
+    with Pipeline(source(), encode_rows, batch_size=10, queue_size=2) as pipeline:
+        first = next(iter(pipeline))
+        # give the stages time to fill their queues
+        threading.Event().wait(0.3)
+        assert first["Id"] == 0
+        # two queues and a batch in each stage at most
+        assert len(consumed) <= 10 * (2 * 2 + 3)
+
+
+@pytest.mark.parametrize("stage", ["source", "prepare", "encode"])
+def test_pipeline_reraises_errors_of_the_stages(stage):
+    def source():
+        yield from rows(50)
+        if stage == "source":
+            raise ValueError("boom")
+
+    def prepare(batch):
+        if stage == "prepare":
+            raise ValueError("boom")
+        return batch
+
+    def encode(batch):
+        if stage == "encode":
+            raise ValueError("boom")
+        return batch
+
+    with pytest.raises(ValueError, match="boom"):
+        with Pipeline(source(), encode, prepare=prepare, batch_size=10) as pipeline:
+            list(pipeline)
+
+
+def test_pipeline_closes_the_source_when_the_consumer_stops():
+    closed = threading.Event()
+
+    def source():
+        try:
+            yield from rows(10 ** 6)
+        finally:
+            closed.set()
+
+    with Pipeline(source(), encode_rows, batch_size=10) as pipeline:
+        for row in pipeline:
+            if row["Id"] == 20:
+                break
+    assert closed.is_set()
+
+
+def delta_stream():
+    for i, row in enumerate(rows(300)):
+        yield row, {"adv0": i}
+        if i % 100 == 99:
+            yield None, {"adv1": i}
+            yield AdvertiserDone("adv0"), {"adv0": i}
+
+
+@pytest.mark.parametrize("encode_processes", [0, 2])
+def test_serializers_write_the_same_through_the_pipeline(tmpdir, encode_processes):
+    pipeline = {"batch_size": 16, "queue_size": 2, "encode_processes": encode_processes}
+    flatten = [{"path": "Nested.Tags", "table": "tags", "parent_keys": ["Id"]}]
+    for name, options in (("plain", None), ("piped", pipeline)):
+        outdir = tmpdir.mkdir(name)
+        TTDExtractor.serialize_response_to_json(
+            rows(300), outdir.join("rows.csv"), pipeline=options,
+            flatten=Flattener(FlattenSchema(flatten), outdir.strpath))
+        _, versions = TTDExtractor.serialize_delta_stream_to_csv(
+            delta_stream(), outdir.join("delta.csv"), pipeline=options)
+        assert versions == {"adv0": 299, "adv1": 299}
+
+    for table in ("rows.csv", "tags.csv", "delta.csv"):
+        assert tmpdir.join("piped", table).read() == tmpdir.join("plain", table).read()
+
+
+def test_encode_delta_items_passes_markers_and_empty_rows():
+    marker = AdvertiserDone("adv0")
+    batch = [({"A": [1]}, {"adv0": 1}), (None, {"adv1": 2}), (marker, {"adv0": 1})]
+    assert encode_delta_items(batch) == [
+        ({"A": "[1]"}, {"adv0": 1}), (None, {"adv1": 2}), (marker, {"adv0": 1})]
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from ttdex.extractor import main, validate_config
+from ttdex.planner import pages
+from mockapi import MockTTDApi
+
+
+def run(api, datadir, state=None, **extra):
+    datadir.join("in/state.json").write(json.dumps(state or {}))
+    params = dict({
+        "login": "login",
+        "#password": "password",
+        "base_url": api.base_url,
+        "rate_limit": {"requests_per_minute": 60000, "burst": 100},
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0", "adv1-camp1"]},
+            "adgroup_templates": {"campaign_ids": ["adv0-camp0"]},
+            "sitelists_summary": {"iterations": [{"AdvertiserId": "adv0"}]},
+            "sitelist_lines": {"iterations": [{"AdvertiserId": "adv0"}]},
+            "all_advertisers": {"partner_id": "partner"},
+            "all_campaigns_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+        },
+        "custom_post_paginated_queries": [{
+            "endpoint": "campaign/query/advertiser",
+            # not the same query as the one of all_campaigns_all_advertisers
+            "payload": {"AdvertiserId": "adv2", "SearchTerms": ["camp"]},
+            "filename": "adv2_campaigns.csv"}]
+    }, **extra)
+    main(datadir.strpath, validate_config(params))
+    return json.loads(datadir.join("out/state.json").read())
+
+
+def requests_sent(api):
+    return api.requests_total - api.requests[("POST", "authentication")]
+
+
+@pytest.mark.parametrize("pagination, campaign_pages", [({}, 2), ({"page_size": 1000}, 1)])
+def test_dry_run_predicts_the_requests_of_the_run(datadir, tmpdir, pagination, campaign_pages):
+    with MockTTDApi(advertisers=4, campaigns_per_advertiser=150) as api:
+        state = run(api, datadir, state={"delta_campaigns": {"adv3": 150}}, dry_run=True,
+                    pagination=pagination)
+    plan = json.loads(datadir.join("out/files/plan.json").read())
+    # nothing extracted, the state is kept
+    assert datadir.join("out/tables").listdir() == []
+    assert state["delta_campaigns"] == {"adv3": 150}
+
+    sections = {section["section"]: section for section in plan["sections"]}
+    assert list(sections) == [
+        "campaign_templates", "adgroup_templates", "sitelists_summary", "sitelist_lines",
+        "all_advertisers", "all_campaigns_all_advertisers",
+        "custom_query adv2_campaigns.csv", "delta_campaigns"]
+    assert sections["all_campaigns_all_advertisers"]["advertisers"] == 4
+    assert sections["all_campaigns_all_advertisers"]["items"] == 4 * 150
+    assert sections["all_campaigns_all_advertisers"]["endpoints"] == {
+        "POST advertiser/query/partner": 1, "POST campaign/query/advertiser": 4 * campaign_pages}
+
+    rundir = tmpdir.mkdir("run")
+    for folder in ("in/tables", "out/tables", "out/files"):
+        rundir.join(folder).ensure(dir=True)
+    with MockTTDApi(advertisers=4, campaigns_per_advertiser=150, delta_page_size=100) as api:
+        run(api, rundir, state={"delta_campaigns": {"adv3": 150}}, pagination=pagination)
+        assert plan["requests"] == requests_sent(api)
+
+
+def test_dry_run_extrapolates_from_a_sample_of_advertisers(datadir):
+    with MockTTDApi(advertisers=10, campaigns_per_advertiser=250) as api:
+        run(api, datadir, dry_run={"sample_advertisers": 2},
+            extract_predefined={"all_campaigns_all_advertisers": {"partner_id": "partner"}},
+            custom_post_paginated_queries=[])
+        # the listing, its count and the counts of the sample
+        assert requests_sent(api) == 1 + 2
+    section, = json.loads(datadir.join("out/files/plan.json").read())["sections"]
+    assert section["requests"] == 1 + 10 * 3
+    assert section["items"] == 10 * 250
+    assert section["notes"]
+
+
+def test_dry_run_predicts_the_time_from_the_rate_limit(datadir):
+    with MockTTDApi(advertisers=30) as api:
+        run(api, datadir,
+            dry_run={"max_minutes": 0.25},
+            rate_limit={"requests_per_minute": 60000, "burst": 1, "endpoints": {"delta/": 60}},
+            extract_predefined={"delta_campaigns": {"partner_id": "partner"}},
+            custom_post_paginated_queries=[])
+    plan = json.loads(datadir.join("out/files/plan.json").read())
+    # a delta request a second after the first one
+    assert plan["requests"] == 1 + 30
+    assert plan["estimated_seconds"] == pytest.approx(29, abs=1)
+    assert plan["exceeds_max_minutes"]
+
+
+def test_pages():
+    assert pages(0, 100) == 1
+    assert pages(100, 100) == 1
+    assert pages(101, 100) == 2
@@ -0,0 +1,62 @@
+from ttdex.polling import PollScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_status(finish_times, clock):
+    """Job `ref` is InProgress until clock reaches finish_times[ref]"""
+    polls = []
+
+    def fetch_status(ref):
+        polls.append((clock.now, ref))
+        if clock.now >= finish_times[ref]:
+            return {"ReferenceId": ref, "Status": "Completed"}
+        return {"ReferenceId": ref, "Status": "InProgress"}
+    return fetch_status, polls
+
+
+def test_jobs_are_polled_concurrently_and_yielded_when_finished():
+    clock = FakeClock()
+    finish_times = {"slow": 100, "fast": 5, "medium": 30}
+    fetch_status, _ = make_status(finish_times, clock)
+    scheduler = PollScheduler(fetch_status, max_delay=10, clock=clock, sleep=clock.sleep)
+
+    finished = []
+    for ref, status in scheduler.run(["slow", "fast", "medium"]):
+        assert status["Status"] == "Completed"
+        finished.append((ref, clock.now))
+
+    assert [ref for ref, _ in finished] == ["fast", "medium", "slow"]
+    # wall time is close to the slowest job, not the sum
+    assert finished[-1][1] < 100 + 10
+
+
+def test_delay_is_capped():
+    clock = FakeClock()
+    fetch_status, polls = make_status({"ref": 1000}, clock)
+    scheduler = PollScheduler(fetch_status, max_delay=5, timeout=2000,
+                              clock=clock, sleep=clock.sleep)
+    list(scheduler.run(["ref"]))
+    times = [t for t, _ in polls]
+    assert max(b - a for a, b in zip(times, times[1:])) <= 5
+
+
+def test_unfinished_jobs_time_out():
+    clock = FakeClock()
+    fetch_status, _ = make_status({"never": float("inf"), "done": 2}, clock)
+    scheduler = PollScheduler(fetch_status, max_delay=5, timeout=60,
+                              clock=clock, sleep=clock.sleep)
+    result = dict(scheduler.run(["never", "done", "done"]))
+    assert result["done"]["Status"] == "Completed"
+    assert result["never"]["Status"] == "TimedOut"
+    assert result["never"]["ReferenceId"] == "never"
+    assert clock.now <= 60
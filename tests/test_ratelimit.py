@@ -0,0 +1,112 @@
+from datetime import datetime, timezone
+import pytest
+from ttdex.ratelimit import TokenBucket, RateLimiter, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_bucket_paces_requests_after_burst(clock):
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.now == 0
+    for _ in range(4):
+        bucket.acquire()
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_bucket_pause_blocks_and_empties(clock):
+    bucket = TokenBucket(rate=1, capacity=5, clock=clock, sleep=clock.sleep)
+    bucket.pause(10)
+    bucket.acquire()
+    # paused for 10s and then waits for the first token
+    assert clock.now == pytest.approx(11)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("30", 30.0),
+    ("Wed, 21 Oct 2015 07:28:30 GMT", 30.0),
+    ("garbage", None),
+])
+def test_parse_retry_after(header, expected):
+    now = datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)
+    assert parse_retry_after(header, now=now) == expected
+
+
+def test_backoff_honours_retry_after_and_budget(clock):
+    limiter = RateLimiter(
+        requests_per_minute=60,
+        retry_budget=2,
+        clock=clock,
+        sleep=clock.sleep,
+        random_=lambda: 0.0)
+    assert limiter.backoff("campaign/foo", attempt=0, retry_after=42) == 42
+    assert limiter.backoff("campaign/foo", attempt=1) == 2.0
+    # budget exhausted
+    assert limiter.backoff("campaign/foo", attempt=0) is None
+
+
+def test_backoff_is_capped_and_gives_up(clock):
+    limiter = RateLimiter(
+        max_retries=20,
+        backoff_cap=65,
+        clock=clock,
+        sleep=clock.sleep,
+        random_=lambda: 1.0)
+    assert limiter.backoff("foo", attempt=15) == 65
+    assert limiter.backoff("foo", attempt=20) is None
+
+
+def test_endpoint_buckets_only_pace_their_endpoints(clock):
+    limiter = RateLimiter(
+        requests_per_minute=6000,
+        burst=1,
+        endpoints={"/delta/": 60},
+        clock=clock,
+        sleep=clock.sleep)
+    for _ in range(10):
+        limiter.acquire("campaign/query/advertiser")
+    assert clock.now == pytest.approx(9 / 100)
+    start = clock.now
+    limiter.acquire("delta/campaign/query/advertiser")
+    limiter.acquire("delta/campaign/query/advertiser")
+    # the global bucket adds a hundredth of a second at most
+    assert clock.now - start == pytest.approx(1.0, abs=0.02)
+
+
+def test_rate_limiter_min_seconds():
+    limiter = RateLimiter(requests_per_minute=120, burst=10, endpoints={"delta/": 30})
+    assert limiter.min_seconds({}) == 0
+    assert limiter.min_seconds({"campaign/query/advertiser": 5}) == 0
+    assert limiter.min_seconds({"campaign/query/advertiser": 130}) == 60
+    # the delta endpoints have a slower bucket of their own
+    assert limiter.min_seconds({"delta/campaign/query/advertiser": 40,
+                                "campaign/query/advertiser": 10}) == 60
+
+
+def test_rate_limiter_doesnt_pace_by_default(clock):
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep, random_=lambda: 0.0)
+    for _ in range(1000):
+        limiter.acquire("campaign/query/advertiser")
+    assert clock.now == 0
+    assert limiter.min_seconds({"campaign/query/advertiser": 1000}) == 0
+    # the throttled requests still back off
+    assert limiter.backoff("campaign/query/advertiser", attempt=0, retry_after=5) == 5
+    limiter.acquire("campaign/query/advertiser")
+    assert clock.now == pytest.approx(5)
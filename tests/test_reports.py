@@ -0,0 +1,130 @@
+import gzip
+import io
+import json
+import pytest
+import requests
+from ttdapi.exceptions import TTDApiError
+from ttdex.extractor import main, validate_config
+from ttdex.reports import GunzipWriter, IncompleteDownload, ReportDownloader
+from mockapi import MockTTDApi
+
+
+def gunzipped(chunks, chunk_size=1024):
+    out = io.BytesIO()
+    writer = GunzipWriter(out, chunk_size)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return out.getvalue(), writer.lines
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_gunzip_writer_streams_members_in_small_chunks():
+    content = b'a,b\n' + b'1,2\n' * 100000
+    data = gzip.compress(content[:1000]) + gzip.compress(content[1000:])
+    assert gunzipped(split(data, 7)) == (content, 100001)
+
+
+def test_gunzip_writer_passes_plain_data_through():
+    assert gunzipped([b'a', b',b\n1,2\n']) == (b'a,b\n1,2\n', 2)
+
+
+def test_gunzip_writer_detects_truncated_streams():
+    data = gzip.compress(b'1,2\n' * 1000)
+    with pytest.raises(IncompleteDownload):
+        gunzipped([data[:len(data) // 2]])
+
+
+def test_downloader_resumes_interrupted_downloads(tmpdir):
+    with MockTTDApi(report_executions=1, report_rows=5000,
+                    interrupted_report_downloads=2) as api:
+        url = api.base_url + 'reports/1.csv.gz'
+        outpath = tmpdir.join("report.csv")
+        with requests.Session() as session:
+            lines = ReportDownloader(session, tmpdir.join("parts"), chunk_size=1024).download(
+                url, outpath, "report_1")
+        assert outpath.read_binary() == api.report_csv(1)
+        assert lines == 5001
+        size = len(api.report_file(1))
+        # the whole file, then from the half, then from 3/4
+        assert api.report_ranges == [0, size // 2, size // 2 + (size - size // 2) // 2]
+    assert not tmpdir.join("parts").listdir()
+
+
+def test_downloader_continues_a_part_file_of_a_previous_run(tmpdir):
+    with MockTTDApi(report_executions=1, report_rows=5000) as api:
+        content = api.report_file(1)
+        tmpdir.mkdir("parts").join("report_1.part").write_binary(content[:1000])
+        outpath = tmpdir.join("report.csv")
+        with requests.Session() as session:
+            ReportDownloader(session, tmpdir.join("parts")).download(
+                api.base_url + 'reports/1.csv.gz', outpath, "report_1")
+        assert api.report_ranges == [1000]
+        assert outpath.read_binary() == api.report_csv(1)
+
+        # a complete part file isn't downloaded again
+        tmpdir.join("parts/report_1.part").write_binary(content)
+        with requests.Session() as session:
+            ReportDownloader(session, tmpdir.join("parts")).download(
+                api.base_url + 'reports/1.csv.gz', outpath, "report_1")
+        assert outpath.read_binary() == api.report_csv(1)
+
+
+def test_main_downloads_each_report_execution_once(datadir):
+    with MockTTDApi(report_executions=3, pending_report_executions=[3],
+                    interrupted_report_downloads=1) as api:
+        params = {
+            "login": "login",
+            "#password": "password",
+            "base_url": api.base_url,
+            "max_workers": 2,
+            "extract_predefined": {
+                "report_executions": {"payload": {"AdvertiserIds": ["adv0"]}},
+            },
+        }
+        main(datadir.strpath, validate_config(params))
+        out = datadir.join("out/tables")
+        assert out.join("report_1.csv").read_binary() == api.report_csv(1)
+        assert out.join("report_2.csv").read_binary() == api.report_csv(2)
+        assert not out.join("report_3.csv").exists()
+        state = json.loads(datadir.join("out/state.json").read())
+        assert state["report_executions"] == [1, 2]
+        metrics = json.loads(datadir.join("metrics.json").read())
+        assert metrics["tables"][out.join("report_1.csv").strpath]["rows"] == 100
+        assert json.loads(out.join("report_1.csv.manifest").read()) == {
+            "incremental": False, "primary_key": []}
+        # the file hosts don't get the auth token
+        assert api.report_auth_headers and not any(api.report_auth_headers)
+
+        # the next run only downloads the new execution
+        datadir.join("in/state.json").write(json.dumps(state))
+        api.pending_report_executions = set()
+        api.report_ranges = []
+        main(datadir.strpath, validate_config(params))
+        assert api.report_ranges == [0]
+        assert out.join("report_3.csv").read_binary() == api.report_csv(3)
+        state = json.loads(datadir.join("out/state.json").read())
+        assert state["report_executions"] == [1, 2, 3]
+
+
+def test_downloaded_report_executions_are_saved_when_the_run_fails_later(datadir):
+    with MockTTDApi(report_executions=2) as api:
+        params = {
+            "login": "login",
+            "#password": "password",
+            "base_url": api.base_url,
+            "extract_predefined": {
+                "report_executions": {"payload": {"AdvertiserIds": ["adv0"]}},
+            },
+            # runs after the reports and fails
+            "custom_post_paginated_queries": [
+                {"endpoint": "nothing/query/here", "payload": {}, "filename": "nothing.csv"}],
+        }
+        datadir.join("in/state.json").write(json.dumps({"delta_campaigns": {"adv0": 5}}))
+        with pytest.raises(TTDApiError):
+            main(datadir.strpath, validate_config(params))
+    state = json.loads(datadir.join("out/state.json").read())
+    assert state == {"delta_campaigns": {"adv0": 5}, "report_executions": [1, 2]}
@@ -0,0 +1,91 @@
+import csv
+import json
+import pytest
+import voluptuous as vp
+from ttdex.extractor import main, validate_config
+from ttdex.sharding import Shard, shard_of
+from mockapi import MockTTDApi
+from helpers import read_csv
+
+
+def test_shard_of_is_stable():
+    # the same in every process, unlike hash()
+    assert [shard_of("adv{}".format(i), 3) for i in range(12)] == [1, 2, 1, 0, 1, 0, 1, 0, 1, 1, 1, 2]
+
+
+def test_every_advertiser_is_in_exactly_one_shard():
+    shards = [Shard(i, 4) for i in range(4)]
+    for i in range(1000):
+        assert sum(shard.owns("adv{}".format(i)) for shard in shards) == 1
+    counts = [sum(shard.owns("adv{}".format(i)) for i in range(1000)) for shard in shards]
+    assert min(counts) > 200
+
+
+def test_shard_options_are_validated():
+    config = {"login": "login", "#password": "password", "base_url": "https://api/v3"}
+    with pytest.raises(vp.Invalid):
+        validate_config(dict(config, shard_index=2, shard_count=2))
+    with pytest.raises(vp.Invalid):
+        validate_config(dict(config, shard_index=1))
+    assert validate_config(dict(config, shard_index=1, shard_count=2))
+
+
+def run_shard(api, datadir, index, count, state=None, **extra):
+    for folder in ("in/tables", "out/tables", "out/files"):
+        datadir.join(folder).ensure(dir=True)
+    datadir.join("in/state.json").write(json.dumps(state or {}))
+    params = dict({
+        "login": "login",
+        "#password": "password",
+        "base_url": api.base_url,
+        "shard_index": index,
+        "shard_count": count,
+        "extract_predefined": {
+            "campaign_templates": {"campaign_ids": ["adv0-camp0"]},
+            "all_campaigns_all_advertisers": {"partner_id": "partner"},
+            "delta_campaigns": {"partner_id": "partner"},
+        },
+    }, **extra)
+    main(datadir.strpath, validate_config(params))
+    return json.loads(datadir.join("out/state.json").read())
+
+
+def test_shards_split_the_advertisers(tmpdir):
+    with MockTTDApi(advertisers=12) as api:
+        states = [run_shard(api, tmpdir.join(str(i)), i, 3) for i in range(3)]
+
+        campaigns, deltas = [], []
+        for i in range(3):
+            out = tmpdir.join(str(i), "out/tables")
+            name = "shard-{}-of-3".format(i)
+            campaigns.extend(read_csv(out.join("all_campaigns_all_advertisers_{}.csv".format(name))))
+            deltas.extend(read_csv(out.join("delta_campaigns_{}.csv".format(name))))
+            manifest = json.loads(out.join("delta_campaigns_{}.csv.manifest".format(name)).read())
+            assert manifest["incremental"] is True
+            # the sections not split by advertisers run only in the first shard
+            assert out.join("campaign_templates.csv").exists() == (i == 0)
+        assert len(campaigns) == len({row["CampaignId"] for row in campaigns}) == 12 * 5
+        assert len(deltas) == 12 * 5
+
+        # the states of the shards merge without conflicts
+        merged = {}
+        for i, state in enumerate(states):
+            versions = state["delta_campaigns_shard-{}-of-3".format(i)]
+            assert all(shard_of(advertiser, 3) == i for advertiser in versions)
+            merged.update((key, value) for key, value in state.items() if key != "auth")
+        assert sum(len(versions) for versions in merged.values()) == 12
+
+        # resharding continues from the merged versions
+        datadir = tmpdir.join("resharded")
+        state = run_shard(api, datadir, 0, 2, state=merged)
+        assert not datadir.join("out/tables/delta_campaigns_shard-0-of-2.csv").exists()
+        assert all(version == 5 for version in state["delta_campaigns_shard-0-of-2"].values())
+
+
+def test_sharded_slices_are_named_after_the_shard(tmpdir):
+    with MockTTDApi(advertisers=6) as api:
+        run_shard(api, tmpdir, 1, 2, sliced_output={"slice_rows": 5})
+    table = tmpdir.join("out/tables/all_campaigns_all_advertisers_shard-1-of-2.csv")
+    slices = table.listdir("*.csv.gz")
+    assert slices
+    assert all(part.basename.startswith("shard-1-of-2-part-") for part in slices)
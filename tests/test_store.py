@@ -0,0 +1,38 @@
+from ttdex.checkpoint import AdvertiserDone
+from ttdex.store import SnapshotStore
+
+
+def test_snapshot_store_upserts_by_primary_key(tmpdir):
+    path = tmpdir.join("snapshot.sqlite")
+    delta = [
+        ({"CampaignId": "c1", "AdvertiserId": "a", "Name": "old"}, {"a": 1}),
+        (None, {"b": 1}),
+        ({"CampaignId": "c2", "AdvertiserId": "a", "Name": "other"}, {"a": 2}),
+        ({"CampaignId": "c1", "AdvertiserId": "a", "Name": "new"}, {"a": 3}),
+        (AdvertiserDone("a"), {"a": 3}),
+    ]
+    with SnapshotStore(path, ["AdvertiserId", "CampaignId"], batch_size=2) as snapshot:
+        assert list(snapshot.apply(iter(delta))) == delta
+        assert len(snapshot) == 2
+
+    # the store is kept between runs
+    with SnapshotStore(path, ["AdvertiserId", "CampaignId"]) as snapshot:
+        list(snapshot.apply([({"CampaignId": "c3", "AdvertiserId": "a"}, {"a": 4})]))
+        assert [(row["CampaignId"], row.get("Name")) for row in snapshot.rows()] == [
+            ("c1", "new"), ("c2", "other"), ("c3", None)]
+        snapshot.clear()
+        assert len(snapshot) == 0
+
+
+def test_snapshot_store_keeps_its_id(tmpdir):
+    path = tmpdir.join("snapshot.sqlite")
+    assert SnapshotStore.read_store_id(path) is None
+    with SnapshotStore(path, ["CampaignId"]) as snapshot:
+        store_id = snapshot.store_id
+        snapshot.clear()
+    with SnapshotStore(path, ["CampaignId"]) as snapshot:
+        assert snapshot.store_id == store_id
+    assert SnapshotStore.read_store_id(path) == store_id
+    path.remove()
+    with SnapshotStore(path, ["CampaignId"]) as snapshot:
+        assert snapshot.store_id != store_id
@@ -0,0 +1,109 @@
+import csv
+import gzip
+import json
+import os
+import pytest
+from ttdex.writers import CsvTableWriter, NdjsonFileWriter, SlicedCsvTableWriter
+from helpers import read_csv
+
+
+def test_writer_handles_growing_schema(tmpdir):
+    outpath = tmpdir.join("out.csv").strpath
+    rows = [
+        {"a": 1, "b": {"nested": True}},
+        {"a": 2},
+        {"b": [1, 2], "c": "new", "a": 3},
+        {"d": None},
+    ]
+    with CsvTableWriter(outpath) as writer:
+        for row in rows:
+            writer.writerow(row)
+
+    assert writer.columns == ["a", "b", "c", "d"]
+    written = read_csv(outpath)
+    assert list(written[0].keys()) == ["a", "b", "c", "d"]
+    assert json.loads(written[0].pop("b")) == {"nested": True}
+    assert written[0] == {"a": "1", "c": "", "d": ""}
+    assert written[1] == {"a": "2", "b": "", "c": "", "d": ""}
+    assert json.loads(written[2]["b"]) == [1, 2]
+    assert written[2]["c"] == "new"
+    assert written[3] == {"a": "", "b": "", "c": "", "d": ""}
+
+
+def test_writer_doesnt_rewrite_stable_schema(tmpdir):
+    outpath = tmpdir.join("out.csv").strpath
+    with CsvTableWriter(outpath) as writer:
+        writer.writerow({"a": 1, "b": 2})
+        writer.writerow({"b": 3, "a": 4})
+    assert not writer.schema_changed
+    assert read_csv(outpath) == [{"a": "1", "b": "2"}, {"a": "4", "b": "3"}]
+
+
+def test_writer_without_rows_writes_nothing(tmpdir):
+    outpath = tmpdir.join("out.csv")
+    writer = CsvTableWriter(outpath.strpath)
+    assert writer.close() is None
+    assert not outpath.exists()
+
+
+def read_sliced(outpath):
+    with open(outpath + ".manifest") as mani:
+        columns = json.load(mani)["columns"]
+    rows = []
+    for part in sorted(os.listdir(outpath)):
+        with gzip.open(os.path.join(outpath, part), "rt", newline="") as fin:
+            rows.extend(dict(zip(columns, values)) for values in csv.reader(fin))
+    return columns, rows
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_sliced_writer_rolls_over_and_pads_slices(tmpdir, workers):
+    outpath = tmpdir.join("out.csv").strpath
+    with SlicedCsvTableWriter(outpath, batch_size=4, slice_rows=10, workers=workers) as writer:
+        for i in range(95):
+            row = {"id": i, "nested": {"i": i}}
+            if i >= 50:
+                row["late"] = "x"
+            writer.writerow(row)
+
+    assert writer.rows_written == 95
+    assert all(path.endswith(".csv.gz") for path in writer.slices)
+    assert len(writer.slices) >= 95 // 12
+    columns, rows = read_sliced(outpath)
+    assert columns == ["id", "nested", "late"]
+    assert sorted(int(row["id"]) for row in rows) == list(range(95))
+    assert all(len(row) == 3 for row in rows)
+    assert all(row["late"] == ("x" if int(row["id"]) >= 50 else "") for row in rows)
+    assert json.loads(rows[0]["nested"]) == {"i": int(rows[0]["id"])}
+
+
+def test_sliced_writer_replaces_previous_output(tmpdir):
+    outpath = tmpdir.join("out.csv")
+    outpath.write("a plain csv from a previous run")
+    with SlicedCsvTableWriter(outpath.strpath) as writer:
+        writer.writerow({"a": 1})
+    assert read_sliced(outpath.strpath) == (["a"], [{"a": "1"}])
+
+
+def test_ndjson_writer_writes_one_object_per_line(tmpdir):
+    outpath = tmpdir.join("out.ndjson")
+    objects = [{"a": 1, "nested": {"text": "line\nbreak"}}, {"b": [1, 2]}]
+    with NdjsonFileWriter(outpath.strpath, tags=["out"], batch_size=1) as writer:
+        for obj in objects:
+            writer.write(obj)
+    assert [json.loads(line) for line in outpath.readlines()] == objects
+    assert json.loads(tmpdir.join("out.ndjson.manifest").read()) == {"tags": ["out"]}
+
+    empty = tmpdir.join("empty.ndjson")
+    assert NdjsonFileWriter(empty.strpath).close() is None
+    assert not empty.exists()
+
+
+def test_ndjson_writer_leaves_nothing_when_failing(tmpdir):
+    outpath = tmpdir.join("out.ndjson")
+    with pytest.raises(ValueError):
+        with NdjsonFileWriter(outpath.strpath, batch_size=1) as writer:
+            writer.write({"a": 1})
+            raise ValueError("the extraction failed")
+    assert not outpath.exists()
+    assert not tmpdir.join("out.ndjson.manifest").exists()
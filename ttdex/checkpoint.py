@@ -0,0 +1,274 @@
+"""Crash-safe progress of long multi-advertiser sections
+
+The checkpoint records, for each section, which advertisers are finished,
+their tracking versions and how far the output file got (its byte size and
+columns at that moment). A restarted run skips the finished advertisers,
+truncates the output to the last checkpoint, drops the rows of advertisers
+which were half way through (with concurrent workers their rows are
+interleaved with the finished ones) and appends to it, so nothing is
+duplicated.
+
+The progress is a journal of json lines, each finished advertiser appends
+one, so checkpointing stays cheap for partners with many advertisers. A line
+cut short by a crash is ignored when the journal is read back.
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# the rows of unfinished advertisers are told apart by this column
+RESUME_COLUMN = 'AdvertiserId'
+
+
+class AdvertiserDone:
+    """Marker in a stream of rows, all rows of `advertiser_id` are before it"""
+    __slots__ = ('advertiser_id',)
+
+    def __init__(self, advertiser_id):
+        self.advertiser_id = advertiser_id
+
+    def __repr__(self):
+        return 'AdvertiserDone({!r})'.format(self.advertiser_id)
+
+
+def atomic_write_json(data, path):
+    """Write the json into a temporary file next to `path` and rename it, so
+    that `path` is never half written"""
+    path = Path(path)
+    fd, tmppath = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(data, outf)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.replace(tmppath, str(path))
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def fingerprint(config) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SectionCheckpoint:
+    """Progress of one section writing into `outpath`
+
+    Attributes:
+        resume_from: what CsvTableWriter needs to continue the partial
+            `outpath`, None to start afresh
+    """
+    def __init__(self, checkpoint, name, data, outpath):
+        self._checkpoint = checkpoint
+        self.name = name
+        self._data = data
+        self._warned_unresumable = False
+        self.resume_from = self._prepare_output(outpath)
+
+    @property
+    def done(self):
+        return set(self._data['done'])
+
+    @property
+    def tracking_versions(self):
+        return dict(self._data['tracking_versions'])
+
+    def _reset(self):
+        self._data.update(done=[], tracking_versions={}, output=None, completed=False)
+        self._checkpoint.append(self.name, fingerprint=self._data['fingerprint'])
+
+    def _prepare_output(self, outpath) -> Optional[dict]:
+        # If the partial output of the previous run is gone (eg. a new
+        # container), the finished advertisers have to be done again
+        with self._checkpoint.lock:
+            output = self._data.get('output')
+            try:
+                size = os.path.getsize(str(outpath))
+            except OSError:
+                size = None
+
+            if output is None:
+                # nothing was checkpointed, but there may be rows of
+                # advertisers which didn't finish
+                if size is not None:
+                    os.remove(str(outpath))
+                return None
+            if output['path'] != str(outpath) or size is None or size < output['offset']:
+                logger.warning("Can't resume %s, the partial output is gone. "
+                               "Starting the section from scratch", outpath)
+                self._reset()
+                if size is not None:
+                    os.remove(str(outpath))
+                return None
+            if RESUME_COLUMN not in output['columns']:
+                logger.warning("Can't resume %s, the rows have no %s. "
+                               "Starting the section from scratch", outpath, RESUME_COLUMN)
+                self._reset()
+                os.remove(str(outpath))
+                return None
+            self._data['output'] = output = self._drop_unfinished(output)
+            self._checkpoint.append(self.name, output=output)
+            return output
+
+    def _drop_unfinished(self, output) -> dict:
+        """Cut the output at the checkpoint and keep only the rows of the
+        finished advertisers"""
+        path = output['path']
+        done = self.done
+        position = output['columns'].index(RESUME_COLUMN)
+        with open(path, 'r+') as outf:
+            outf.truncate(output['offset'])
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.csv.tmp')
+        rows = 0
+        try:
+            with open(path, newline='') as inf,\
+                 os.fdopen(fd, 'w', newline='') as outf:
+                reader = csv.reader(inf)
+                writer = csv.writer(outf)
+                writer.writerow(next(reader))
+                for values in reader:
+                    if position < len(values) and values[position] in done:
+                        writer.writerow(values)
+                        rows += 1
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        if rows != output['rows']:
+            logger.info("Dropped %s rows of unfinished advertisers from %s",
+                        output['rows'] - rows, path)
+        return dict(output, offset=os.path.getsize(path), rows=rows)
+
+    def advertiser_done(self, advertiser_id, tracking_versions, writer=None):
+        """Record that everything of `advertiser_id` is written
+
+        Args:
+            tracking_versions: {advertiser_id: version} of this advertiser
+            writer: CsvTableWriter of the section output, it's flushed to
+                disk so that the recorded offset is safe
+        """
+        with self._checkpoint.lock:
+            self._data['done'].append(advertiser_id)
+            self._data['tracking_versions'].update(tracking_versions)
+            record = {'done': advertiser_id, 'tracking_versions': tracking_versions}
+            if writer is not None:
+                self._data['output'] = record['output'] = writer.checkpoint()
+                self._warn_if_unresumable()
+            self._checkpoint.append(self.name, **record)
+
+    def _warn_if_unresumable(self):
+        output = self._data['output']
+        if (output is not None and RESUME_COLUMN not in output['columns']
+                and not self._warned_unresumable):
+            logger.warning("The rows of %s have no %s, if this run fails the next "
+                           "one starts the section from scratch", self.name, RESUME_COLUMN)
+            self._warned_unresumable = True
+
+    def complete(self, writer=None):
+        with self._checkpoint.lock:
+            self._data['completed'] = True
+            record = {'completed': True}
+            if writer is not None:
+                self._data['output'] = record['output'] = writer.checkpoint()
+            self._checkpoint.append(self.name, **record)
+
+
+class Checkpoint:
+    """The checkpoint journal of a run
+
+    Sections are identified by name and a fingerprint of their config, a
+    section whose config changed since the checkpoint starts from scratch
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self._journal = None
+        self._data = {'sections': {}}
+        try:
+            with open(str(self.path)) as inf:
+                for line in inf:
+                    self._replay(line)
+            logger.info("Resuming from checkpoint %s", self.path)
+        except FileNotFoundError:
+            pass
+
+    def _replay(self, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logger.warning("Ignoring a partial line of checkpoint %s", self.path)
+            return
+        name = record.pop('section')
+        if 'fingerprint' in record:
+            self._data['sections'][name] = self._new_section(record['fingerprint'])
+            return
+        data = self._data['sections'].get(name)
+        if data is None:
+            return
+        if 'done' in record:
+            data['done'].append(record['done'])
+            data['tracking_versions'].update(record['tracking_versions'])
+        if 'output' in record:
+            data['output'] = record['output']
+        if record.get('completed'):
+            data['completed'] = True
+
+    @staticmethod
+    def _new_section(config_fingerprint) -> dict:
+        return {
+            'fingerprint': config_fingerprint,
+            'done': [],
+            'tracking_versions': {},
+            'output': None,
+            'completed': False
+        }
+
+    def section(self, name, config, outpath) -> SectionCheckpoint:
+        with self.lock:
+            config_fingerprint = fingerprint(config)
+            data = self._data['sections'].get(name)
+            if data is None or data.get('fingerprint') != config_fingerprint:
+                data = self._new_section(config_fingerprint)
+                self._data['sections'][name] = data
+                self.append(name, fingerprint=config_fingerprint)
+            return SectionCheckpoint(self, name, data, outpath)
+
+    def append(self, name, **record):
+        """Append a record of section `name` to the journal"""
+        with self.lock:
+            if self._journal is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._journal = open(str(self.path), 'a+')
+                # end a line cut short by a crash, it's skipped when read
+                if self._journal.tell() > 0:
+                    self._journal.seek(self._journal.tell() - 1)
+                    if self._journal.read(1) != '\n':
+                        self._journal.write('\n')
+            self._journal.write(json.dumps(dict(record, section=name)) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def close(self):
+        with self.lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def clear(self):
+        """The run finished, the next one starts from scratch"""
+        with self.lock:
+            self.close()
+            self._data = {'sections': {}}
+            try:
+                os.remove(str(self.path))
+            except FileNotFoundError:
+                pass
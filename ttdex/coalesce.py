@@ -0,0 +1,133 @@
+"""Sending identical API calls of a run only once
+
+Sections and input rows often ask for the same thing, eg. a campaign id listed
+twice in `campaign_templates` or the delta of an advertiser needed both by
+`delta_campaigns` and by the changed campaign templates. Identical idempotent
+requests which are in flight at the same time are sent once. The responses of
+GETs and of the small listings several sections start from are also kept in a
+LRU for the rest of the run, the other queries (deltas, the pages of big
+listings) aren't, they would keep in memory what the sections stream.
+
+Only GETs and POST queries are idempotent, anything else (logging in,
+cloning, updates) and the clone status (it's polled to see it change) is
+always sent.
+"""
+import copy
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+import requests
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+VOLATILE_PATHS = ('campaign/clone/status',)
+# the queries whose responses are kept, not just coalesced
+KEPT_QUERIES = ('advertiser/query/partner', 'sitelist/query/advertiser')
+
+
+def request_key(method: str, path: str, url: str, kwargs: dict) -> Optional[Tuple]:
+    """The identity of an idempotent request, None if it must always be sent
+
+    Args:
+        path: the endpoint, relative to the base url
+        kwargs: the keyword arguments of `Session.request`
+    """
+    method = method.upper()
+    path = path.strip('/')
+    if method == 'GET':
+        if path.startswith(VOLATILE_PATHS):
+            return None
+    elif method != 'POST' or '/query/' not in '/{}/'.format(path):
+        return None
+    if kwargs.get('stream') or kwargs.get('data') or kwargs.get('files'):
+        return None
+    return (method, url,
+            json.dumps(kwargs.get('json'), sort_keys=True),
+            json.dumps(kwargs.get('params'), sort_keys=True))
+
+
+def is_kept(method: str, path: str) -> bool:
+    """Whether the response of an idempotent request is kept for the rest of
+    the run, the others are only coalesced while in flight"""
+    return method.upper() == 'GET' or path.strip('/') in KEPT_QUERIES
+
+
+class RequestCache:
+    """Coalesces identical in-flight requests and keeps the successful
+    responses in a LRU bounded by the number of entries and their bytes
+
+    The responses are kept as they came (the raw body), each caller gets its
+    own copy of the `requests.Response` and parses it on its own, so nobody
+    can change what the others get.
+    """
+    def __init__(self, max_entries: int=DEFAULT_MAX_ENTRIES, max_bytes: int=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._lru)
+
+    def fetch(
+            self,
+            key,
+            send: Callable[[], requests.Response],
+            keep: bool=True) -> Tuple[requests.Response, bool]:
+        """The response of `send()`, or of an identical request sent before
+
+        Args:
+            keep: keep the response for the identical requests sent after
+                this one finished, otherwise only those in flight share it
+
+        Returns:
+            (response, True if it wasn't sent because of this call)
+        """
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return copy.copy(cached), True
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                in_flight = self._in_flight[key] = Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            response = in_flight.result()
+            with self._lock:
+                self.hits += 1
+            return copy.copy(response), True
+
+        try:
+            response = send()
+        except BaseException as err:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set_exception(err)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if keep and response.ok:
+                self._store(key, response)
+        in_flight.set_result(response)
+        return response, False
+
+    def _store(self, key, response):
+        size = len(response.content)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        self._lru[key] = response
+        self._bytes += size
+        while len(self._lru) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._bytes -= len(evicted.content)
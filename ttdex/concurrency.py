@@ -0,0 +1,134 @@
+"""Helpers for running blocking API calls in a bounded pool of threads"""
+import itertools
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# the messages passed through the queues between threads are `(kind, payload)`
+ITEM = 'item'
+DONE = 'done'
+ERROR = 'error'
+POLL_SECONDS = 0.1
+
+
+def put_until_stopped(target: queue.Queue, message, stop: threading.Event) -> bool:
+    """Put `message` into the bounded queue `target`, unless `stop` is set
+    while it's full (the consumer went away), returns whether it was put"""
+    while not stop.is_set():
+        try:
+            target.put(message, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_until_stopped(source: queue.Queue, stop: threading.Event):
+    """The next message of `source`, or None once `stop` is set"""
+    while not stop.is_set():
+        try:
+            return source.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return None
+
+
+def fan_out(
+        func: Callable[[Any], Iterable],
+        items: Iterable,
+        max_workers: int,
+        buffer_size: int=1000) -> Iterator:
+    """Call the generator function `func(item)` for each item concurrently
+
+    Whatever the generators yield is funneled into a single bounded queue and
+    yielded from here, so that there is still exactly one consumer (ie. one
+    csv writer). Everything one `func(item)` call yields stays in its
+    original order (one item is always processed by one worker), but the
+    outputs of different items are interleaved.
+
+    If the consumer stops iterating or any of the workers raises, the
+    remaining work is cancelled and the exception is reraised here.
+
+    Args:
+        func: a callable returning an iterable, for example
+            `lambda advertiser_id: self.post_paginated(...)`
+        items: the inputs for `func`
+        max_workers: how many `func` calls run at the same time
+        buffer_size: how many results can wait in the queue before the
+            workers are blocked (keeps memory bounded when writing is slow)
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield from func(item)
+        return
+
+    results = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(message):
+        return put_until_stopped(results, message, stop)
+
+    def work(item):
+        if stop.is_set():
+            return
+        try:
+            for result in func(item):
+                if not put((ITEM, result)):
+                    return
+        except Exception as err:
+            put((ERROR, err))
+        else:
+            put((DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(work, item) for item in items]
+        pending = len(futures)
+        while pending:
+            kind, payload = results.get()
+            if kind == ITEM:
+                yield payload
+            elif kind == DONE:
+                pending -= 1
+            else:
+                raise payload
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def prefetch_ordered(
+        func: Callable[[Any], Any],
+        items: Iterable,
+        window: int) -> Iterator:
+    """Yield `func(item)` for each item, in the order of `items`
+
+    Up to `window` calls run ahead of the consumer in a thread pool. Useful
+    when the calls are independent (eg. pages of a paginated endpoint) but
+    the results must keep their order.
+    """
+    if window <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=window)
+    pending = deque()
+    try:
+        for item in itertools.islice(items, window):
+            pending.append(executor.submit(func, item))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
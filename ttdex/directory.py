@@ -0,0 +1,89 @@
+"""The advertisers of a partner, listed once and shared by all the sections"""
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+from ttdex.checkpoint import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+
+def directory_key(payload: dict) -> str:
+    """The same query gives the same key, no matter the order of the
+    availabilities or search terms"""
+    normalized = dict(payload)
+    for key in ('availabilities', 'SearchTerms'):
+        if isinstance(normalized.get(key), list):
+            normalized[key] = sorted(normalized[key])
+    return json.dumps(normalized, sort_keys=True)
+
+
+class AdvertiserDirectory:
+    """Memoized advertiser listings, keyed by the query payload (partner,
+    availabilities, search terms)
+
+    Sections asking for the same listing at the same time wait for the one
+    which is downloading it. With a `cache_path` the listings are also kept
+    on disk for `ttl` seconds, so that the next run doesn't list them again.
+    """
+    def __init__(
+            self,
+            cache_path=None,
+            ttl: Optional[float]=None,
+            clock: Callable[[], float]=time.time):
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._listings = {}
+        self._disk = self._load()
+
+    def _load(self) -> dict:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(str(self.cache_path)) as inf:
+                return json.load(inf)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring the corrupted advertiser cache %s", self.cache_path)
+            return {}
+
+    def _from_disk(self, key) -> Optional[List[dict]]:
+        cached = self._disk.get(key)
+        if cached is None or self.ttl is None:
+            return None
+        if self._clock() - cached['fetched_at'] > self.ttl:
+            return None
+        return cached['advertisers']
+
+    def _save(self, key, advertisers):
+        if self.cache_path is None:
+            return
+        with self._lock:
+            self._disk[key] = {'fetched_at': self._clock(), 'advertisers': advertisers}
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_json(self._disk, self.cache_path)
+
+    def advertisers(self, payload: dict, fetch: Callable[[dict], Iterable[dict]]) -> List[dict]:
+        """The advertisers `fetch(payload)` returns, downloaded at most once"""
+        key = directory_key(payload)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            listing = self._listings.get(key)
+            if listing is not None:
+                return listing
+            listing = self._from_disk(key)
+            if listing is not None:
+                logger.info("Using %s cached advertisers of %s", len(listing), key)
+            else:
+                listing = list(fetch(payload))
+                self._save(key, listing)
+            self._listings[key] = listing
+            return listing
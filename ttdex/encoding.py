@@ -0,0 +1,104 @@
+"""Turning API entities into csv rows
+
+Nested values (dicts/lists) end up as json strings in the csv cells, which is
+where most of the serialization time goes for big templates. They are dumped
+with the standard library by default. A faster json library (`orjson` or
+`ujson`) can be opted into with `set_default_backend`, its output is compact
+(no spaces after the separators) and keeps non-ascii characters unescaped,
+so the cells aren't byte for byte the same as with the standard library.
+"""
+import json
+import logging
+from typing import Callable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+NESTED_TYPES = (dict, list)
+DEFAULT_BACKEND = 'json'
+
+# the backend used by `get_dumps()` without an explicit one
+_default_backend = DEFAULT_BACKEND
+
+
+def _stdlib_dumps():
+    return json.dumps
+
+
+def _orjson_dumps():
+    import orjson
+    _dumps = orjson.dumps
+
+    def dumps(value):
+        return _dumps(value).decode('utf-8')
+    return dumps
+
+
+def _ujson_dumps():
+    import ujson
+    _dumps = ujson.dumps
+
+    def dumps(value):
+        return _dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+    return dumps
+
+
+JSON_BACKENDS = {
+    'orjson': _orjson_dumps,
+    'ujson': _ujson_dumps,
+    'json': _stdlib_dumps,
+}
+
+
+def set_default_backend(backend: str):
+    """Sets the backend `get_dumps()` returns when not given one"""
+    global _default_backend
+    if backend != 'auto' and backend not in JSON_BACKENDS:
+        raise ValueError("Unknown json backend {}".format(backend))
+    _default_backend = backend
+
+
+def default_backend() -> str:
+    return _default_backend
+
+
+def get_dumps(backend: Optional[str]=None) -> Callable[[object], str]:
+    """Returns a `json.dumps` like function
+
+    Args:
+        backend: one of JSON_BACKENDS or 'auto' to take the fastest
+            one which is installed, the default backend if None
+    """
+    if backend is None:
+        backend = _default_backend
+    if backend != 'auto':
+        return JSON_BACKENDS[backend]()
+    for name in ('orjson', 'ujson'):
+        try:
+            dumps = JSON_BACKENDS[name]()
+        except ImportError:
+            continue
+        logger.debug("Using %s to serialize nested values", name)
+        return dumps
+    return _stdlib_dumps()
+
+
+class RowEncoder:
+    """Encodes dict rows into lists of csv values
+
+    Every cell is checked, so a field that's a scalar in one entity and an
+    object in another still ends up as a json string.
+    """
+    def __init__(self, dumps: Optional[Callable[[object], str]]=None):
+        self.dumps = dumps or get_dumps()
+
+    def encode(self, row: dict, columns: Sequence[str]) -> List:
+        values = list(map(row.get, columns))
+        dumps = self.dumps
+        for i, value in enumerate(values):
+            if isinstance(value, NESTED_TYPES):
+                values[i] = dumps(value)
+        return values
+
+    def encode_batch(self, rows: Sequence[dict], columns: Sequence[str]) -> List[List]:
+        encode = self.encode
+        return [encode(row, columns) for row in rows]
@@ -0,0 +1,47 @@
+"""Running the independent config sections concurrently"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_SECTIONS = 4
+
+Section = Tuple[str, Callable]
+
+
+def _run_section(name, section, make_extractor):
+    logger.info("Starting section %s", name)
+    start = time.monotonic()
+    ex = make_extractor()
+    with ex:
+        section(ex)
+    logger.info("Section %s finished in %.1f seconds", name, time.monotonic() - start)
+
+
+def run_sections_concurrently(
+        sections: List[Section],
+        make_extractor: Callable,
+        max_concurrency: int=DEFAULT_MAX_CONCURRENT_SECTIONS):
+    """Run the `sections` at the same time, at most `max_concurrency` at once
+
+    Each section runs in a thread of a pool of `max_concurrency` with the
+    extractor from `make_extractor`. All sections are let to finish, then
+    the first error is reraised.
+
+    Args:
+        sections: [(name, function taking an entered TTDExtractor)]
+        make_extractor: returns the TTDExtractor for a section. It can be
+            the same one for all of them, as long as entering and leaving it
+            doesn't log the others out (which TTDExtractor doesn't)
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(_run_section, name, section, make_extractor)
+                   for name, section in sections]
+
+    for (name, _), future in zip(sections, futures):
+        error = future.exception()
+        if error is not None:
+            logger.error("Section %s failed", name)
+            raise error
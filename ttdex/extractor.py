@@ -1,11 +1,16 @@
 """TTD extractor"""
+import contextlib
 import csv
 import json
+import itertools
 import logging
-from itertools import tee
+import threading
 import time
+from collections import OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+from urllib.parse import urlparse
 
 from typing import Iterable, Tuple, Optional, Callable
 
@@ -13,16 +18,45 @@ import voluptuous as vp
 from ttdapi.client import TTDClient
 from ttdapi.exceptions import TTDApiError
 
+from ttdex.checkpoint import AdvertiserDone, Checkpoint, SectionCheckpoint, atomic_write_json
+from ttdex.coalesce import DEFAULT_MAX_BYTES, DEFAULT_MAX_ENTRIES, RequestCache, is_kept, request_key
+from ttdex.concurrency import fan_out, prefetch_ordered
+from ttdex.directory import AdvertiserDirectory
+from ttdex.encoding import DEFAULT_BACKEND, set_default_backend
+from ttdex.engine import DEFAULT_MAX_CONCURRENT_SECTIONS, run_sections_concurrently
+from ttdex.flatten import Flattener, FlattenSchema
+from ttdex.metrics import Metrics, Profiler, endpoint_key
+from ttdex.planner import DEFAULT_LATENCY, DEFAULT_SAMPLE_ADVERTISERS, Planner, plan_report, save_plan
+from ttdex.pipeline import Pipeline, encode_delta_items, encode_rows, prepare_delta_items, prepare_rows
+from ttdex.polling import PollScheduler
+from ttdex.ratelimit import RateLimiter, parse_retry_after
+from ttdex.reports import REPORT_EXECUTIONS_ENDPOINT, ReportDownloader
+from ttdex.sharding import Shard, merged_shard_states, shard_from_params
+from ttdex.store import SnapshotStore, TemplateStore
+from ttdex.writers import NdjsonFileWriter, open_table_writer
+
 logger = logging.getLogger(__name__)
 
+# the sections which process only the advertisers of their shard, the rest
+# runs in the first shard only
+SHARDED_SECTIONS = ("all_campaigns_all_advertisers",
+                    "all_adgroups_all_advertisers",
+                    "delta_campaigns",
+                    "delta_adgroups")
+
 
 def PredefinedTemplates(config):
     return vp.Schema({
         vp.Optional("campaign_templates"): {
-            "campaign_ids": [vp.Coerce(str)]
+            "campaign_ids": [vp.Coerce(str)],
+            vp.Optional("refresh"): vp.Any("all", "changed"),
+            vp.Optional("format"): vp.Any("csv", "ndjson"),
+            vp.Optional("flatten"): FlattenSchema
         },
         vp.Optional("adgroup_templates"): {
-            "campaign_ids": [vp.Coerce(str)]
+            "campaign_ids": [vp.Coerce(str)],
+            vp.Optional("format"): vp.Any("csv", "ndjson"),
+            vp.Optional("flatten"): FlattenSchema
         },
         vp.Optional("sitelists_summary"): {
             "iterations": [
@@ -31,7 +65,31 @@ def PredefinedTemplates(config):
                         "AdvertiserId": str
                     },
                     extra=vp.ALLOW_EXTRA)
-            ]
+            ],
+            vp.Optional("flatten"): FlattenSchema
+        },
+        vp.Optional("report_executions"): {
+            "payload": vp.Schema({}, extra=vp.ALLOW_EXTRA),
+            vp.Optional("endpoint"): vp.All(str, vp.Length(min=1)),
+        },
+        vp.Optional("sitelist_lines"): {
+            "iterations": [
+                vp.Schema(
+                    {
+                        "AdvertiserId": str
+                    },
+                    extra=vp.ALLOW_EXTRA)
+            ],
+        },
+        **{
+            vp.Optional(section): vp.Schema(
+                {vp.Optional("flatten"): FlattenSchema},
+                extra=vp.ALLOW_EXTRA)
+            for section in ("all_advertisers",
+                            "all_campaigns_all_advertisers",
+                            "all_adgroups_all_advertisers",
+                            "delta_campaigns",
+                            "delta_adgroups")
         }
     },
                      extra=vp.ALLOW_EXTRA)(config)
@@ -45,15 +103,82 @@ def validate_config(params):
             "#password": str,
             vp.Optional("debug"): bool,
             "base_url": str,
-            "extract_predefined": PredefinedTemplates
+            vp.Optional("max_workers"): vp.All(int, vp.Range(min=1)),
+            vp.Optional("store_dir"): str,
+            vp.Optional("checkpoint"): bool,
+            vp.Optional("shard_index"): vp.All(int, vp.Range(min=0)),
+            vp.Optional("shard_count"): vp.All(int, vp.Range(min=1)),
+            vp.Optional("profile"): bool,
+            vp.Optional("advertiser_cache"): {
+                vp.Required("ttl_minutes"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+            },
+            vp.Optional("request_cache"): {
+                vp.Optional("max_entries"): vp.All(int, vp.Range(min=0)),
+                vp.Optional("max_mb"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+            },
+            vp.Optional("sliced_output"): {
+                vp.Optional("slice_rows"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("slice_mb"): vp.All(vp.Coerce(float), vp.Range(min=0, min_included=False)),
+                vp.Optional("writers"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("compresslevel"): vp.All(int, vp.Range(min=0, max=9)),
+            },
+            vp.Optional("json_backend"): vp.Any("json", "orjson", "ujson", "auto"),
+            vp.Optional("pipeline"): {
+                vp.Optional("batch_size"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("queue_size"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("encode_processes"): vp.All(int, vp.Range(min=0)),
+            },
+            vp.Optional("dry_run"): vp.Any(bool, {
+                vp.Optional("sample_advertisers"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("max_minutes"): vp.All(vp.Coerce(float), vp.Range(min=0, min_included=False)),
+            }),
+            vp.Optional("concurrent_sections"): bool,
+            vp.Optional("token_lifetime_minutes"): vp.All(vp.Coerce(float), vp.Range(min=1)),
+            vp.Optional("max_concurrent_sections"): vp.All(int, vp.Range(min=1)),
+            vp.Optional("pagination"): {
+                vp.Optional("page_size"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("prefetch_pages"): vp.All(int, vp.Range(min=1)),
+            },
+            vp.Optional("clone_polling"): {
+                vp.Optional("max_delay"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+                vp.Optional("timeout"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+            },
+            vp.Optional("rate_limit"): {
+                vp.Optional("requests_per_minute"): vp.All(vp.Coerce(float), vp.Range(min=0, min_included=False)),
+                vp.Optional("burst"): vp.All(int, vp.Range(min=1)),
+                vp.Optional("endpoints"): {str: vp.All(vp.Coerce(float), vp.Range(min=0, min_included=False))},
+                vp.Optional("max_retries"): vp.All(int, vp.Range(min=0)),
+                vp.Optional("retry_budget"): vp.All(int, vp.Range(min=0)),
+                vp.Optional("backoff_base"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+                vp.Optional("backoff_cap"): vp.All(vp.Coerce(float), vp.Range(min=0)),
+            },
+            "extract_predefined": PredefinedTemplates,
+            vp.Optional("custom_post_paginated_queries"): [{
+                "endpoint": str,
+                "payload": dict,
+                "filename": str,
+                vp.Optional("format"): vp.Any("csv", "ndjson"),
+                vp.Optional("flatten"): FlattenSchema
+            }]
         }
     )
-    return schema(params)
+    params = schema(params)
+    if params.get("checkpoint") and "sliced_output" in params:
+        raise vp.Invalid("checkpoint can't be used with sliced_output")
+    if "shard_index" in params and "shard_count" not in params:
+        raise vp.Invalid("shard_index needs shard_count")
+    if params.get("shard_index", 0) >= params.get("shard_count", 1):
+        raise vp.Invalid("shard_index must be less than shard_count")
+    return params
 
-def load_tracking_versions(path_to_statefile, endpoint):
-    with open(path_to_statefile) as f:
-        state = json.load(f)
-        return state.get(endpoint, dict())
+
+def load_state(path_to_statefile):
+    """The whole statefile, empty if there is none (the very first run)"""
+    try:
+        with open(path_to_statefile) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
 
 class StateFile(dict):
@@ -63,17 +188,274 @@ class StateFile(dict):
             json.dump(self, outf)
 
 class TTDExtractor(TTDClient):
-    def _request(self, *args, **kwargs):
+    """TTDClient which keeps one session (pooled keep-alive connections and the
+    auth token) for the whole run
+
+    Entering the extractor (`with ex:`) logs in only if there is no token or
+    it's about to expire, leaving it keeps the session open. Call `close()`
+    when the run is finished.
+    """
+    # the PageSize TTDClient.post_paginated asks for by default
+    CLIENT_PAGE_SIZE = 100
+    DEFAULT_POOL_MAXSIZE = 10
+    DEFAULT_TOKEN_LIFETIME_MINUTES = 60
+    # refresh the token this long before it expires
+    TOKEN_REFRESH_MARGIN_SECONDS = 300
+    AUTH_HEADER = 'TTD-Auth'
+
+    def __init__(
+            self,
+            *args,
+            max_workers: int=1,
+            rate_limiter: Optional[RateLimiter]=None,
+            page_size: Optional[int]=None,
+            prefetch_pages: int=1,
+            pool_maxsize: Optional[int]=None,
+            token_lifetime_minutes: float=DEFAULT_TOKEN_LIFETIME_MINUTES,
+            auth_state: Optional[dict]=None,
+            metrics: Optional[Metrics]=None,
+            advertiser_directory: Optional[AdvertiserDirectory]=None,
+            request_cache: Optional[RequestCache]=None,
+            shard: Optional[Shard]=None,
+            **kwargs):
+        """
+        Args:
+            max_workers: how many advertisers are processed concurrently
+                in the "all advertisers" and delta extractions
+            rate_limiter: paces the requests of all threads, by default
+                nothing is paced and only the throttled requests back off
+            page_size: PageSize of the paginated queries, by default the one
+                of TTDClient
+            prefetch_pages: how many pages of a paginated query are
+                downloaded at the same time, 1 keeps the pagination of TTDClient
+            pool_maxsize: how many keep-alive connections are kept, by default
+                enough for `max_workers` * `prefetch_pages` threads
+            token_lifetime_minutes: the lifetime asked for when logging in
+            auth_state: a token saved by `auth_state()` in a previous run
+            metrics: where the requests are counted and timed
+            advertiser_directory: the advertiser listings shared by all the
+                sections, by default kept just in memory
+            request_cache: where identical requests are coalesced and their
+                responses kept, defaults to the default bounds of RequestCache
+            shard: only the advertisers of this shard are processed in the
+                "all advertisers" and delta extractions
+        """
+        super().__init__(*args, **kwargs)
+        self._login_name = kwargs.get('login', args[0] if args else None)
+        self._password = kwargs.get('password', args[1] if len(args) > 1 else None)
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.page_size = page_size
+        self.prefetch_pages = prefetch_pages
+        self.token_lifetime_minutes = token_lifetime_minutes
+        self.metrics = metrics or Metrics()
+        self.advertiser_directory = advertiser_directory or AdvertiserDirectory()
+        self.request_cache = request_cache if request_cache is not None else RequestCache()
+        self.shard = shard
+
+        pool_maxsize = pool_maxsize or max(self.DEFAULT_POOL_MAXSIZE,
+                                           max_workers * prefetch_pages)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+        self._auth_lock = threading.RLock()
+        self._authenticating = False
+        self.auth_token = None
+        self.token_expires_at = 0.0
+        auth_state = auth_state or {}
+        if auth_state.get('login') == self._login_name and auth_state.get('#token'):
+            self.auth_token = auth_state['#token']
+            self.token_expires_at = auth_state.get('expires_at', 0.0)
+
+    @property
+    def query_page_size(self) -> int:
+        """The PageSize the paginated queries actually ask for"""
+        return self.page_size or self.CLIENT_PAGE_SIZE
+
+    def __enter__(self):
+        self._ensure_token()
+        return self
+
+    def __exit__(self, *exc):
+        # keep the connections and the token for the next section
+        return None
+
+    def _token_is_fresh(self):
+        return (self.auth_token is not None and
+                time.time() < self.token_expires_at - self.TOKEN_REFRESH_MARGIN_SECONDS)
+
+    def _ensure_token(self):
+        with self._auth_lock:
+            if self._authenticating:
+                # this is the login request itself
+                return
+            if self._token_is_fresh():
+                self.headers[self.AUTH_HEADER] = self.auth_token
+                return
+            logger.info("Logging in")
+            self._authenticating = True
+            try:
+                self.authorize()
+            finally:
+                self._authenticating = False
+            self.token_expires_at = time.time() + self.token_lifetime_minutes * 60
+
+    def authorize(self):
+        """Logs in asking for a token valid `token_lifetime_minutes`"""
+        response = self.post('authentication', json={
+            'Login': self._login_name,
+            'Password': self._password,
+            'TokenExpirationInMinutes': int(self.token_lifetime_minutes),
+        })
+        self.auth_token = response['Token']
+        self.headers[self.AUTH_HEADER] = self.auth_token
+
+    def auth_state(self) -> dict:
+        """The token and its expiry, to be saved in the statefile"""
+        if self.auth_token is None:
+            return {}
+        return {
+            'login': self._login_name,
+            '#token': self.auth_token,
+            'expires_at': self.token_expires_at
+        }
+
+    def _relative_path(self, url) -> str:
+        path = urlparse(url).path
+        base_path = urlparse(getattr(self, 'base_url', '')).path
+        if path.startswith(base_path):
+            path = path[len(base_path):]
+        return path
+
+    def request(self, method, url, *args, **kwargs):
+        """Identical idempotent requests of the run (GETs and queries) are
+        sent only once, see RequestCache"""
+        path = self._relative_path(url)
+        key = None if args else request_key(method, path, url, kwargs)
+        if key is None:
+            return super().request(method, url, *args, **kwargs)
+        response, hit = self.request_cache.fetch(
+            key, lambda: super(TTDExtractor, self).request(method, url, **kwargs),
+            keep=is_kept(method, path))
+        if hit:
+            self.metrics.cache_hit(endpoint_key(method, path))
+        return response
+
+    def send(self, request, **kwargs):
+        # only the requests which really go out wait for the rate limiter
+        # and are counted
+        endpoint = self._relative_path(request.url)
+        key = endpoint_key(request.method, endpoint)
+        started = time.monotonic()
+        self.rate_limiter.acquire(endpoint)
+        sent = time.monotonic()
+        self.metrics.rate_limit_wait(key, sent - started)
         try:
-            return super()._request(*args, **kwargs)
-        except (requests.HTTPError, TTDApiError)  as err:
-            if err.response.status_code == 429:
-                logger.info("Too many requests, waiting 65 seconds")
-                time.sleep(65)
-                logger.info("Retrying")
-                return super()._request(*args, **kwargs)
+            response = super().send(request, **kwargs)
+        except requests.RequestException:
+            self.metrics.request(key, time.monotonic() - sent, 'error')
+            raise
+        self.metrics.request(key, time.monotonic() - sent, response.status_code)
+        self.metrics.received(key, self._wire_bytes(response, kwargs.get('stream')))
+        return response
+
+    @staticmethod
+    def _wire_bytes(response, stream) -> int:
+        """The size of the body as it came over the network, before
+        requests decompressed it"""
+        if stream:
+            # the body of a streamed response isn't read yet
+            return int(response.headers.get('Content-Length') or 0)
+        content = response.content
+        tell = getattr(response.raw, 'tell', None)
+        if tell is None:
+            return len(content)
+        # urllib3 counts what it pulled from the socket
+        return tell()
+
+    def _request(self, method, endpoint, *args, **kwargs):
+        if self.auth_token is not None and not self._token_is_fresh():
+            self._ensure_token()
+        attempt = 0
+        relogged = False
+        while True:
+            try:
+                return super()._request(method, endpoint, *args, **kwargs)
+            except (requests.HTTPError, TTDApiError) as err:
+                if err.response is None:
+                    raise err
+                if (err.response.status_code == 401 and not relogged
+                        and self.auth_token is not None and not self._authenticating):
+                    # the cached token might have been revoked
+                    logger.info("The auth token was rejected, logging in again")
+                    self.token_expires_at = 0.0
+                    self._ensure_token()
+                    relogged = True
+                    continue
+                if err.response.status_code != 429:
+                    raise err
+                delay = self.rate_limiter.backoff(
+                    endpoint,
+                    attempt,
+                    parse_retry_after(err.response.headers.get('Retry-After')))
+                if delay is None:
+                    raise err
+                logger.info("Too many requests to %s, retrying in %.1f seconds",
+                            endpoint, delay)
+                self.metrics.retried(endpoint_key(method, endpoint), delay)
+                attempt += 1
+
+    def post_paginated(self, endpoint, json_payload, stream_items=False):
+        """Yield all the pages (or items if `stream_items`) of a paginated query
+
+        The first page tells us the total count, so the offsets of the
+        remaining pages are known up front and up to `prefetch_pages` of them
+        are downloaded concurrently. They are still yielded in order.
+        """
+        if self.prefetch_pages <= 1:
+            page_size = {} if self.page_size is None else {'page_size': self.page_size}
+            yield from super().post_paginated(
+                endpoint,
+                json_payload=json_payload,
+                stream_items=stream_items,
+                **page_size)
+            return
+
+        def fetch_page(start_index, page_size):
+            payload = dict(json_payload,
+                           PageStartIndex=start_index,
+                           PageSize=page_size)
+            return self.post(endpoint, json=payload)
+
+        first_page = fetch_page(0, self.query_page_size)
+        total = first_page['TotalFilteredCount']
+        # the API might return less than we asked for, the next pages are
+        # then asked for as many items as the first one had so that the
+        # offsets and the page sizes agree
+        stride = first_page['ResultCount'] or self.query_page_size
+        logger.debug("%s has %s items, fetching the rest in pages of %s",
+                     endpoint, total, stride)
+
+        pages = itertools.chain(
+            [first_page],
+            prefetch_ordered(lambda start_index: fetch_page(start_index, stride),
+                             range(stride, total, stride), self.prefetch_pages))
+        for page in pages:
+            if stream_items:
+                yield from page['Result']
             else:
-                raise err
+                yield page
+
+    def _in_shard(self, advertiser_id) -> bool:
+        return self.shard is None or self.shard.owns(advertiser_id)
+
+    def get_all_advertisers(self, payload):
+        """The advertisers of a partner, the same listing is downloaded only
+        once per run (or reused from the advertiser cache)"""
+        yield from self.advertiser_directory.advertisers(
+            payload,
+            lambda payload: super(TTDExtractor, self).get_all_advertisers(payload))
 
     def extract_sitelists(self, params):
         """
@@ -105,6 +487,38 @@ class TTDExtractor(TTDClient):
                     yield sitelist
         logger.info("Sitelists extracted")
 
+    def extract_sitelist_lines(self, params):
+        """The lines (domains) of every sitelist the summary query returns
+
+        https://api.thetradedesk.com/v3/doc/api/get-sitelist-sitelistid
+        The lines of a sitelist come with the sitelist itself
+        (`SiteListLines`), `max_workers` sitelists are downloaded at the same
+        time and only the lines of those are in memory. The lines of
+        different sitelists are interleaved.
+
+        Args:
+            params: the iterations of `extract_sitelists`
+
+        Returns:
+            dicts like this one at a time
+            {"SiteListId": "sample string 1", "Domain": "example.com", "Adjustment": 1.0}
+        """
+        def lines_of(sitelist):
+            sitelist_id = sitelist['SiteListId']
+            if sitelist.get('SiteListLineCount') == 0:
+                return
+            logger.info("downloading %s lines of sitelist %s",
+                        sitelist.get('SiteListLineCount'), sitelist_id)
+            lines = self.get('sitelist/' + sitelist_id).get('SiteListLines') or []
+            for line in lines:
+                row = {'SiteListId': sitelist_id}
+                row.update(line)
+                yield row
+
+        logger.info("Extracting sitelist lines")
+        yield from fan_out(lines_of, self.extract_sitelists(params), self.max_workers)
+        logger.info("Sitelist lines extracted")
+
     def extract_campaign_templates(self, campaign_ids):
         """
         https://apisb.thetradedesk.com/v3/doc/api/post-sitelist-query-advertiser
@@ -120,6 +534,70 @@ class TTDExtractor(TTDClient):
             }
         logger.info("campaign templates extracted")
 
+    def extract_changed_campaign_templates(self, campaign_ids, store: TemplateStore):
+        """Like extract_campaign_templates, but downloads only new campaigns
+        and those the delta endpoint reports as changed since the last run
+
+        The rest is taken from the `store`, which is updated along the way.
+        """
+        logger.info("Extracting changed campaign templates")
+        campaign_ids = list(OrderedDict.fromkeys(campaign_ids))
+        wanted = set(campaign_ids)
+        stored = store.advertisers_of(campaign_ids)
+
+        def download(campaign_id):
+            logger.info("downloading template for campaign_id %s", campaign_id)
+            template = self.get("/campaign/" + campaign_id)
+            store.save_template(campaign_id, template)
+            return template
+
+        new = [campaign_id for campaign_id in campaign_ids if campaign_id not in stored]
+        new_advertisers = {
+            template.get('AdvertiserId')
+            for template in prefetch_ordered(download, new, self.max_workers)
+        }
+
+        def changed_campaigns(advertiser_id):
+            # without a stored version (a new advertiser) the delta endpoint
+            # returns everything, that's the baseline for the next run
+            version = store.tracking_version(advertiser_id)
+            for campaign, version in self.fetch_all_delta_campaigns_for_advertiser(
+                    advertiser_id, version):
+                yield campaign and campaign['CampaignId'], {advertiser_id: version}
+
+        # templates without an AdvertiserId can't be checked for changes
+        advertisers = (set(stored.values()) | new_advertisers) - {None}
+        reported = OrderedDict()
+        tracking_versions = {}
+        for campaign_id, tracking_version in fan_out(
+                changed_campaigns, sorted(advertisers), self.max_workers):
+            if campaign_id is not None:
+                reported[campaign_id] = True
+            tracking_versions.update(tracking_version)
+        # the new ones were downloaded just now. The stored campaigns which
+        # aren't in the config anymore are dropped, the tracking version of
+        # their advertiser moves past their change and they would come back
+        # stale if they were added again
+        changed = [campaign_id for campaign_id in reported if campaign_id in stored]
+        outdated = [campaign_id for campaign_id in store.advertisers_of(reported)
+                    if campaign_id not in wanted]
+        logger.info("%s new and %s changed campaigns out of %s, %s outdated dropped",
+                    len(new), len(changed), len(campaign_ids), len(outdated))
+        store.delete_templates(outdated)
+        for _ in prefetch_ordered(download, changed, self.max_workers):
+            pass
+        # only once the changes are safely downloaded
+        for advertiser_id, version in tracking_versions.items():
+            if version is not None:
+                store.save_tracking_version(advertiser_id, version)
+
+        for campaign_id, template in store.templates(campaign_ids):
+            yield {
+                "CampaignId": campaign_id,
+                "template": template
+            }
+        logger.info("campaign templates extracted")
+
     def extract_adgroup_templates(self, campaign_ids):
         logger.info("Extracting adgroup templates for campaigns")
         for campaign_id in campaign_ids:
@@ -140,12 +618,96 @@ class TTDExtractor(TTDClient):
                     }
 
 
+    def report_executions(self, payload: dict, endpoint: str=REPORT_EXECUTIONS_ENDPOINT):
+        """The completed report executions the paginated `endpoint` returns
+        for the `payload` (eg. {"AdvertiserIds": [...], "ReportScheduleIds": [...]})"""
+        executions = self.post_paginated(endpoint, json_payload=payload, stream_items=True)
+        for execution in executions:
+            if execution.get('ReportExecutionState') == 'Complete':
+                yield execution
+
+    def download_report_executions(self, executions, outdir: Path, partdir: Path,
+                                   metrics: Optional[Metrics]=None):
+        """Stream the files of the report executions into
+        `outdir/report_<ReportExecutionId>.csv`, `max_workers` at a time
+
+        The files are gunzipped as they stream, see ReportDownloader. They
+        are downloaded with a session of their own, without the auth token,
+        the rate limiter and the request cache of the API calls.
+
+        Yields:
+            (ReportExecutionId, [the paths of its files]) of each execution
+            once all its files are downloaded
+        """
+        def download(execution):
+            execution_id = execution['ReportExecutionId']
+            urls = [delivery['DownloadURL']
+                    for delivery in execution.get('ReportDeliveries') or []
+                    if delivery.get('DownloadURL')]
+            outpaths = []
+            for i, url in enumerate(urls):
+                name = 'report_{}'.format(execution_id) + ('_{}'.format(i) if i else '')
+                outpath = outdir / (name + '.csv')
+                logger.info("Downloading report execution %s to %s", execution_id, outpath)
+                lines = downloader.download(url, outpath, name)
+                if metrics is not None:
+                    # minus the header
+                    metrics.table(outpath, max(0, lines - 1))
+                outpaths.append(outpath)
+            yield execution_id, outpaths
+
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_maxsize=max(self.DEFAULT_POOL_MAXSIZE, self.max_workers))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            downloader = ReportDownloader(session, partdir)
+            yield from fan_out(download, executions, self.max_workers)
+
+    def cloned_adgroup_details(self, campaign_id, adgroup_ids):
+        """Details of the adgroups of a (cloned) campaign, in the order of `adgroup_ids`
+
+        All the adgroups of the campaign are listed with the paginated
+        adgroup/query/campaign, only the ids it doesn't return (eg. a clone not
+        fully indexed yet) are then fetched one by one, `max_workers` at a time.
+        """
+        adgroup_ids = list(adgroup_ids)
+        if not adgroup_ids:
+            return []
+        wanted = set(adgroup_ids)
+        details = {}
+        pages = self.post_paginated(
+            'adgroup/query/campaign',
+            json_payload={'CampaignId': campaign_id})
+        for page in pages:
+            for adgroup in page["Result"]:
+                if adgroup["AdGroupId"] in wanted:
+                    details[adgroup["AdGroupId"]] = adgroup
+
+        missing = [adgroup_id for adgroup_id in adgroup_ids if adgroup_id not in details]
+        if missing:
+            logger.info("%s adgroups of campaign %s weren't listed, fetching them one by one",
+                        len(missing), campaign_id)
+            fetched = prefetch_ordered(
+                lambda adgroup_id: self.get('adgroup/{}'.format(adgroup_id)),
+                missing,
+                self.max_workers)
+            details.update(zip(missing, fetched))
+        return [details[adgroup_id] for adgroup_id in adgroup_ids]
+
     def _delta_things(
             self,
             fetch_all_delta_THING_for_advertiser: Callable,
             last_change_tracking_versions: dict,
             partner_id: str=None,
-            advertisers: Optional[Iterable[str]]=None):
+            advertisers: Optional[Iterable[str]]=None,
+            skip_advertisers: Iterable[str]=(),
+            mark_done: bool=False):
+        """
+        Args:
+            skip_advertisers: advertisers finished in a previous (crashed) run
+            mark_done: yield (AdvertiserDone(advertiser_id), {advertiser_id: version})
+                after all the data of each advertiser, for checkpointing
+        """
 
         if ((partner_id is None and advertisers is None) or
             (partner_id is not None and advertisers is not None)):
@@ -161,7 +723,8 @@ class TTDExtractor(TTDClient):
                         "availabilities": ["Available"]
                     })
             ]
-        for advertiser_id in advertisers:
+
+        def delta_for_advertiser(advertiser_id):
             logger.debug("Processing advertiser_id %s", advertiser_id)
             last_change_tracking_version = last_change_tracking_versions.get(advertiser_id)
             for data, tracking_version in fetch_all_delta_THING_for_advertiser(
@@ -169,13 +732,30 @@ class TTDExtractor(TTDClient):
                     last_change_tracking_version):
                 # {id: version} is a duplication, but the overhead shouldn't
                 # be too dramatic as the data is written to file right away
+                # It also keeps the versions correct when advertisers are
+                # processed concurrently and their rows get interleaved
                 yield data, {advertiser_id: tracking_version}
+                last_change_tracking_version = tracking_version
+            if mark_done:
+                yield (AdvertiserDone(advertiser_id),
+                       {advertiser_id: last_change_tracking_version}
+                       if last_change_tracking_version is not None else {})
+
+        skip_advertisers = set(skip_advertisers)
+        if skip_advertisers:
+            logger.info("Skipping %s advertisers finished in the previous run",
+                        len(skip_advertisers))
+        yield from fan_out(
+            delta_for_advertiser,
+            [a for a in advertisers if a not in skip_advertisers and self._in_shard(a)],
+            self.max_workers)
 
     def delta_campaigns(
             self,
             last_change_tracking_versions: dict,
             partner_id:str =None,
-            advertisers: Optional[Iterable[str]]=None
+            advertisers: Optional[Iterable[str]]=None,
+            **kwargs
     ) -> Iterable[Tuple[dict, dict]]:
         """The first dict in the tuple is the JSON data, the second is
         a {advertiserId: last_change_tracking_version}
@@ -185,13 +765,15 @@ class TTDExtractor(TTDClient):
             self.fetch_all_delta_campaigns_for_advertiser,
             last_change_tracking_versions=last_change_tracking_versions,
             partner_id=partner_id,
-            advertisers=advertisers)
+            advertisers=advertisers,
+            **kwargs)
 
     def delta_adgroups(
             self,
             last_change_tracking_versions: dict,
             partner_id:str =None,
             advertisers: Optional[Iterable[str]]=None,
+            **kwargs
             ):
 
 
@@ -199,36 +781,49 @@ class TTDExtractor(TTDClient):
             self.fetch_all_delta_adgroups_for_advertiser,
             last_change_tracking_versions=last_change_tracking_versions,
             partner_id=partner_id,
-            advertisers=advertisers)
+            advertisers=advertisers,
+            **kwargs)
 
     def get_all_campaigns_all_advertisers(
             self,
             partner_id,
             search_terms=None,
-            availabilities=["Available"]):
+            availabilities=["Available"],
+            **kwargs):
         yield from self._get_all_things_all_advertisers(
             thing='campaign',
             partner_id=partner_id,
             search_terms=search_terms,
-            availabilities=availabilities)
+            availabilities=availabilities,
+            **kwargs)
 
     def get_all_adgroups_all_advertisers(
             self,
             partner_id,
             search_terms=None,
-            availabilities=["Available"]):
+            availabilities=["Available"],
+            **kwargs):
         yield from self._get_all_things_all_advertisers(
             thing='adgroup',
             partner_id=partner_id,
             search_terms=search_terms,
-            availabilities=availabilities)
+            availabilities=availabilities,
+            **kwargs)
 
     def _get_all_things_all_advertisers(
             self,
             thing,
             partner_id,
             search_terms=None,
-            availabilities=['Available']):
+            availabilities=['Available'],
+            skip_advertisers: Iterable[str]=(),
+            mark_done: bool=False):
+        """
+        Args:
+            skip_advertisers: advertisers finished in a previous (crashed) run
+            mark_done: yield AdvertiserDone(advertiser_id) after all the things
+                of each advertiser, for checkpointing
+        """
 
         available_things = ("campaign", "adgroup")
         if thing not in available_things:
@@ -249,7 +844,7 @@ class TTDExtractor(TTDClient):
         if search_terms is not None:
             advertisers_payload['SearchTerms'] = search_terms
 
-        for advertiser in self.get_all_advertisers(advertisers_payload):
+        def things_for_advertiser(advertiser):
             logger.info("Processing advertiser '%s'", advertiser)
             thing_payload = {
                 "AdvertiserId": advertiser['AdvertiserId']
@@ -258,48 +853,68 @@ class TTDExtractor(TTDClient):
                 endpoint='{}/query/advertiser'.format(thing),
                 json_payload=thing_payload,
                 stream_items=True)
+            if mark_done:
+                yield AdvertiserDone(advertiser['AdvertiserId'])
+
+        skip_advertisers = set(skip_advertisers)
+        yield from fan_out(
+            things_for_advertiser,
+            (advertiser
+             for advertiser in self.get_all_advertisers(advertisers_payload)
+             if advertiser['AdvertiserId'] not in skip_advertisers
+             and self._in_shard(advertiser['AdvertiserId'])),
+            self.max_workers)
 
 
     @staticmethod
     def serialize_delta_stream_to_csv(original_delta_stream: Iterable[Tuple[dict, dict]],
-                                      outpath):
+                                      outpath,
+                                      checkpoint: Optional[SectionCheckpoint]=None,
+                                      sliced: Optional[dict]=None,
+                                      flatten: Optional[Flattener]=None,
+                                      metrics: Optional[Metrics]=None,
+                                      pipeline: Optional[dict]=None):
         """A delta stream is a stream of tuples, (json_data, {advertiser_id: last_change_Tracking_version})
 
         We need to write the json_data to csv and cache the last_change_tracking_version
-        """
-        # For now a dumb copy paste of serialize_response_to_json - no time to refactor
-        # will I regret?
 
-        logger.info("Saving to %s", outpath)
+        With a `checkpoint` the stream must contain the AdvertiserDone markers
+        (`mark_done=True`), the output is resumed from the checkpoint and the
+        progress is saved after each advertiser
 
-        _header, delta_stream_of_data = tee(original_delta_stream, 2)
+        With `sliced` (the `sliced_output` options) the output is a sliced
+        table of gzip compressed csvs
 
-        logger.debug("Looking for header")
-        for datapoint, _ in _header:
-            if datapoint is not None:
-                logger.debug("Found header")
-                header = datapoint.keys()
-                break
-        else:
-            # a corner case when neither of the advertisers had any data,
-            # and the delta_stream is full of just tracking_versions
-            tracking_versions = {}
-            for _, track_version in delta_stream_of_data:
-                tracking_versions.update(track_version)
-            logging.info("delta_stream did not contain any data, "
-                            "but was full of tracking_versions. "
-                            "No tables will be in out/tables"
-                            "but statefile will be updated")
-            return None, tracking_versions
+        A `flatten` splits the configured nested values into child tables,
+        it's closed at the end
+
+        The rows and bytes written are counted in `metrics`
+
+        With `pipeline` (the `pipeline` options, the kwargs of `Pipeline`)
+        the stream is consumed, flattened and encoded in other threads
+        while the rows are written
+        """
+        logger.info("Saving to %s", outpath)
 
         tracking_versions = {}
+        resume_from = None
+        if checkpoint is not None:
+            tracking_versions.update(checkpoint.tracking_versions)
+            resume_from = checkpoint.resume_from
         total_rows = 0
-        written_rows = 0
 
-        with open(outpath, 'w') as outf:
-            writer = csv.DictWriter(outf, fieldnames=header)
-            writer.writeheader()
-            for row, last_tracking_version in delta_stream_of_data:
+        delta_stream, split = original_delta_stream, flatten
+        if pipeline is not None:
+            delta_stream = Pipeline(
+                original_delta_stream, encode_delta_items,
+                prepare=prepare_delta_items(flatten) if flatten is not None else None,
+                **pipeline)
+            split = None
+
+        with open_table_writer(outpath, sliced, resume_from) as writer,\
+                (flatten or contextlib.nullcontext()),\
+                (delta_stream if pipeline is not None else contextlib.nullcontext()):
+            for row, last_tracking_version in delta_stream:
                 # take write scalar values as columns, but safely serialize
                 # dicts/lists into json strings
                 # In case of templates the jsons are useful as they are
@@ -307,76 +922,161 @@ class TTDExtractor(TTDClient):
                 # separate component eg.
                 # https://components.keboola.com/~/components/apac.processor-flatten-json
 
+                if isinstance(row, AdvertiserDone):
+                    tracking_versions.update(last_tracking_version)
+                    if checkpoint is not None:
+                        checkpoint.advertiser_done(
+                            row.advertiser_id, last_tracking_version, writer)
+                    continue
+
                 # if row is None it means that the delta endpoint returned
                 # empty data but a new tracking version which we need to cache
                 total_rows += 1
                 if row is not None:
-
-                    written_rows += 1
-
-                    writer.writerow(
-                        {
-                            key: (json.dumps(value) if isinstance(value, (dict, list)) else value)
-                            for key, value
-                            in row.items()
-                        }
-                    )
+                    if split is not None:
+                        row = split(row)
+                    writer.writerow(row)
                 tracking_versions.update(last_tracking_version)
+        if checkpoint is not None:
+            checkpoint.complete(writer)
+        if metrics is not None and writer.rows_written:
+            metrics.table(outpath, writer.rows_written)
 
-        print("total_rows: {}; written_rows: {}".format(total_rows, written_rows))
+        logger.info("total_rows: %s; written_rows: %s", total_rows, writer.rows_written)
+        if writer.rows_written == 0:
+            # a corner case when neither of the advertisers had any data,
+            # and the delta_stream is full of just tracking_versions
+            logging.info("delta_stream did not contain any data, "
+                            "but was full of tracking_versions. "
+                            "No tables will be in out/tables"
+                            "but statefile will be updated")
+            return None, tracking_versions
         return outpath, tracking_versions
 
 
     @staticmethod
-    def serialize_response_to_json(original_stream, outpath):
+    def serialize_response_to_json(original_stream, outpath,
+                                   checkpoint: Optional[SectionCheckpoint]=None,
+                                   sliced: Optional[dict]=None,
+                                   flatten: Optional[Flattener]=None,
+                                   metrics: Optional[Metrics]=None,
+                                   pipeline: Optional[dict]=None):
         """Save the stream of json objects (dicts) into csv
 
-        Scalars are saved as columns, dicts/lists are dumped as strings
+        Scalars are saved as columns, dicts/lists are dumped as strings. The
+        header is the union of the keys of all the objects
+
+        With a `checkpoint` the stream must contain the AdvertiserDone markers
+        (`mark_done=True`), the output is resumed from the checkpoint and the
+        progress is saved after each advertiser
+
+        With `sliced` (the `sliced_output` options) the output is a sliced
+        table of gzip compressed csvs
+
+        A `flatten` splits the configured nested values into child tables,
+        it's closed at the end
+
+        The rows and bytes written are counted in `metrics`
+
+        With `pipeline` (the `pipeline` options, the kwargs of `Pipeline`)
+        the stream is consumed, flattened and encoded in other threads
+        while the rows are written
 
         Retruns:
             None if the stream is empty, else path to the output csv
         """
-        # do not use original_stream here at all!
         logger.info("Saving to %s", outpath)
-        _header, stream_of_data = tee(original_stream)
-        try:
-            header = next(_header).keys()
-        except StopIteration:
-            logger.info("empty data, didn't save anything")
-            return None
-
-        with open(outpath, 'w') as outf:
-            writer = csv.DictWriter(outf, fieldnames=header)
-            writer.writeheader()
-            for row in stream_of_data:
+        resume_from = None
+        if checkpoint is not None:
+            resume_from = checkpoint.resume_from
+        stream, split = original_stream, flatten
+        if pipeline is not None:
+            stream = Pipeline(
+                original_stream, encode_rows,
+                prepare=prepare_rows(flatten) if flatten is not None else None,
+                **pipeline)
+            split = None
+        with open_table_writer(outpath, sliced, resume_from) as writer,\
+                (flatten or contextlib.nullcontext()),\
+                (stream if pipeline is not None else contextlib.nullcontext()):
+            for row in stream:
+                if isinstance(row, AdvertiserDone):
+                    if checkpoint is not None:
+                        checkpoint.advertiser_done(row.advertiser_id, {}, writer)
+                    continue
                 # take write scalar values as columns, but safely serialize
                 # dicts/lists into json strings
                 # In case of templates the jsons are useful as they are
                 # in other cases the json objects can be converted to csv in a
                 # separate component eg.
                 # https://components.keboola.com/~/components/apac.processor-flatten-json
-                writer.writerow(
-                    {
-                        key: (json.dumps(value) if isinstance(value, (dict, list)) else value)
-                        for key, value
-                        in row.items()
-                     }
-                    )
+                # or configure `flatten`
+                if split is not None:
+                    row = split(row)
+                writer.writerow(row)
+        if checkpoint is not None:
+            checkpoint.complete(writer)
+        if metrics is not None and writer.rows_written:
+            metrics.table(outpath, writer.rows_written)
+
+        if writer.rows_written == 0:
+            logger.info("empty data, didn't save anything")
+            return None
+        return outpath
+
+    @staticmethod
+    def serialize_to_ndjson(original_stream, outpath, tags=(),
+                            metrics: Optional[Metrics]=None):
+        """Save the stream of json objects as they are into a newline
+        delimited json file (+ its file manifest)
+
+        Returns:
+            None if the stream is empty, else path to the output file
+        """
+        logger.info("Saving to %s", outpath)
+        with NdjsonFileWriter(outpath, tags=tags) as writer:
+            for obj in original_stream:
+                writer.write(obj)
+        if metrics is not None and writer.rows_written:
+            metrics.table(outpath, writer.rows_written)
+        if writer.rows_written == 0:
+            logger.info("empty data, didn't save anything")
+            return None
         return outpath
 
     def poll_cloned_campaign_get_details(
             self,
             inpath_references: Path,
-            outdir: Path):
+            outdir: Path,
+            max_delay: float=60,
+            timeout: float=3600):
+        """Wait for cloned campaigns and save their details
+
+        All ReferenceIds are polled at the same time, each campaign (and its
+        adgroups) is written as soon as its clone is finished.
+
+        Args:
+            max_delay: the longest wait between two polls of one ReferenceId
+            timeout: after this many seconds the remaining clones are written
+                as failed with Status 'TimedOut'
+        """
         outpath_campaigns = outdir / 'cloned_campaigns.csv'
         outpath_adgroups = outdir / 'cloned_campaign_adgroups.csv'
 
+        rows_by_reference = OrderedDict()
         with open(inpath_references) as inf:
-            input_header = list(csv.DictReader(inf).fieldnames)
+            reader = csv.DictReader(inf)
+            input_header = list(reader.fieldnames)
+            for row in reader:
+                rows_by_reference.setdefault(row['ReferenceId'], []).append(row)
+
+        scheduler = PollScheduler(
+            lambda reference_id: self.get('/campaign/clone/status/{}'.format(reference_id)),
+            max_delay=max_delay,
+            timeout=timeout)
 
         with open(outpath_campaigns, 'w') as out_c,\
-             open(outpath_adgroups, 'w') as out_a,\
-             open(inpath_references) as inf:
+             open(outpath_adgroups, 'w') as out_a:
             wr_campaigns = csv.DictWriter(
                 out_c,
                 fieldnames=input_header + ['CampaignId',
@@ -389,22 +1089,20 @@ class TTDExtractor(TTDClient):
                 fieldnames=['ReferenceId', 'CampaignId', 'AdGroupId', 'adgroup_payload'])
             wr_adgroups.writeheader()
 
-            for row in csv.DictReader(inf):
-                reference_id = row['ReferenceId']
-                cloned_campaign = self._wait_for_cloned_campaign(reference_id)
-                campaign_id = cloned_campaign['CampaignId']
-                campaign_detail = self.get('campaign/{}'.format(campaign_id))
-                campaign_out = row.copy()
-                campaign_out['clone_response'] = json.dumps(cloned_campaign)
+            for reference_id, cloned_campaign in scheduler.run(rows_by_reference):
                 if cloned_campaign['Status'] == 'Completed':
-                    campaign_out['campaign_payload'] = json.dumps(
-                        campaign_detail)
-                    campaign_out['CampaignId'] = campaign_id
-                    wr_campaigns.writerow(campaign_out)
-
-                    for adgroup_id in cloned_campaign['AdGroupIdMap'].values():
-                        adgroup_details = self.get(
-                            'adgroup/{}'.format(adgroup_id))
+                    campaign_id = cloned_campaign['CampaignId']
+                    campaign_detail = self.get('campaign/{}'.format(campaign_id))
+                    for row in rows_by_reference[reference_id]:
+                        campaign_out = row.copy()
+                        campaign_out['clone_response'] = json.dumps(cloned_campaign)
+                        campaign_out['campaign_payload'] = json.dumps(
+                            campaign_detail)
+                        campaign_out['CampaignId'] = campaign_id
+                        wr_campaigns.writerow(campaign_out)
+
+                    for adgroup_details in self.cloned_adgroup_details(
+                            campaign_id, cloned_campaign['AdGroupIdMap'].values()):
                         adgroup_out = {
                             'ReferenceId': reference_id,
                             'CampaignId': adgroup_details['CampaignId'],
@@ -414,164 +1112,454 @@ class TTDExtractor(TTDClient):
                         wr_adgroups.writerow(adgroup_out)
                 else:
                     # we need to still write failed/timeouted campaigns
-                    campaign_out['campaign_payload'] = ''
-                    campaign_out['CampaignId'] = ''
-                    wr_campaigns.writerow(campaign_out)
+                    for row in rows_by_reference[reference_id]:
+                        campaign_out = row.copy()
+                        campaign_out['clone_response'] = json.dumps(cloned_campaign)
+                        campaign_out['campaign_payload'] = ''
+                        campaign_out['CampaignId'] = ''
+                        wr_campaigns.writerow(campaign_out)
                     logger.info("Cloned campaign with ReferenceId %s failed. %s",
                                 reference_id,
                                 cloned_campaign)
 
 
-
-    def _wait_for_cloned_campaign(self, reference_id):
-        delay = 1
-        while True:
-            resp = self.get('/campaign/clone/status/{}'.format(reference_id))
-            if resp['Status'] == 'InProgress':
-                time.sleep(delay)
-                delay *= 1.5
-            else:
-                return resp
-
-
-
-def main(datadir, params):
-    _datadir = Path(datadir)
-    intables = _datadir / 'in/tables'
-    outtables = _datadir / 'out/tables'
-
-    state = StateFile()
-    ex = TTDExtractor(login=params['login'],
-                      password=params["#password"],
-                      base_url=params["base_url"])
+def configured_sections(
+        datadir: Path,
+        params: dict,
+        state: StateFile,
+        checkpoint: Optional[Checkpoint]=None,
+        metrics: Optional[Metrics]=None):
+    """The sections of the config as a list of (name, function)
+
+    Each function takes an entered TTDExtractor and writes its own output
+    table(s), so the sections don't depend on each other
+    """
+    intables = datadir / 'in/tables'
+    outtables = datadir / 'out/tables'
+    outfiles = datadir / 'out/files'
+    store_dir = Path(params.get("store_dir", datadir / 'store'))
+    shard = shard_from_params(params)
+    # the tables and states of the sections split by advertisers
+    shard_suffix = shard.suffix if shard is not None else ''
+    sliced = params.get("sliced_output")
+    if shard is not None and sliced is not None:
+        # the slices of all the shards can be moved into one table
+        sliced = dict(sliced, slice_prefix=shard.name + '-')
+    # the options of every serializer writing a table
+    output = {"sliced": sliced, "metrics": metrics, "pipeline": params.get("pipeline")}
+    sections = []
+
+    def resume(name, config, outpath):
+        """The kwargs for the multi-advertiser extraction and the checkpoint
+        for the serializer"""
+        if checkpoint is None:
+            return {}, None
+        if config.get('flatten'):
+            logger.warning("%s has flattened child tables, it can't be "
+                           "resumed from a checkpoint", name)
+            return {}, None
+        section_checkpoint = checkpoint.section(name, config, outpath)
+        return ({"skip_advertisers": section_checkpoint.done, "mark_done": True},
+                section_checkpoint)
+
+    def flattener(config, table_suffix=''):
+        if not config.get('flatten'):
+            return None
+        return Flattener(config['flatten'], outtables, sliced, metrics, table_suffix)
+
+    def tracking_versions(name):
+        """The tracking versions of the previous run, merged from all the
+        shards (and an unsharded run)"""
+        return merged_shard_states(load_state(datadir / "in/state.json"), name)
+
+    def query_options(config):
+        """The section config without the options of the output"""
+        return {key: value for key, value in config.items() if key != 'flatten'}
+
+    def save_progress(key):
+        """Write `key` of the state into `out/state.json` right away, on top
+        of the previous state, so that it's kept even if a later section
+        fails (the whole state is saved once the run succeeds)"""
+        progress = dict(load_state(datadir / "in/state.json"), **{key: state[key]})
+        atomic_write_json(progress, datadir / "out/state.json")
+
+    def write_manifest(outpath, incremental, primary_key):
+        manifest = {}
+        if outpath.is_dir():
+            # the sliced table already has a manifest with its columns
+            with open(str(outpath) + '.manifest') as mani:
+                manifest = json.load(mani)
+        manifest.update(incremental=incremental, primary_key=primary_key)
+        with open(str(outpath) + '.manifest', 'w') as mani:
+            json.dump(manifest, mani)
+
+    def snapshot_store(name, config, primary_key) -> Optional[SnapshotStore]:
+        """The snapshot store of a delta section with `"snapshot": true`"""
+        if not config.get('snapshot'):
+            return None
+        snapshot = SnapshotStore(
+            store_dir / (name + '_snapshot' + shard_suffix + '.sqlite'), primary_key)
+        if config.get('reset'):
+            snapshot.clear()
+        return snapshot
+
+    def delta_tracking_versions(name, config, snapshot):
+        """Where the delta section `name` continues from, nowhere (all the
+        entities are downloaded) with `reset` or when the snapshot store
+        isn't the one the previous run updated (eg. a new `store_dir`)"""
+        if config.get('reset'):
+            return {}
+        if snapshot is not None:
+            marker = load_state(datadir / "in/state.json").get(name + '_snapshot' + shard_suffix)
+            if marker != snapshot.store_id:
+                logger.warning("The %s snapshot store isn't the one of the previous run, "
+                               "downloading all the entities again", name)
+                return {}
+        return tracking_versions(name)
+
+    def serialize_delta(ex, name, config, primary_key, delta_stream, section_checkpoint, snapshot):
+        """Write the delta stream into the incremental `<name>.csv`, returns
+        the tracking versions
+
+        With a `snapshot` store the rows are also upserted into it and the
+        current state of all the entities is written into
+        `<name>_snapshot.csv` (a full table), the store is closed afterwards
+        """
+        outpath = outtables / (name + shard_suffix + '.csv')
+        if snapshot is not None:
+            delta_stream = snapshot.apply(delta_stream)
+        try:
+            _, tracking_versions = ex.serialize_delta_stream_to_csv(
+                delta_stream,
+                outpath,
+                checkpoint=section_checkpoint,
+                **output,
+                flatten=flattener(config, shard_suffix)
+            )
+            write_manifest(outpath, True, primary_key)
+            if snapshot is not None:
+                logger.info("%s snapshot has %s rows", name, len(snapshot))
+                snapshot_path = outtables / (name + '_snapshot' + shard_suffix + '.csv')
+                ex.serialize_response_to_json(snapshot.rows(), snapshot_path, **output)
+                write_manifest(snapshot_path, False, primary_key)
+                state[name + '_snapshot' + shard_suffix] = snapshot.store_id
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        return tracking_versions
+
+    def serialize_templates(ex, templates, name, config):
+        """A csv table, or with `"format": "ndjson"` the templates as they
+        came from the API into a file"""
+        if config.get("format") == "ndjson":
+            ex.serialize_to_ndjson(
+                (row["template"] for row in templates),
+                outfiles / (name + ".ndjson"),
+                tags=[name],
+                metrics=metrics)
+        else:
+            ex.serialize_response_to_json(
+                templates,
+                outtables / (name + ".csv"),
+                **output,
+                flatten=flattener(config))
 
     p_predef = params.get("extract_predefined", {})
     config_campaign_templates = p_predef.get("campaign_templates")
     if config_campaign_templates is not None:
-        with ex:
+        def campaign_templates_section(ex):
+            if config_campaign_templates.get("refresh") == "changed":
+                with TemplateStore(store_dir / 'campaign_templates.sqlite') as store:
+                    campaign_templates = ex.extract_changed_campaign_templates(
+                        config_campaign_templates["campaign_ids"], store)
+                    serialize_templates(
+                        ex, campaign_templates, "campaign_templates", config_campaign_templates)
+                return
             campaign_templates = ex.extract_campaign_templates(
                 config_campaign_templates["campaign_ids"])
-            ex.serialize_response_to_json(
-                campaign_templates,
-                outtables / "campaign_templates.csv")
+            serialize_templates(
+                ex, campaign_templates, "campaign_templates", config_campaign_templates)
+        sections.append(("campaign_templates", campaign_templates_section))
 
     config_adgroup_templates = p_predef.get("adgroup_templates")
     if config_adgroup_templates is not None:
-        with ex:
+        def adgroup_templates_section(ex):
             adgroup_templates = ex.extract_adgroup_templates(config_adgroup_templates["campaign_ids"])
-            ex.serialize_response_to_json(
-                adgroup_templates,
-                outtables / "adgroup_templates.csv")
+            serialize_templates(
+                ex, adgroup_templates, "adgroup_templates", config_adgroup_templates)
+        sections.append(("adgroup_templates", adgroup_templates_section))
 
     config_sitelists = p_predef.get("sitelists_summary")
     if config_sitelists is not None:
-        with ex:
+        def sitelists_section(ex):
             sitelists = ex.extract_sitelists(config_sitelists['iterations'])
-            ex.serialize_response_to_json(sitelists, outtables / "sitelists_summary.csv")
+            ex.serialize_response_to_json(sitelists, outtables / "sitelists_summary.csv",
+                                          **output,
+                                          flatten=flattener(config_sitelists))
+        sections.append(("sitelists_summary", sitelists_section))
+
+    config_reports = p_predef.get("report_executions")
+    if config_reports is not None:
+        def report_executions_section(ex):
+            downloaded = set(load_state(datadir / "in/state.json").get("report_executions", []))
+            executions = list(ex.report_executions(
+                config_reports['payload'],
+                config_reports.get('endpoint', REPORT_EXECUTIONS_ENDPOINT)))
+            new = [execution for execution in executions
+                   if execution['ReportExecutionId'] not in downloaded]
+            logger.info("%s completed report executions, %s of them not downloaded yet",
+                        len(executions), len(new))
+            # executions which the query doesn't return anymore are forgotten
+            listed = {execution['ReportExecutionId'] for execution in executions}
+            for execution_id, outpaths in ex.download_report_executions(
+                    new, outtables, store_dir / 'reports', metrics):
+                for outpath in outpaths:
+                    write_manifest(outpath, False, [])
+                downloaded.add(execution_id)
+                state["report_executions"] = sorted(downloaded & listed)
+                save_progress("report_executions")
+            state["report_executions"] = sorted(downloaded & listed)
+        sections.append(("report_executions", report_executions_section))
+
+    config_sitelist_lines = p_predef.get("sitelist_lines")
+    if config_sitelist_lines is not None:
+        def sitelist_lines_section(ex):
+            lines = ex.extract_sitelist_lines(config_sitelist_lines['iterations'])
+            # big sitelists have hundreds of thousands of lines, the table is
+            # always sliced
+            ex.serialize_response_to_json(lines, outtables / "sitelist_lines.csv",
+                                          **dict(output, sliced=sliced or {}))
+        sections.append(("sitelist_lines", sitelist_lines_section))
 
     config_get_advertisers = p_predef.get("all_advertisers")
     if config_get_advertisers is not None:
-        with ex:
+        def all_advertisers_section(ex):
             advertisers = ex.get_all_advertisers({"PartnerId": config_get_advertisers['partner_id']})
-            ex.serialize_response_to_json(advertisers, outtables / "advertisers.csv")
+            ex.serialize_response_to_json(advertisers, outtables / "advertisers.csv",
+                                          **output,
+                                          flatten=flattener(config_get_advertisers))
+        sections.append(("all_advertisers", all_advertisers_section))
 
     cfg_gacaa = p_predef.get("all_campaigns_all_advertisers")
     if cfg_gacaa is not None:
-        with ex:
-            campaigns = ex.get_all_campaigns_all_advertisers(**cfg_gacaa)
+        def all_campaigns_section(ex):
+            outpath = outtables / ("all_campaigns_all_advertisers" + shard_suffix + ".csv")
+            resume_kwargs, section_checkpoint = resume(
+                "all_campaigns_all_advertisers" + shard_suffix, cfg_gacaa, outpath)
+            campaigns = ex.get_all_campaigns_all_advertisers(
+                **query_options(cfg_gacaa), **resume_kwargs)
             ex.serialize_response_to_json(
                 campaigns,
-                outtables / "all_campaigns_all_advertisers.csv")
-
+                outpath,
+                checkpoint=section_checkpoint,
+                **output,
+                flatten=flattener(cfg_gacaa, shard_suffix))
+        sections.append(("all_campaigns_all_advertisers", all_campaigns_section))
 
     cfg_gaaaa = p_predef.get("all_adgroups_all_advertisers")
     if cfg_gaaaa is not None:
-        with ex:
-            adgroups = ex.get_all_adgroups_all_advertisers(**cfg_gaaaa)
+        def all_adgroups_section(ex):
+            outpath = outtables / ("all_adgroups_all_advertisers" + shard_suffix + ".csv")
+            resume_kwargs, section_checkpoint = resume(
+                "all_adgroups_all_advertisers" + shard_suffix, cfg_gaaaa, outpath)
+            adgroups = ex.get_all_adgroups_all_advertisers(
+                **query_options(cfg_gaaaa), **resume_kwargs)
             ex.serialize_response_to_json(
                 adgroups,
-                outtables / "all_adgroups_all_advertisers.csv")
+                outpath,
+                checkpoint=section_checkpoint,
+                **output,
+                flatten=flattener(cfg_gaaaa, shard_suffix))
+        sections.append(("all_adgroups_all_advertisers", all_adgroups_section))
 
     for custom_query in params.get("custom_post_paginated_queries", []):
-        with ex:
+        def custom_query_section(ex, custom_query=custom_query):
             stream = ex.post_paginated(
                 endpoint=custom_query['endpoint'],
                 json_payload=custom_query['payload'],
                 stream_items=True)
+            if custom_query.get('format') == 'ndjson':
+                ex.serialize_to_ndjson(
+                    stream,
+                    outfiles / (Path(custom_query['filename']).stem + '.ndjson'),
+                    tags=[Path(custom_query['filename']).stem],
+                    metrics=metrics)
+                return
             ex.serialize_response_to_json(
                 stream,
-                outtables / Path(custom_query['filename']).stem + '.csv'
+                outtables / (Path(custom_query['filename']).stem + '.csv'),
+                **output,
+                flatten=flattener(custom_query)
             )
+        sections.append(("custom_query " + custom_query['filename'], custom_query_section))
 
     cfg_delta_campaigns = p_predef.get("delta_campaigns")
     if cfg_delta_campaigns is not None:
-        with ex:
+        def delta_campaigns_section(ex):
             # download all advertisers
             # Iterate over them
             # If advertiser is in statefile use that last_change_tracking_version
             # serialize everything to csv
-            if cfg_delta_campaigns.get('reset'):
-                state_campaign_tracking_ids = {}
-            else:
-                state_campaign_tracking_ids = load_tracking_versions(
-                    _datadir / "in/state.json",
-                    "delta_campaigns")
+            primary_key = ['AdvertiserId', 'CampaignId']
+            snapshot = snapshot_store("delta_campaigns", cfg_delta_campaigns, primary_key)
+            state_campaign_tracking_ids = delta_tracking_versions(
+                "delta_campaigns", cfg_delta_campaigns, snapshot)
 
+            outpath = outtables / ('delta_campaigns' + shard_suffix + '.csv')
+            resume_kwargs, section_checkpoint = resume("delta_campaigns" + shard_suffix, cfg_delta_campaigns, outpath)
             camp_delta_stream = ex.delta_campaigns(
                 last_change_tracking_versions=state_campaign_tracking_ids,
                 partner_id=cfg_delta_campaigns.get('partner_id'),
-                advertisers=cfg_delta_campaigns.get('advertisers'))
-            _, campaign_tracking_versions = ex.serialize_delta_stream_to_csv(
-                camp_delta_stream,
-                outtables / 'delta_campaigns.csv'
-            )
-
-            with open(outtables / 'delta_campaigns.csv.manifest', 'w') as mani:
-                json.dump({
-                    'incremental': True,
-                    'primary_key': ['AdvertiserId', 'CampaignId']
-                }, mani)
-            state["delta_campaigns"] = campaign_tracking_versions
-
-
+                advertisers=cfg_delta_campaigns.get('advertisers'),
+                **resume_kwargs)
+            campaign_tracking_versions = serialize_delta(
+                ex, "delta_campaigns", cfg_delta_campaigns, primary_key,
+                camp_delta_stream, section_checkpoint, snapshot)
+            state["delta_campaigns" + shard_suffix] = campaign_tracking_versions
+        sections.append(("delta_campaigns", delta_campaigns_section))
 
     cfg_delta_adgroups = p_predef.get("delta_adgroups")
     if cfg_delta_adgroups is not None:
-        with ex:
+        def delta_adgroups_section(ex):
             # download all advertisers
             # Iterate over them
             # If advertiser is in statefile use that last_change_tracking_version
             # serialize everything to csv
 
-            if cfg_delta_adgroups.get('reset'):
-                state_adgroup_tracking_ids = {}
-            else:
-                state_adgroup_tracking_ids = load_tracking_versions(
-                    _datadir / "in/state.json",
-                    "delta_adgroups")
+            primary_key = ['CampaignId', 'AdGroupId']
+            snapshot = snapshot_store("delta_adgroups", cfg_delta_adgroups, primary_key)
+            state_adgroup_tracking_ids = delta_tracking_versions(
+                "delta_adgroups", cfg_delta_adgroups, snapshot)
 
+            outpath = outtables / ('delta_adgroups' + shard_suffix + '.csv')
+            resume_kwargs, section_checkpoint = resume("delta_adgroups" + shard_suffix, cfg_delta_adgroups, outpath)
             adgrp_delta_stream = ex.delta_adgroups(
                 last_change_tracking_versions=state_adgroup_tracking_ids,
                 partner_id=cfg_delta_adgroups.get('partner_id'),
-                advertisers=cfg_delta_adgroups.get('advertisers'))
+                advertisers=cfg_delta_adgroups.get('advertisers'),
+                **resume_kwargs)
 
-            _, adgroup_tracking_versions = ex.serialize_delta_stream_to_csv(
-                adgrp_delta_stream,
-                outtables / 'delta_adgroups.csv'
-            )
-            with open(outtables / 'delta_adgroups.csv.manifest', 'w') as mani:
-                json.dump({
-                    'incremental': True,
-                    'primary_key': ['CampaignId', 'AdGroupId']
-                }, mani)
+            adgroup_tracking_versions = serialize_delta(
+                ex, "delta_adgroups", cfg_delta_adgroups, primary_key,
+                adgrp_delta_stream, section_checkpoint, snapshot)
 
-            state["delta_adgroups"] = adgroup_tracking_versions
+            state["delta_adgroups" + shard_suffix] = adgroup_tracking_versions
+        sections.append(("delta_adgroups", delta_adgroups_section))
 
     path_poll_campaigns = intables / 'poll_cloned_campaign_get_details.csv'
     logger.info("Looking for file %s", path_poll_campaigns)
     if path_poll_campaigns.is_file():
         logger.info('Found! Polling cloned campaigns')
-        with ex:
-            ex.poll_cloned_campaign_get_details(path_poll_campaigns, outtables)
 
+        def poll_cloned_campaigns_section(ex):
+            ex.poll_cloned_campaign_get_details(
+                path_poll_campaigns,
+                outtables,
+                **params.get("clone_polling", {}))
+        sections.append(("poll_cloned_campaign_get_details", poll_cloned_campaigns_section))
+
+    if shard is not None and not shard.is_first:
+        skipped = [name for name, _ in sections if name not in SHARDED_SECTIONS]
+        if skipped:
+            logger.info("%s runs only the sections split by advertisers, "
+                        "the first shard runs %s", shard.name, skipped)
+        sections = [(name, section) for name, section in sections
+                    if name in SHARDED_SECTIONS]
+    return sections
+
+
+def main(datadir, params):
+    _datadir = Path(datadir)
+
+    state = StateFile()
+    previous_state = load_state(_datadir / 'in/state.json')
+
+    concurrent_sections = params.get("concurrent_sections", False)
+    max_concurrent_sections = params.get("max_concurrent_sections",
+                                         DEFAULT_MAX_CONCURRENT_SECTIONS)
+    pagination = params.get("pagination", {})
+    max_workers = params.get("max_workers", 1)
+    # one connection for every thread that can make a request at the same time
+    pool_maxsize = (max_workers *
+                    pagination.get("prefetch_pages", 1) *
+                    (max_concurrent_sections if concurrent_sections else 1))
+
+    set_default_backend(params.get("json_backend", DEFAULT_BACKEND))
+    metrics = Metrics()
+    profiler = Profiler() if params.get("profile") else None
+    store_dir = Path(params.get("store_dir", _datadir / 'store'))
+    advertiser_cache = params.get("advertiser_cache")
+    if advertiser_cache is not None:
+        advertiser_directory = AdvertiserDirectory(
+            store_dir / 'advertisers.json',
+            ttl=advertiser_cache['ttl_minutes'] * 60)
+    else:
+        advertiser_directory = AdvertiserDirectory()
+    request_cache = params.get("request_cache", {})
+
+    # one session, token and rate limiter for the whole run, shared by all
+    # the sections even when they run concurrently
+    ex = TTDExtractor(login=params['login'],
+                      password=params["#password"],
+                      base_url=params["base_url"],
+                      max_workers=max_workers,
+                      rate_limiter=RateLimiter(**params.get("rate_limit", {})),
+                      pool_maxsize=max(TTDExtractor.DEFAULT_POOL_MAXSIZE, pool_maxsize),
+                      token_lifetime_minutes=params.get(
+                          "token_lifetime_minutes",
+                          TTDExtractor.DEFAULT_TOKEN_LIFETIME_MINUTES),
+                      auth_state=previous_state.get("auth"),
+                      metrics=metrics,
+                      advertiser_directory=advertiser_directory,
+                      shard=shard_from_params(params),
+                      request_cache=RequestCache(
+                          max_entries=request_cache.get("max_entries", DEFAULT_MAX_ENTRIES),
+                          max_bytes=int(request_cache.get("max_mb", DEFAULT_MAX_BYTES / 2**20) * 2**20)),
+                      **pagination)
+
+    dry_run = params.get("dry_run", False)
+    if dry_run is True:
+        dry_run = {}
+    checkpoint = None
+    if params.get("checkpoint") and dry_run is False:
+        checkpoint = Checkpoint(store_dir / 'checkpoint.jsonl')
+    sections = configured_sections(_datadir, params, state, checkpoint, metrics)
+    if profiler is not None:
+        sections = [(name, profiler.profiled(section)) for name, section in sections]
+    try:
+        if dry_run is not False:
+            with ex:
+                planner = Planner(ex, _datadir, previous_state,
+                                  dry_run.get("sample_advertisers", DEFAULT_SAMPLE_ADVERTISERS),
+                                  store_dir)
+                plans = planner.plan(params, [name for name, _ in sections])
+            report = plan_report(plans, ex.rate_limiter,
+                                 metrics.mean_latency() or DEFAULT_LATENCY,
+                                 concurrent_sections,
+                                 dry_run.get("max_minutes"))
+            save_plan(report, _datadir / 'out/files/plan.json')
+        elif concurrent_sections:
+            run_sections_concurrently(
+                sections,
+                lambda: ex,
+                max_concurrency=max_concurrent_sections)
+        else:
+            for _, section in sections:
+                with ex:
+                    section(ex)
+    finally:
+        ex.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        # also (especially) when the run failed
+        metrics.save(_datadir / 'metrics.json')
+        if profiler is not None:
+            profiler.save(_datadir / 'profile.pstats')
+
+    if dry_run is not False:
+        # nothing was extracted, the next run goes on from the same state
+        state.update(previous_state)
+    state["auth"] = ex.auth_state()
     state.save_to_file(path= _datadir / 'out/state.json')
+    if checkpoint is not None:
+        checkpoint.clear()
@@ -0,0 +1,163 @@
+"""Splitting nested values of the rows into child tables while writing
+
+A section config can list nested paths to normalize, eg. the adgroups of a
+campaign and the bid lists of each adgroup
+
+    "flatten": [{
+        "path": "AdGroups",
+        "table": "campaign_adgroups",
+        "parent_keys": ["CampaignId"],
+        "flatten": [{
+            "path": "RTBAttributes.BidLists",
+            "table": "adgroup_bidlists",
+            "parent_keys": ["AdGroupId"]
+        }]
+    }]
+
+The value at `path` (dot separated keys) is removed from the row and written
+into `table` instead, one child row per list item (or one for a dict) with
+the `parent_keys` of the row as foreign keys and `_index`, the position in
+the list. Scalar items end up in a `value` column. Every row is split as it
+streams by, so a big table is still written in one pass and only the rows
+being split are in memory.
+"""
+import logging
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import voluptuous as vp
+
+from ttdex.writers import open_table_writer
+
+logger = logging.getLogger(__name__)
+
+
+def _flatten_schema(value):
+    return FlattenSchema(value)
+
+
+FlattenSchema = vp.Schema([{
+    vp.Required("path"): vp.All(str, vp.Length(min=1)),
+    vp.Required("table"): vp.All(str, vp.Length(min=1)),
+    vp.Optional("parent_keys"): [str],
+    vp.Optional("flatten"): _flatten_schema,
+}])
+
+
+def _get_path(row: dict, path: List[str]):
+    value = row
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _pop_path(row: dict, path: List[str]) -> Tuple[dict, object]:
+    """`row` without the value at `path`, and the value
+
+    The dicts along the path are copied instead of changed, the rows can be
+    shared with other sections (eg. the memoized advertiser listing)
+    """
+    key = path[0]
+    if key not in row:
+        return row, None
+    if len(path) == 1:
+        row = dict(row)
+        return row, row.pop(key)
+    child = row[key]
+    if not isinstance(child, dict):
+        return row, None
+    new_child, value = _pop_path(child, path[1:])
+    if new_child is not child:
+        row = dict(row)
+        row[key] = new_child
+    return row, value
+
+
+class _Spec:
+    def __init__(self, config):
+        self.path = config['path'].split('.')
+        self.table = config['table']
+        self.parent_keys = [(key, key.split('.')) for key in config.get('parent_keys', [])]
+        self.children = [_Spec(child) for child in config.get('flatten', [])]
+
+
+class Flattener:
+    """Splits the configured nested paths of rows into child tables
+
+    Call it on each row before writing the row, use it as a context manager
+    (or `close()` it) to finish the child tables.
+
+    Args:
+        specs: the `flatten` list of a section config
+        outdir: where the child tables are written (`<table>.csv`)
+        sliced: the `sliced_output` options for the child tables
+        metrics: Metrics counting the rows written into the child tables
+        table_suffix: appended to the names of the child tables
+    """
+    def __init__(self, specs: List[dict], outdir, sliced: Optional[dict]=None, metrics=None,
+                 table_suffix: str=''):
+        self._specs = [_Spec(spec) for spec in specs]
+        self.outdir = Path(outdir)
+        self.sliced = sliced
+        self.metrics = metrics
+        self.table_suffix = table_suffix
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        for writer in self._writers.values():
+            writer.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+            if self.metrics is not None:
+                self.metrics.table(writer.outpath, writer.rows_written)
+
+    @property
+    def tables(self):
+        """{table: rows written} of the child tables written so far"""
+        return {table: writer.rows_written for table, writer in self._writers.items()}
+
+    def _writer(self, table):
+        writer = self._writers.get(table)
+        if writer is None:
+            outpath = self.outdir / (table + self.table_suffix + '.csv')
+            logger.info("Saving nested values to %s", outpath)
+            writer = self._writers[table] = open_table_writer(outpath, self.sliced)
+        return writer
+
+    def __call__(self, row: dict) -> dict:
+        """Write the nested values of `row` into the child tables, returns the
+        row without them, `row` itself is left as it was"""
+        return self._split(row, self._specs)
+
+    def _split(self, row, specs) -> dict:
+        for spec in specs:
+            row, value = _pop_path(row, spec.path)
+            if value is None:
+                continue
+            foreign_keys = {key: _get_path(row, path) for key, path in spec.parent_keys}
+            writer = self._writer(spec.table)
+            if isinstance(value, list):
+                items = enumerate(value)
+            else:
+                items = [(None, value)]
+            for index, item in items:
+                child = dict(foreign_keys)
+                if index is not None:
+                    child['_index'] = index
+                if isinstance(item, dict):
+                    # the child's own value wins, eg. the CampaignId of an adgroup
+                    child.update(item)
+                else:
+                    child['value'] = item
+                writer.writerow(self._split(child, spec.children))
+        return row
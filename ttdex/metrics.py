@@ -0,0 +1,192 @@
+"""Counters of a run, saved into `metrics.json` in the data dir
+
+Per endpoint: requests by status, a latency histogram, bytes received,
+retries, the time spent waiting for the client side rate limiter, the time
+the API made us wait with 429s and the requests answered by the request cache.
+Per output table: rows and bytes written.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+def endpoint_key(method: str, endpoint: str) -> str:
+    """'GET campaign/{id}' for 'GET /campaign/abc123'
+
+    The last part of a GET endpoint is the id of the entity, POST endpoints
+    are queries without ids
+    """
+    endpoint = endpoint.strip('/')
+    if method.upper() == 'GET' and '/' in endpoint:
+        endpoint = endpoint.rsplit('/', 1)[0] + '/{id}'
+    return '{} {}'.format(method.upper(), endpoint)
+
+
+def _size(path) -> int:
+    """Bytes of a file, or of all the files of a (sliced table) directory"""
+    path = str(path)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class _EndpointMetrics:
+    def __init__(self):
+        self.statuses = Counter()
+        self.latency = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.bytes_received = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.rate_limit_wait_seconds = 0.0
+        self.cache_hits = 0
+
+    def to_dict(self):
+        requests = sum(self.statuses.values())
+        return {
+            'requests': requests,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+            'latency_seconds': {
+                'mean': self.latency_sum / requests if requests else 0.0,
+                'max': self.latency_max,
+                'histogram': {
+                    ('inf' if bound == float('inf') else str(bound)): count
+                    for bound, count in zip(LATENCY_BUCKETS, self.latency)
+                },
+            },
+            'bytes_received': self.bytes_received,
+            'retries': self.retries,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'rate_limit_wait_seconds': round(self.rate_limit_wait_seconds, 3),
+            'cache_hits': self.cache_hits,
+        }
+
+
+class Metrics:
+    """Thread safe counters of one run
+
+    The endpoints are keyed by `endpoint_key`, the tables by their output path
+    """
+    def __init__(self, clock: Callable[[], float]=time.monotonic):
+        self._clock = clock
+        self._started = clock()
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._tables = {}
+
+    def _endpoint(self, key) -> _EndpointMetrics:
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = self._endpoints[key] = _EndpointMetrics()
+        return endpoint
+
+    def request(self, key: str, seconds: float, status: Union[int, str]):
+        with self._lock:
+            endpoint = self._endpoint(key)
+            endpoint.statuses[status] += 1
+            endpoint.latency_sum += seconds
+            endpoint.latency_max = max(endpoint.latency_max, seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    endpoint.latency[i] += 1
+                    break
+
+    def received(self, key: str, nbytes: int):
+        with self._lock:
+            self._endpoint(key).bytes_received += nbytes
+
+    def retried(self, key: str, delay: float):
+        """A request was throttled by the API and is retried after `delay`"""
+        with self._lock:
+            endpoint = self._endpoint(key)
+            endpoint.retries += 1
+            endpoint.throttled_seconds += delay
+
+    def rate_limit_wait(self, key: str, seconds: float):
+        with self._lock:
+            self._endpoint(key).rate_limit_wait_seconds += seconds
+
+    def cache_hit(self, key: str):
+        """A request wasn't sent, an identical one was answered already"""
+        with self._lock:
+            self._endpoint(key).cache_hits += 1
+
+    def mean_latency(self) -> Optional[float]:
+        """Mean latency of all the requests so far, None before the first one"""
+        with self._lock:
+            requests = sum(sum(endpoint.statuses.values()) for endpoint in self._endpoints.values())
+            if not requests:
+                return None
+            return sum(endpoint.latency_sum for endpoint in self._endpoints.values()) / requests
+
+    def table(self, outpath, rows: int):
+        """`rows` were written into `outpath` (a file or a sliced table)"""
+        with self._lock:
+            self._tables[str(outpath)] = {
+                'rows': rows,
+                'bytes': _size(outpath),
+            }
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'elapsed_seconds': round(self._clock() - self._started, 3),
+                'endpoints': {key: endpoint.to_dict()
+                              for key, endpoint in sorted(self._endpoints.items())},
+                'tables': dict(sorted(self._tables.items())),
+            }
+
+    def save(self, path):
+        logger.info("Saving metrics to %s", path)
+        with open(str(path), 'w') as outf:
+            json.dump(self.to_dict(), outf, indent=2)
+
+
+class Profiler:
+    """cProfile of the threads running the sections
+
+    `profiled(func)` wraps a function so that it's profiled in whatever
+    thread it runs, `save()` merges all the profiles into one pstats file.
+    The worker pools inside a section (`max_workers`, `prefetch_pages`) are
+    not profiled.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []  # type: List[cProfile.Profile]
+
+    def profiled(self, func):
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+        return wrapper
+
+    def save(self, path) -> Optional[Path]:
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        logger.info("Saving the profile to %s", path)
+        pstats.Stats(*profiles).dump_stats(str(path))
+        return Path(path)
@@ -0,0 +1,210 @@
+"""Overlapping the download, the encoding and the writing of a table
+
+Without a pipeline one thread takes turns: it waits for a page of the API,
+dumps the nested values of its rows into json strings and writes them. With
+one the work is split into stages connected by bounded queues:
+
+    fetch (thread) -> transform/encode (thread or processes) -> write (caller)
+
+A stage blocks when the queue in front of it is full, so a slow writer slows
+down the downloads instead of buffering the whole table (backpressure). An
+exception in any of the stages is reraised in the writing thread, and when
+the writer stops (or fails) the other stages stop too.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+from ttdex.concurrency import DONE, ERROR, ITEM, get_until_stopped, put_until_stopped
+from ttdex.encoding import NESTED_TYPES, default_backend, get_dumps, set_default_backend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_QUEUE_SIZE = 4
+
+# the json backend of the process (a worker of the encode pool or the main one)
+_dumps = None
+
+
+def _process_dumps():
+    global _dumps
+    if _dumps is None:
+        _dumps = get_dumps()
+    return _dumps
+
+
+def encode_nested(row: dict, dumps: Callable[[object], str]) -> dict:
+    """The row with its nested values (dicts/lists) dumped into json strings,
+    like the csv writers would"""
+    return {key: dumps(value) if isinstance(value, NESTED_TYPES) else value
+            for key, value in row.items()}
+
+
+def encode_rows(batch: List) -> List:
+    """Encode stage for a stream of rows, the AdvertiserDone markers pass"""
+    dumps = _process_dumps()
+    return [encode_nested(row, dumps) if isinstance(row, dict) else row
+            for row in batch]
+
+
+def encode_delta_items(batch: List) -> List:
+    """Encode stage for a delta stream of `(row, tracking_versions)`, the
+    rows that are None and the AdvertiserDone markers pass"""
+    dumps = _process_dumps()
+    return [(encode_nested(row, dumps), versions) if isinstance(row, dict) else (row, versions)
+            for row, versions in batch]
+
+
+def prepare_rows(func: Callable[[dict], dict]) -> Callable[[List], List]:
+    """A `prepare` applying `func` to the rows of a stream of rows"""
+    def prepare(batch):
+        return [func(row) if isinstance(row, dict) else row for row in batch]
+    return prepare
+
+
+def prepare_delta_items(func: Callable[[dict], dict]) -> Callable[[List], List]:
+    """A `prepare` applying `func` to the rows of a delta stream"""
+    def prepare(batch):
+        return [(func(row) if isinstance(row, dict) else row, versions)
+                for row, versions in batch]
+    return prepare
+
+
+class Pipeline:
+    """Iterates over `encode(prepare(batch))` of the batches of `source`,
+    flattened back into single items in their original order
+
+    `source` is consumed in a thread of its own and `prepare` and `encode`
+    run in another thread, ahead of the consumer. Close the pipeline (or use
+    it as a context manager) when done, which stops and joins the stages
+    and closes `source` if it's a generator.
+
+    Args:
+        source: the stream of items, typically a generator making API calls
+        encode: a function taking and returning a list of items; with
+            `encode_processes` it runs in other processes, so it must be
+            a module level function (picklable) and so must be the items
+        prepare: like `encode`, but always runs in the transform thread (eg.
+            the flattening, which writes its child tables)
+        batch_size: items passed between the stages at a time
+        queue_size: batches that can wait between two stages, with
+            `batch_size` it bounds the memory taken by the pipeline
+        encode_processes: run `encode` in a pool of this many processes
+            instead of the transform thread, so that encoding big templates
+            doesn't hold the GIL against the fetch stage
+    """
+    def __init__(
+            self,
+            source: Iterable,
+            encode: Callable[[List], List],
+            prepare: Optional[Callable[[List], List]]=None,
+            batch_size: int=DEFAULT_BATCH_SIZE,
+            queue_size: int=DEFAULT_QUEUE_SIZE,
+            encode_processes: int=0):
+        self.encode = encode
+        self.prepare = prepare
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._fetched = queue.Queue(maxsize=queue_size)
+        self._encoded = queue.Queue(maxsize=queue_size)
+        self._executor = None
+        # the batches submitted to the pool before waiting for the oldest
+        self._window = 2 * encode_processes
+        if encode_processes:
+            # not forked, a fork of a process running threads (the http
+            # connection pool, other sections) can deadlock on their locks,
+            # so the workers are told the json backend of this process
+            self._executor = ProcessPoolExecutor(
+                encode_processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=set_default_backend, initargs=(default_backend(),))
+        self._threads = [
+            threading.Thread(target=self._fetch, args=(source,), name='pipeline-fetch', daemon=True),
+            threading.Thread(target=self._transform, name='pipeline-transform', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _put(self, stage_queue, message) -> bool:
+        return put_until_stopped(stage_queue, message, self._stop)
+
+    def _get(self, stage_queue):
+        return get_until_stopped(stage_queue, self._stop)
+
+    def _fetch(self, source):
+        try:
+            batch = []
+            for item in source:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    if not self._put(self._fetched, (ITEM, batch)):
+                        return
+                    batch = []
+            if batch and not self._put(self._fetched, (ITEM, batch)):
+                return
+        except Exception as err:
+            self._put(self._fetched, (ERROR, err))
+        else:
+            self._put(self._fetched, (DONE, None))
+        finally:
+            # cancels the pending requests of a generator that's stopped early
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    def _transform(self):
+        pending = deque()
+        try:
+            while True:
+                message = self._get(self._fetched)
+                if message is None:
+                    return
+                kind, batch = message
+                if kind != ITEM:
+                    while pending:
+                        if not self._put(self._encoded, (ITEM, pending.popleft().result())):
+                            return
+                    self._put(self._encoded, message)
+                    return
+                if self.prepare is not None:
+                    batch = self.prepare(batch)
+                if self._executor is None:
+                    if not self._put(self._encoded, (ITEM, self.encode(batch))):
+                        return
+                    continue
+                pending.append(self._executor.submit(self.encode, batch))
+                if len(pending) >= self._window:
+                    if not self._put(self._encoded, (ITEM, pending.popleft().result())):
+                        return
+        except Exception as err:
+            self._put(self._encoded, (ERROR, err))
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __iter__(self):
+        while True:
+            kind, payload = self._encoded.get()
+            if kind == ITEM:
+                yield from payload
+            elif kind == DONE:
+                return
+            else:
+                raise payload
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,406 @@
+"""Planning a run without downloading its data (`dry_run`)
+
+For each configured section the planner estimates how many advertisers, pages
+and requests the run needs. Paginated queries are asked for a single item
+(PageSize 1), which still tells the total count. The queries done once for
+every advertiser are counted for a sample of the advertisers and extrapolated
+to all of them. Together with the rate limit, the concurrency and the latency
+of the planning requests this predicts how long the run takes.
+"""
+import csv
+import json
+import logging
+import math
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from ttdex.coalesce import is_kept
+from ttdex.directory import directory_key
+from ttdex.metrics import endpoint_key
+from ttdex.ratelimit import RateLimiter
+from ttdex.reports import REPORT_EXECUTIONS_ENDPOINT
+from ttdex.sharding import merged_shard_states
+from ttdex.store import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_ADVERTISERS = 20
+# assumed when no request was timed (eg. only templates are configured)
+DEFAULT_LATENCY = 0.5
+# entities in one response of the delta endpoints, they don't take a
+# PageSize, the API decides (an estimate)
+DELTA_PAGE_SIZE = 100
+ADVERTISERS_ENDPOINT = 'advertiser/query/partner'
+SITELISTS_ENDPOINT = 'sitelist/query/advertiser'
+SITELIST_ENDPOINT = 'sitelist/{id}'
+ADGROUPS_OF_CAMPAIGN_ENDPOINT = 'adgroup/query/campaign'
+
+
+def pages(items: int, page_size: int) -> int:
+    """Pages of a paginated query, an empty one still takes a request"""
+    return max(1, math.ceil(items / page_size))
+
+
+def _sample(values: List, size: int) -> List:
+    """`size` values spread evenly over `values`"""
+    if len(values) <= size:
+        return list(values)
+    return [values[i * len(values) // size] for i in range(size)]
+
+
+class SectionPlan:
+    """The estimated work of one section
+
+    Args:
+        parallelism: how many of its requests are in flight at a time
+    """
+    def __init__(self, name: str, parallelism: int=1):
+        self.name = name
+        self.parallelism = max(1, parallelism)
+        self.advertisers = None
+        self.items = 0
+        self.pages = 0
+        self.requests = Counter()
+        self.notes = []
+
+    def add(self, method: str, endpoint: str, requests: int, items: int=0, pages: int=0):
+        self.requests[(method, endpoint)] += requests
+        self.items += items
+        self.pages += pages
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def requests_by_endpoint(self) -> Dict[str, int]:
+        by_endpoint = Counter()
+        for (_, endpoint), requests in self.requests.items():
+            by_endpoint[endpoint] += requests
+        return by_endpoint
+
+    def seconds(self, rate_limiter: RateLimiter, latency: float) -> float:
+        """Whichever takes longer, waiting for the rate limiter or for the
+        responses"""
+        return max(rate_limiter.min_seconds(self.requests_by_endpoint()),
+                   self.total_requests * latency / self.parallelism)
+
+    def to_dict(self, rate_limiter: RateLimiter, latency: float) -> dict:
+        return {
+            'section': self.name,
+            'advertisers': self.advertisers,
+            'items': self.items,
+            'pages': self.pages,
+            'requests': self.total_requests,
+            'endpoints': {endpoint_key(method, endpoint): requests
+                          for (method, endpoint), requests in sorted(self.requests.items())},
+            'parallelism': self.parallelism,
+            'estimated_seconds': round(self.seconds(rate_limiter, latency), 1),
+            'notes': self.notes,
+        }
+
+
+class Planner:
+    """Plans the sections of a config using an entered TTDExtractor
+
+    Args:
+        ex: sends the planning requests (and counts them in its metrics)
+        datadir: the data dir of the run, for its input tables
+        previous_state: the statefile of the previous run, for the tracking
+            versions of the delta sections
+        sample_advertisers: for how many advertisers the per advertiser
+            queries are counted
+        store_dir: where the run keeps its stores, for the snapshots of the
+            delta sections
+    """
+    def __init__(
+            self,
+            ex,
+            datadir: Path,
+            previous_state: dict,
+            sample_advertisers: int=DEFAULT_SAMPLE_ADVERTISERS,
+            store_dir: Optional[Path]=None):
+        self.ex = ex
+        self.datadir = Path(datadir)
+        self.previous_state = previous_state
+        self.sample_advertisers = sample_advertisers
+        self.store_dir = Path(store_dir) if store_dir is not None else self.datadir / 'store'
+        # the queries a run sends once (see RequestCache and is_kept), by
+        # the first section needing them
+        self._planned = set()
+
+    @property
+    def fan_out(self) -> int:
+        """Parallelism of the sections processing advertisers concurrently"""
+        return self.ex.max_workers * self.ex.prefetch_pages
+
+    def count(self, endpoint: str, payload: dict) -> int:
+        """The total count of a paginated query"""
+        page = self.ex.post(endpoint, json=dict(payload, PageStartIndex=0, PageSize=1))
+        return page['TotalFilteredCount']
+
+    def _first_time(self, key) -> bool:
+        if key in self._planned:
+            return False
+        self._planned.add(key)
+        return True
+
+    def paginated(self, plan: SectionPlan, endpoint: str, payload: dict) -> int:
+        """Plans one paginated query, returns the number of its items"""
+        total = self.count(endpoint, payload)
+        query_pages = pages(total, self.ex.query_page_size)
+        # a run sends a kept query once, the others every time
+        if (not is_kept('POST', endpoint)
+                or self._first_time((endpoint, json.dumps(payload, sort_keys=True)))):
+            plan.add('POST', endpoint, query_pages, pages=query_pages)
+        plan.items += total
+        return total
+
+    def per_key(self, plan: SectionPlan, endpoint: str, key: str, values: List[str],
+                count_endpoint: Optional[str]=None, page_size: Optional[int]=None):
+        """Plans the paginated `endpoint` queried for each of `values`
+
+        The items are counted with `count_endpoint` (defaults to `endpoint`)
+        for a sample of the values and extrapolated to the rest. The pages
+        hold `page_size` items, by default the extractor's.
+        """
+        if not values:
+            return
+        sample = _sample(values, self.sample_advertisers)
+        counts = [self.count(count_endpoint or endpoint, {key: value}) for value in sample]
+        scale = len(values) / len(sample)
+        page_size = page_size or self.ex.query_page_size
+        query_pages = round(sum(pages(count, page_size) for count in counts) * scale)
+        plan.add('POST', endpoint, query_pages,
+                 items=round(sum(counts) * scale), pages=query_pages)
+        if len(sample) < len(values):
+            plan.notes.append("{} for {} of {} {}s, the rest extrapolated".format(
+                endpoint, len(sample), len(values), key))
+
+    def advertisers(self, plan: SectionPlan, payload: dict) -> List[str]:
+        """The advertisers (of the shard) the section processes
+
+        The listing is downloaded, its pages are added to the first section
+        listing it, the other ones reuse it like in a run.
+        """
+        listed = [advertiser['AdvertiserId'] for advertiser in self.ex.get_all_advertisers(payload)]
+        if self._first_time(directory_key(payload)):
+            listing_pages = pages(len(listed), self.ex.query_page_size)
+            plan.add('POST', ADVERTISERS_ENDPOINT, listing_pages, pages=listing_pages)
+        shard = self.ex.shard
+        advertisers = [advertiser for advertiser in listed
+                       if shard is None or shard.owns(advertiser)]
+        plan.advertisers = len(advertisers)
+        return advertisers
+
+    # the sections
+
+    def campaign_templates(self, config: dict) -> SectionPlan:
+        campaign_ids = list(dict.fromkeys(config['campaign_ids']))
+        if config.get('refresh') == 'changed':
+            plan = SectionPlan('campaign_templates', self.ex.max_workers)
+            plan.notes.append("only new and changed campaigns are downloaded, "
+                              "the requests are an upper bound")
+        else:
+            plan = SectionPlan('campaign_templates')
+        plan.add('GET', 'campaign/{id}', len(campaign_ids), items=len(campaign_ids))
+        return plan
+
+    def adgroup_templates(self, config: dict) -> SectionPlan:
+        plan = SectionPlan('adgroup_templates', self.ex.prefetch_pages)
+        self.per_key(plan, ADGROUPS_OF_CAMPAIGN_ENDPOINT, 'CampaignId',
+                     list(config['campaign_ids']))
+        return plan
+
+    def sitelists_summary(self, config: dict) -> SectionPlan:
+        plan = SectionPlan('sitelists_summary', self.ex.prefetch_pages)
+        for iteration in config['iterations']:
+            self.paginated(plan, SITELISTS_ENDPOINT, iteration)
+        return plan
+
+    def sitelist_lines(self, config: dict) -> SectionPlan:
+        plan = SectionPlan('sitelist_lines', self.fan_out)
+        unknown = 0
+        for iteration in config['iterations']:
+            sitelists = [sitelist
+                         for page in self.ex.get_all_sitelists(iteration)
+                         for sitelist in page['Result']]
+            if self._first_time((SITELISTS_ENDPOINT, json.dumps(iteration, sort_keys=True))):
+                listing_pages = pages(len(sitelists), self.ex.query_page_size)
+                plan.add('POST', SITELISTS_ENDPOINT, listing_pages, pages=listing_pages)
+            for sitelist in sitelists:
+                lines = sitelist.get('SiteListLineCount')
+                if lines == 0:
+                    continue
+                if lines is None:
+                    unknown += 1
+                # the lines come with the sitelist
+                plan.add('GET', SITELIST_ENDPOINT, 1, items=lines or 0)
+        if unknown:
+            plan.notes.append("{} sitelists don't tell their number of lines, "
+                              "their lines aren't counted".format(unknown))
+        return plan
+
+    def report_executions(self, config: dict, endpoint: str) -> SectionPlan:
+        plan = SectionPlan('report_executions', self.ex.max_workers)
+        executions = self.paginated(plan, endpoint, config['payload'])
+        plan.add('GET', '<DownloadURL>', executions)
+        plan.notes.append("one file per execution assumed, only the complete "
+                          "executions are downloaded; the size of the files isn't known")
+        return plan
+
+    def all_advertisers(self, config: dict) -> SectionPlan:
+        plan = SectionPlan('all_advertisers', self.ex.prefetch_pages)
+        plan.items = len(self.advertisers(plan, {"PartnerId": config['partner_id']}))
+        return plan
+
+    def all_things_all_advertisers(self, name: str, thing: str, config: dict) -> SectionPlan:
+        plan = SectionPlan(name, self.fan_out)
+        payload = {
+            "PartnerId": config['partner_id'],
+            "availabilities": config.get('availabilities', ["Available"])
+        }
+        if config.get('search_terms') is not None:
+            payload['SearchTerms'] = config['search_terms']
+        advertisers = self.advertisers(plan, payload)
+        self.per_key(plan, '{}/query/advertiser'.format(thing), 'AdvertiserId', advertisers)
+        return plan
+
+    def delta(self, name: str, thing: str, config: dict) -> SectionPlan:
+        plan = SectionPlan(name, self.ex.max_workers)
+        if config.get('advertisers') is not None:
+            advertisers = [advertiser for advertiser in config['advertisers']
+                           if self.ex.shard is None or self.ex.shard.owns(advertiser)]
+            plan.advertisers = len(advertisers)
+        else:
+            advertisers = self.advertisers(
+                plan, {"PartnerId": config['partner_id'], "availabilities": ["Available"]})
+        versions = {} if config.get('reset') else merged_shard_states(self.previous_state, name)
+        if versions and config.get('snapshot') and not self._snapshot_is_current(name):
+            versions = {}
+            plan.notes.append("the snapshot store isn't the one of the previous run, "
+                              "all the {}s are downloaded again".format(thing))
+        endpoint = 'delta/{}/query/advertiser'.format(thing)
+        tracked = [advertiser for advertiser in advertisers if advertiser in versions]
+        new = [advertiser for advertiser in advertisers if advertiser not in versions]
+        plan.add('POST', endpoint, len(tracked), pages=len(tracked))
+        if tracked:
+            plan.notes.append("{} advertisers with a tracking version take one request "
+                              "each, more if many of their {}s changed".format(len(tracked), thing))
+        if new:
+            # the first delta of an advertiser returns all its entities
+            self.per_key(plan, endpoint, 'AdvertiserId', new,
+                         count_endpoint='{}/query/advertiser'.format(thing),
+                         page_size=DELTA_PAGE_SIZE)
+            plan.notes.append("{} advertisers without a tracking version download all "
+                              "their {}s".format(len(new), thing))
+        return plan
+
+    def _snapshot_is_current(self, name: str) -> bool:
+        suffix = self.ex.shard.suffix if self.ex.shard is not None else ''
+        store_id = SnapshotStore.read_store_id(
+            self.store_dir / (name + '_snapshot' + suffix + '.sqlite'))
+        return store_id is not None and store_id == self.previous_state.get(
+            name + '_snapshot' + suffix)
+
+    def custom_query(self, name: str, query: dict) -> SectionPlan:
+        plan = SectionPlan(name, self.ex.prefetch_pages)
+        self.paginated(plan, query['endpoint'], query['payload'])
+        return plan
+
+    def poll_cloned_campaigns(self, inpath: Path) -> SectionPlan:
+        plan = SectionPlan('poll_cloned_campaign_get_details')
+        with open(str(inpath)) as inf:
+            references = {row['ReferenceId'] for row in csv.DictReader(inf)}
+        plan.add('GET', 'campaign/clone/status/{id}', len(references), items=len(references))
+        plan.add('GET', 'campaign/{id}', len(references))
+        plan.add('POST', ADGROUPS_OF_CAMPAIGN_ENDPOINT, len(references), pages=len(references))
+        plan.notes.append("one status poll per clone assumed, the time the clones "
+                          "take isn't included")
+        return plan
+
+    def plan(self, params: dict, section_names: Iterable[str]) -> List[SectionPlan]:
+        """Plans of the sections, in the order of `section_names` (the names
+        of `configured_sections`, which leaves out the sections of the other
+        shards)"""
+        predefined = params.get("extract_predefined", {})
+        planners = {
+            'campaign_templates': lambda: self.campaign_templates(predefined['campaign_templates']),
+            'adgroup_templates': lambda: self.adgroup_templates(predefined['adgroup_templates']),
+            'sitelists_summary': lambda: self.sitelists_summary(predefined['sitelists_summary']),
+            'report_executions': lambda: self.report_executions(
+                predefined['report_executions'],
+                predefined['report_executions'].get('endpoint', REPORT_EXECUTIONS_ENDPOINT)),
+            'sitelist_lines': lambda: self.sitelist_lines(predefined['sitelist_lines']),
+            'all_advertisers': lambda: self.all_advertisers(predefined['all_advertisers']),
+            'all_campaigns_all_advertisers': lambda: self.all_things_all_advertisers(
+                'all_campaigns_all_advertisers', 'campaign',
+                predefined['all_campaigns_all_advertisers']),
+            'all_adgroups_all_advertisers': lambda: self.all_things_all_advertisers(
+                'all_adgroups_all_advertisers', 'adgroup',
+                predefined['all_adgroups_all_advertisers']),
+            'delta_campaigns': lambda: self.delta('delta_campaigns', 'campaign',
+                                                  predefined['delta_campaigns']),
+            'delta_adgroups': lambda: self.delta('delta_adgroups', 'adgroup',
+                                                 predefined['delta_adgroups']),
+            'poll_cloned_campaign_get_details': lambda: self.poll_cloned_campaigns(
+                self.datadir / 'in/tables/poll_cloned_campaign_get_details.csv'),
+        }
+        for query in params.get("custom_post_paginated_queries", []):
+            name = 'custom_query ' + query['filename']
+            planners[name] = lambda name=name, query=query: self.custom_query(name, query)
+
+        plans = []
+        for name in section_names:
+            logger.info("Planning %s", name)
+            plans.append(planners[name]())
+        return plans
+
+
+def plan_report(
+        plans: List[SectionPlan],
+        rate_limiter: RateLimiter,
+        latency: float,
+        concurrent_sections: bool=False,
+        max_minutes: Optional[float]=None) -> dict:
+    """The plan of a run as saved into `plan.json`"""
+    sections = [plan.to_dict(rate_limiter, latency) for plan in plans]
+    if concurrent_sections:
+        # all the sections share one rate limiter
+        everything = Counter()
+        for plan in plans:
+            everything.update(plan.requests_by_endpoint())
+        seconds = max([rate_limiter.min_seconds(everything)] +
+                      [section['estimated_seconds'] for section in sections])
+    else:
+        seconds = sum(section['estimated_seconds'] for section in sections)
+    report = {
+        'sections': sections,
+        'requests': sum(plan.total_requests for plan in plans),
+        'estimated_seconds': round(seconds, 1),
+        'estimated_minutes': round(seconds / 60, 1),
+        'assumptions': {
+            'latency_seconds': round(latency, 3),
+            'requests_per_minute': rate_limiter.requests_per_minute,
+            'concurrent_sections': concurrent_sections,
+        },
+    }
+    if max_minutes is not None:
+        report['max_minutes'] = max_minutes
+        report['exceeds_max_minutes'] = seconds / 60 > max_minutes
+    return report
+
+
+def save_plan(report: dict, path):
+    logger.info("Saving the plan to %s", path)
+    for section in report['sections']:
+        logger.info("%s: %s requests, %s pages, ~%.0f seconds",
+                    section['section'], section['requests'], section['pages'],
+                    section['estimated_seconds'])
+    logger.info("The run needs ~%s requests and ~%.1f minutes",
+                report['requests'], report['estimated_minutes'])
+    if report.get('exceeds_max_minutes'):
+        logger.warning("The run would take longer than %s minutes", report['max_minutes'])
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), 'w') as outf:
+        json.dump(report, outf, indent=2)
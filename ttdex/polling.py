@@ -0,0 +1,91 @@
+"""Polling many asynchronous jobs (campaign clones) at the same time"""
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Iterable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+IN_PROGRESS = 'InProgress'
+TIMED_OUT = 'TimedOut'
+
+
+class PollScheduler:
+    """Polls the status of many jobs from a single priority queue
+
+    Every outstanding job sits in a heap ordered by the time it should be
+    polled next, so we only ever sleep until the closest one is due. The delay
+    of each job grows by `backoff` up to `max_delay`. When the `timeout` of
+    the whole run is reached, the remaining jobs are given up on.
+
+    The wall time is therefore close to the slowest job instead of the sum of
+    all of them.
+    """
+    def __init__(
+            self,
+            fetch_status: Callable[[str], dict],
+            initial_delay: float=1,
+            backoff: float=1.5,
+            max_delay: float=60,
+            timeout: float=3600,
+            clock: Callable[[], float]=time.monotonic,
+            sleep: Callable[[float], None]=time.sleep):
+        """
+        Args:
+            fetch_status: returns the status response for a job id, the job is
+                considered finished when its 'Status' is not 'InProgress'
+        """
+        self.fetch_status = fetch_status
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._clock = clock
+        self._sleep = sleep
+
+    def run(self, job_ids: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+        """Yield (job_id, final_status) in the order the jobs finish
+
+        Jobs which didn't finish before the timeout are yielded at the end with
+        their last status response and 'Status' set to 'TimedOut'
+        """
+        start = self._clock()
+        deadline = start + self.timeout
+        # the counter breaks ties so that job ids are never compared
+        counter = itertools.count()
+        queue = []
+        last_status = {}
+        for job_id in job_ids:
+            if job_id in last_status:
+                continue
+            last_status[job_id] = None
+            heapq.heappush(queue, (start, next(counter), job_id, self.initial_delay))
+
+        while queue:
+            due, _, job_id, delay = queue[0]
+            now = self._clock()
+            if due > deadline:
+                break
+            if due > now:
+                self._sleep(due - now)
+            heapq.heappop(queue)
+
+            status = self.fetch_status(job_id)
+            last_status[job_id] = status
+            if status.get('Status') == IN_PROGRESS:
+                heapq.heappush(
+                    queue,
+                    (self._clock() + delay,
+                     next(counter),
+                     job_id,
+                     min(self.max_delay, delay * self.backoff)))
+            else:
+                logger.debug("Job %s finished with %s", job_id, status.get('Status'))
+                yield job_id, status
+
+        for _, _, job_id, _ in sorted(queue):
+            logger.warning("Job %s didn't finish in %s seconds", job_id, self.timeout)
+            timed_out = dict(last_status[job_id] or {})
+            timed_out['Status'] = TIMED_OUT
+            yield job_id, timed_out
@@ -0,0 +1,202 @@
+"""Client side rate limiting shared by every thread using one TTDExtractor"""
+import email.utils
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BURST = 10
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_RETRY_BUDGET = 50
+DEFAULT_BACKOFF_BASE = 2.0
+# the same wait the extractor used to do after a 429
+DEFAULT_BACKOFF_CAP = 65.0
+
+
+class TokenBucket:
+    """Thread safe token bucket
+
+    `rate` tokens per second are added up to `capacity`, every request takes
+    one. `pause` blocks the bucket for everybody, which is what we want when
+    the API tells us to slow down. With `rate` None the bucket doesn't pace
+    the requests at all, only its pauses block.
+    """
+    def __init__(
+            self,
+            rate: Optional[float],
+            capacity: int,
+            clock: Callable[[], float]=time.monotonic,
+            sleep: Callable[[float], None]=time.sleep):
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive, not {}".format(rate))
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._last = clock()
+        self._blocked_until = self._last
+
+    def _refill(self, now):
+        if self.rate is None:
+            self._tokens = float(self.capacity)
+        elif now > self._last:
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+    def acquire(self):
+        """Block until a request can be made"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    # tolerate float rounding, otherwise we could be waiting
+                    # for a fraction of a token forever
+                    if self._tokens >= 1 - 1e-9:
+                        self._tokens = max(0.0, self._tokens - 1)
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def pause(self, seconds: float):
+        """Don't hand out any tokens for `seconds` and start empty afterwards"""
+        with self._lock:
+            until = self._clock() + seconds
+            if until > self._blocked_until:
+                self._blocked_until = until
+                self._tokens = 0
+                self._last = until
+
+
+def parse_retry_after(value: Optional[str], now: Optional[datetime]=None) -> Optional[float]:
+    """Seconds to wait according to the `Retry-After` header
+
+    The header is either a number of seconds or a HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug("Can't parse Retry-After '%s'", value)
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+class RateLimiter:
+    """Paces requests below the API quota and decides how long to back off
+
+    There is one global bucket and optionally a bucket for each endpoint
+    prefix in `endpoints`, for example {"delta/": 120} allows 120 requests per
+    minute to the delta endpoints on top of the global limit. Without
+    `requests_per_minute` the global bucket doesn't pace anything, it is only
+    paused when the API throttles us.
+
+    The retry budget is shared by the whole run, so a run that is being
+    throttled all the time eventually fails instead of sleeping for hours.
+    """
+    def __init__(
+            self,
+            requests_per_minute: Optional[float]=None,
+            burst: int=DEFAULT_BURST,
+            endpoints: Optional[Dict[str, float]]=None,
+            max_retries: int=DEFAULT_MAX_RETRIES,
+            retry_budget: int=DEFAULT_RETRY_BUDGET,
+            backoff_base: float=DEFAULT_BACKOFF_BASE,
+            backoff_cap: float=DEFAULT_BACKOFF_CAP,
+            clock: Callable[[], float]=time.monotonic,
+            sleep: Callable[[float], None]=time.sleep,
+            random_: Callable[[], float]=random.random):
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._random = random_
+        self._lock = threading.Lock()
+        self._global = TokenBucket(
+            requests_per_minute / 60 if requests_per_minute else None,
+            burst, clock, sleep)
+        self._endpoints = {
+            self.endpoint_key(prefix): TokenBucket(rpm / 60, burst, clock, sleep)
+            for prefix, rpm
+            in (endpoints or {}).items()
+        }
+
+    @staticmethod
+    def endpoint_key(endpoint: str) -> str:
+        return endpoint.strip('/').lower()
+
+    def _buckets(self, endpoint):
+        key = self.endpoint_key(endpoint)
+        matching = [prefix for prefix in self._endpoints if key.startswith(prefix)]
+        buckets = [self._global]
+        if matching:
+            buckets.append(self._endpoints[max(matching, key=len)])
+        return buckets
+
+    def acquire(self, endpoint: str):
+        for bucket in self._buckets(endpoint):
+            bucket.acquire()
+
+    def min_seconds(self, requests: Dict[str, int]) -> float:
+        """The least time it takes to let through the `requests` (the
+        number of requests by endpoint), for planning a run"""
+        per_bucket = {}
+        for endpoint, count in requests.items():
+            for bucket in self._buckets(endpoint):
+                per_bucket[bucket] = per_bucket.get(bucket, 0) + count
+        return max([max(0, count - bucket.capacity) / bucket.rate
+                    for bucket, count in per_bucket.items()
+                    if bucket.rate is not None] or [0.0])
+
+    def backoff(self, endpoint: str, attempt: int, retry_after: Optional[float]=None) -> Optional[float]:
+        """Register a throttled request
+
+        Pauses the bucket of `endpoint` (or the global one if the endpoint
+        doesn't have its own) so that no other thread hammers the API in the
+        meantime and returns the pause in seconds.
+
+        Args:
+            attempt: 0 for the first retry of the request, 1 for the second...
+            retry_after: what the API asked for in the Retry-After header
+
+        Returns:
+            None if the request shouldn't be retried anymore
+        """
+        if attempt >= self.max_retries:
+            logger.warning("Giving up on %s after %s retries", endpoint, attempt)
+            return None
+        with self._lock:
+            if self.retry_budget <= 0:
+                logger.warning("Retry budget for this run is exhausted")
+                return None
+            self.retry_budget -= 1
+
+        if retry_after is not None:
+            # a bit of jitter so that the workers don't come back all at once
+            delay = retry_after + self._random() * self.backoff_base
+        else:
+            # capped exponential backoff with "equal jitter", we always wait
+            # at least half of the exponential delay
+            ceiling = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+            delay = ceiling / 2 + self._random() * ceiling / 2
+        self._buckets(endpoint)[-1].pause(delay)
+        return delay
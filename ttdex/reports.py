@@ -0,0 +1,196 @@
+"""Streaming (resumable) downloads of report execution files
+
+Report files run to many GB, so they are never held in memory. The raw bytes
+are appended to a `.part` file as they arrive and at the same time gunzipped
+into the output table. An interrupted download continues where the `.part`
+file ends with a HTTP Range request; the output is then first rebuilt from
+the `.part` file (a local read, much cheaper than downloading it again).
+"""
+import logging
+import os
+import zlib
+from pathlib import Path
+
+import requests
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+REPORT_EXECUTIONS_ENDPOINT = 'myreports/reportexecution/query/advertisers'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_ATTEMPTS = 5
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+class GunzipWriter:
+    """Writes the bytes it's fed into `outf`, gunzipped if they are gzip
+
+    Concatenated gzip members are all decompressed, no more than `chunk_size`
+    decompressed bytes are in memory at a time, no matter how well the
+    data compresses.
+    """
+    def __init__(self, outf, chunk_size: int=DEFAULT_CHUNK_SIZE):
+        self.outf = outf
+        self.chunk_size = chunk_size
+        self._head = b''
+        self._gzipped = None
+        self._decompressor = None
+        self.lines = 0
+
+    def _emit(self, data):
+        self.lines += data.count(b'\n')
+        self.outf.write(data)
+
+    def _new_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write(self, data: bytes):
+        if self._gzipped is None:
+            # decide by the first two bytes
+            self._head += data
+            if len(self._head) < len(_GZIP_MAGIC):
+                return
+            data, self._head = self._head, b''
+            self._gzipped = data.startswith(_GZIP_MAGIC)
+            if self._gzipped:
+                self._decompressor = self._new_decompressor()
+        if not self._gzipped:
+            self._emit(data)
+            return
+        while True:
+            out = self._decompressor.decompress(data, self.chunk_size)
+            self._emit(out)
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                if not data:
+                    return
+                # the next gzip member
+                self._decompressor = self._new_decompressor()
+            else:
+                data = self._decompressor.unconsumed_tail
+                # a full chunk might mean there's more output pending
+                if not data and len(out) < self.chunk_size:
+                    return
+
+    def close(self):
+        """Raises IncompleteDownload if the gzip stream was cut off"""
+        if self._head:
+            self._emit(self._head)
+            self._head = b''
+        if self._decompressor is not None:
+            self._emit(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise IncompleteDownload("The gzip stream ended unexpectedly")
+
+
+def _read_chunks(path, chunk_size):
+    with open(str(path), 'rb') as inf:
+        while True:
+            chunk = inf.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class ReportDownloader:
+    """Downloads files through a `requests.Session`
+
+    Args:
+        session: sends the requests, not the extractor's: the DownloadURLs
+            are on other hosts, which mustn't get the auth token, and aren't
+            subject to the API's rate limit
+        partdir: where the `.part` files of unfinished downloads are kept;
+            a persistent dir lets the next run resume them too
+        chunk_size: bytes read from the network (and written) at a time
+        max_attempts: how many times a download is continued after the
+            connection broke, within one run
+    """
+    def __init__(
+            self,
+            session: requests.Session,
+            partdir,
+            chunk_size: int=DEFAULT_CHUNK_SIZE,
+            max_attempts: int=DEFAULT_MAX_ATTEMPTS):
+        self.session = session
+        self.partdir = Path(partdir)
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+
+    def download(self, url: str, outpath, name: str) -> int:
+        """Download `url` into `outpath` (gunzipped), returns the number of
+        lines written
+
+        Args:
+            name: identifies the file across runs (the url may be signed and
+                expire), the name of its `.part` file
+        """
+        self.partdir.mkdir(parents=True, exist_ok=True)
+        part_path = self.partdir / (name + '.part')
+        attempt = 1
+        while True:
+            try:
+                downloaded, lines = self._download(url, Path(outpath), part_path)
+                break
+            except (requests.ConnectionError,
+                    urllib3.exceptions.HTTPError,
+                    IncompleteDownload) as err:
+                if attempt >= self.max_attempts:
+                    raise
+                logger.info("Downloading %s broke off (%s), resuming from %s bytes",
+                            name, err, part_path.stat().st_size if part_path.exists() else 0)
+                attempt += 1
+        os.remove(str(part_path))
+        logger.info("Downloaded %s (%s bytes in the last attempt)", name, downloaded)
+        return lines
+
+    def _download(self, url, outpath, part_path):
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with self.session.request('GET', url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # the .part file is complete already
+                pass
+            elif response.status_code == 200 and offset:
+                logger.info("%s doesn't support ranges, downloading it whole", url)
+                offset = 0
+            else:
+                response.raise_for_status()
+            if response.status_code != 200:
+                total = _content_range_total(response, offset)
+            else:
+                total = int(response.headers.get('Content-Length') or 0) or None
+
+            with open(str(outpath), 'wb') as outf, \
+                    open(str(part_path), 'r+b' if offset else 'wb') as partf:
+                writer = GunzipWriter(outf, self.chunk_size)
+                if offset:
+                    # rebuild the output of the bytes downloaded before
+                    for chunk in _read_chunks(part_path, self.chunk_size):
+                        writer.write(chunk)
+                    partf.seek(offset)
+                if response.status_code != 416:
+                    # the raw bytes, Range offsets count those
+                    for chunk in response.raw.stream(self.chunk_size, decode_content=False):
+                        partf.write(chunk)
+                        writer.write(chunk)
+                partf.flush()
+                size = partf.tell()
+                if total is not None and size < total:
+                    raise IncompleteDownload("Got {} of {} bytes".format(size, total))
+                writer.close()
+        return size - offset, writer.lines
+
+
+def _content_range_total(response, offset):
+    """The full size of a ranged (206/416) response, None if unknown"""
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1]
+    if total.isdigit():
+        return int(total)
+    if response.status_code == 416:
+        return offset
+    return None
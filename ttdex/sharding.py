@@ -0,0 +1,64 @@
+"""Splitting the advertisers of a partner across parallel jobs
+
+With `shard_index` and `shard_count` a job processes only the advertisers of
+its shard in the sections working with all advertisers (all campaigns/adgroups
+and the deltas). An advertiser always falls into the same shard, in every run
+and on every machine. Each shard names its tables, slices and tracking
+versions in `state.json` after itself, so the outputs and states of all the
+shards can be merged without conflicts.
+"""
+import hashlib
+from typing import Optional
+
+
+def shard_of(advertiser_id: str, shard_count: int) -> int:
+    """The shard of an advertiser, stable across processes (unlike `hash()`,
+    which is salted per process)"""
+    digest = hashlib.sha1(advertiser_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+class Shard:
+    """One of `count` shards, `index` is 0 based"""
+    def __init__(self, index: int, count: int):
+        if not 0 <= index < count:
+            raise ValueError("shard_index must be in [0, {})".format(count))
+        self.index = index
+        self.count = count
+
+    def __repr__(self):
+        return 'Shard({}, {})'.format(self.index, self.count)
+
+    @property
+    def name(self) -> str:
+        return 'shard-{}-of-{}'.format(self.index, self.count)
+
+    @property
+    def is_first(self) -> bool:
+        """The first shard runs the sections which aren't split by advertiser"""
+        return self.index == 0
+
+    def owns(self, advertiser_id: str) -> bool:
+        return shard_of(advertiser_id, self.count) == self.index
+
+    @property
+    def suffix(self) -> str:
+        """Appended to the names of the tables and state sections of the
+        shard, eg. 'delta_campaigns_shard-1-of-4'"""
+        return '_' + self.name
+
+
+def shard_from_params(params: dict) -> Optional[Shard]:
+    if params.get("shard_count") is None:
+        return None
+    return Shard(params.get("shard_index", 0), params["shard_count"])
+
+
+def merged_shard_states(state: dict, name: str) -> dict:
+    """The section `name` of a statefile merged with the same section of all
+    the shards (`<name>_shard-i-of-n`), so that resharding doesn't start over"""
+    merged = dict(state.get(name, {}))
+    for key, shard_state in sorted(state.items()):
+        if key.startswith(name + '_shard-'):
+            merged.update(shard_state)
+    return merged
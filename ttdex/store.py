@@ -0,0 +1,192 @@
+"""On-disk stores kept between runs (in `store_dir`)"""
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateStore:
+    """Campaign templates keyed by CampaignId + the delta tracking versions
+    of their advertisers, in a sqlite file
+
+    Used with `campaign_templates.refresh = "changed"`, only the campaigns the
+    delta endpoint reports as changed are downloaded again.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS campaign_templates ("
+                "campaign_id TEXT PRIMARY KEY, advertiser_id TEXT, template TEXT)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracking_versions ("
+                "advertiser_id TEXT PRIMARY KEY, version INTEGER)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def save_template(self, campaign_id: str, template: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO campaign_templates VALUES (?, ?, ?)",
+                (campaign_id, template.get('AdvertiserId'), json.dumps(template)))
+
+    def delete_templates(self, campaign_ids: Iterable[str]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM campaign_templates WHERE campaign_id = ?",
+                ((campaign_id,) for campaign_id in campaign_ids))
+
+    def template(self, campaign_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT template FROM campaign_templates WHERE campaign_id = ?",
+                (campaign_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def advertisers_of(self, campaign_ids: Iterable[str]) -> Dict[str, str]:
+        """{campaign_id: advertiser_id} of the stored campaigns"""
+        campaign_ids = list(campaign_ids)
+        found = {}
+        # sqlite has a limit on the number of query parameters
+        for i in range(0, len(campaign_ids), 500):
+            chunk = campaign_ids[i:i + 500]
+            with self._lock:
+                found.update(self._conn.execute(
+                    "SELECT campaign_id, advertiser_id FROM campaign_templates "
+                    "WHERE campaign_id IN ({})".format(','.join('?' * len(chunk))),
+                    chunk).fetchall())
+        return found
+
+    def tracking_version(self, advertiser_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM tracking_versions WHERE advertiser_id = ?",
+                (advertiser_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_tracking_version(self, advertiser_id: str, version: int):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tracking_versions VALUES (?, ?)",
+                (advertiser_id, version))
+
+    def templates(self, campaign_ids: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+        for campaign_id in campaign_ids:
+            template = self.template(campaign_id)
+            if template is not None:
+                yield campaign_id, template
+
+
+class SnapshotStore:
+    """Current state of the entities of a delta section, in a sqlite file
+
+    Each row of the delta stream is upserted by its `primary_key` (the same
+    columns as in the manifest of the incremental output), so an entity
+    changed several times keeps only its latest version, and `rows()` is the
+    full current state without downloading everything again.
+
+    A new store gets a random `store_id`. It's saved in the statefile next to
+    the tracking versions, a store which doesn't match it (eg. a new
+    `store_dir`) only holds the changes since some run and the entities
+    have to be downloaded again.
+    """
+    def __init__(self, path, primary_key: Iterable[str], batch_size: int=500):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.primary_key = list(primary_key)
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshot ("
+                "pk TEXT PRIMARY KEY, row TEXT)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('store_id', ?)", (uuid.uuid4().hex,))
+        self.store_id = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'store_id'").fetchone()[0]
+
+    @staticmethod
+    def read_store_id(path) -> Optional[str]:
+        """The `store_id` of the store at `path`, None if there is none"""
+        path = Path(path)
+        if not path.is_file():
+            return None
+        conn = sqlite3.connect('file:{}?mode=ro'.format(path.as_posix()), uri=True)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'store_id'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def clear(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM snapshot")
+
+    def _key(self, row: dict) -> str:
+        return json.dumps([row.get(column) for column in self.primary_key])
+
+    def upsert(self, rows: Iterable[dict]):
+        self._upsert_encoded((self._key(row), json.dumps(row)) for row in rows)
+
+    def _upsert_encoded(self, encoded_rows):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshot VALUES (?, ?)", encoded_rows)
+
+    def apply(self, delta_stream: Iterable[Tuple]) -> Iterator[Tuple]:
+        """Upsert the rows of a delta stream while passing it through
+
+        Rows which are None (only a new tracking version) are passed
+        through untouched, on the AdvertiserDone markers of a checkpointed
+        section the pending rows are stored before the marker goes on.
+        The rows are encoded right away, the consumer may change them.
+        """
+        batch = []
+        for item in delta_stream:
+            row = item[0]
+            if isinstance(row, dict):
+                batch.append((self._key(row), json.dumps(row)))
+                if len(batch) < self.batch_size:
+                    yield item
+                    continue
+            if batch and row is not None:
+                self._upsert_encoded(batch)
+                batch = []
+            yield item
+        self._upsert_encoded(batch)
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM snapshot").fetchone()[0]
+
+    def rows(self) -> Iterator[dict]:
+        """All the stored entities ordered by their primary key"""
+        for (row,) in self._conn.execute("SELECT row FROM snapshot ORDER BY pk"):
+            yield json.loads(row)
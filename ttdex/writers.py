@@ -0,0 +1,494 @@
+"""Streaming csv output for rows whose keys aren't known in advance"""
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from ttdex.encoding import RowEncoder, get_dumps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_SLICE_BYTES = 256 * 1024 * 1024
+DEFAULT_COMPRESSLEVEL = 6
+
+
+class _BatchWriter:
+    """What all the writers share: the encoded rows are buffered and written
+    in batches of `batch_size`, a manifest is written next to `outpath` when
+    finishing and a failure aborts instead of finishing"""
+    def __init__(self, outpath, batch_size: int=DEFAULT_BATCH_SIZE):
+        self.outpath = outpath
+        self.batch_size = batch_size
+        self._batch = []
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _buffer(self, encoded):
+        self._batch.append(encoded)
+        self.rows_written += 1
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _write_manifest(self, manifest: dict):
+        with open(str(self.outpath) + '.manifest', 'w') as mani:
+            json.dump(manifest, mani)
+
+    def _flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+
+class _TableWriter(_BatchWriter):
+    """A writer of dicts into csv rows, the columns are the union of the keys
+    of all the rows in the order they showed up"""
+    def __init__(
+            self,
+            outpath,
+            encoder: Optional[RowEncoder]=None,
+            batch_size: int=DEFAULT_BATCH_SIZE):
+        super().__init__(outpath, batch_size)
+        self.encoder = encoder or RowEncoder()
+        self.columns = []
+        self._positions = {}
+        self._initial_width = 0
+
+    @property
+    def _started(self) -> bool:
+        raise NotImplementedError
+
+    def _start(self):
+        """Create the output for the first row, the columns are known"""
+        raise NotImplementedError
+
+    @property
+    def schema_changed(self):
+        return len(self.columns) != self._initial_width
+
+    def _add_columns(self, row):
+        for key in row:
+            if key not in self._positions:
+                self._positions[key] = len(self.columns)
+                self.columns.append(key)
+
+    def writerow(self, row: dict):
+        if not self._started:
+            self._add_columns(row)
+            self._initial_width = len(self.columns)
+            self._start()
+        elif not self._positions.keys() >= row.keys():
+            logger.debug("New columns %s in %s",
+                         row.keys() - self._positions.keys(), self.outpath)
+            self._add_columns(row)
+        self._buffer(self.encoder.encode(row, self.columns))
+
+
+class CsvTableWriter(_TableWriter):
+    """Write dicts into a csv whose header is the union of all their keys
+
+    The header is taken from the first row and the rows are written straight
+    to `outpath`. New keys in later rows are appended as new columns and the
+    file is rewritten once, when closing, with the final header and the short
+    rows padded with empty values. That is one extra streaming pass, and
+    only when the schema actually changed, so memory stays bounded.
+
+    Scalars are written as they are, dicts/lists are dumped into json
+    strings by the `encoder`. The encoded rows are written in batches of
+    `batch_size`.
+
+    Nothing is written (and `close()` returns None) if there were no rows.
+
+    A partially written file can be continued with `resume_from`, what
+    `checkpoint()` returned at some point while writing it. Anything written
+    after that checkpoint is cut off.
+    """
+    def __init__(
+            self,
+            outpath,
+            encoder: Optional[RowEncoder]=None,
+            batch_size: int=DEFAULT_BATCH_SIZE,
+            resume_from: Optional[dict]=None):
+        super().__init__(outpath, encoder, batch_size)
+        self._outf = None
+        self._writer = None
+        if resume_from is not None:
+            self._resume(resume_from)
+
+    def _resume(self, checkpoint):
+        logger.info("Resuming %s from row %s", self.outpath, checkpoint['rows'])
+        self.columns = list(checkpoint['columns'])
+        self._positions = {column: i for i, column in enumerate(self.columns)}
+        self._initial_width = checkpoint['header_width']
+        self.rows_written = checkpoint['rows']
+        with open(self.outpath, 'r+') as outf:
+            outf.truncate(checkpoint['offset'])
+        self._outf = open(self.outpath, 'a', newline='')
+        self._writer = csv.writer(self._outf)
+
+    def checkpoint(self) -> Optional[dict]:
+        """Flush everything to disk, returns what's needed to resume from here"""
+        if self._writer is None:
+            return None
+        if self._outf.closed:
+            # after close() the header is final, continuing the file just
+            # appends rows
+            return {
+                'path': str(self.outpath),
+                'offset': os.path.getsize(str(self.outpath)),
+                'columns': list(self.columns),
+                'header_width': len(self.columns),
+                'rows': self.rows_written
+            }
+        self._flush()
+        self._outf.flush()
+        os.fsync(self._outf.fileno())
+        return {
+            'path': str(self.outpath),
+            'offset': self._outf.tell(),
+            'columns': list(self.columns),
+            'header_width': self._initial_width,
+            'rows': self.rows_written
+        }
+
+    def abort(self):
+        """Close the file as it is, without the buffered rows and without
+        rewriting the header, so that it can still be resumed from the last
+        `checkpoint()`"""
+        self._batch = []
+        if self._outf is not None:
+            self._outf.close()
+
+    @property
+    def _started(self):
+        return self._writer is not None
+
+    def _start(self):
+        self._outf = open(self.outpath, 'w', newline='')
+        self._writer = csv.writer(self._outf)
+        self._writer.writerow(self.columns)
+
+    def _flush(self):
+        self._writer.writerows(self._batch)
+        self._batch = []
+
+    def close(self):
+        """Finish the file, returns the outpath or None if nothing was written"""
+        if self._outf is None:
+            return None
+        if self._outf.closed:
+            return self.outpath
+        self._flush()
+        self._outf.close()
+        if self.schema_changed:
+            self._rewrite_with_final_header()
+        return self.outpath
+
+    def _rewrite_with_final_header(self):
+        logger.info("The schema of %s changed while writing, "
+                    "rewriting it with %s columns",
+                    self.outpath, len(self.columns))
+        width = len(self.columns)
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(str(self.outpath))),
+            suffix='.csv.tmp')
+        try:
+            with open(self.outpath, newline='') as inf,\
+                 os.fdopen(fd, 'w', newline='') as outf:
+                reader = csv.reader(inf)
+                writer = csv.writer(outf)
+                next(reader)
+                writer.writerow(self.columns)
+                for values in reader:
+                    if len(values) < width:
+                        values.extend([''] * (width - len(values)))
+                    writer.writerow(values)
+            os.replace(tmppath, str(self.outpath))
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+
+class _Slice:
+    """One gzip compressed slice of a sliced table, without a header"""
+    def __init__(self, path, compresslevel):
+        self.path = path
+        self.rows = 0
+        self.min_width = None
+        self._raw = open(path, 'wb')
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=compresslevel)
+        self._text = io.TextIOWrapper(self._gz, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._text)
+
+    @property
+    def size(self):
+        """Compressed bytes written so far"""
+        return self._raw.tell()
+
+    def write(self, rows, width):
+        self._writer.writerows(rows)
+        self.rows += len(rows)
+        if self.min_width is None or width < self.min_width:
+            self.min_width = width
+
+    def close(self):
+        self._text.close()
+        self._raw.close()
+
+
+class _Lane:
+    """A worker thread filling its own slices, one after another"""
+    def __init__(self, table):
+        self._table = table
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._slice = None
+
+    def submit(self, rows, width):
+        return self._executor.submit(self._write, rows, width)
+
+    def _write(self, rows, width):
+        if self._slice is None:
+            self._slice = self._table._new_slice()
+        self._slice.write(rows, width)
+        if self._table._is_full(self._slice):
+            self._slice.close()
+            self._slice = None
+
+    def _close_slice(self):
+        if self._slice is not None:
+            self._slice.close()
+            self._slice = None
+
+    def close(self):
+        future = self._executor.submit(self._close_slice)
+        self._executor.shutdown(wait=True)
+        future.result()
+
+
+class SlicedCsvTableWriter(_TableWriter):
+    """Write dicts into a sliced table, a directory of gzip compressed csv
+    slices without headers plus `<outpath>.manifest` with the columns
+
+    Same interface as CsvTableWriter. The rows are encoded in the calling
+    thread, batches of them go round robin to `workers` threads, each one
+    compressing into its own slice. A slice is finished after `slice_rows`
+    rows or `slice_bytes` compressed bytes and the worker starts the next one.
+    At most two batches per worker wait to be written. The slices are named
+    `<slice_prefix>part-00000.csv.gz`, ...
+
+    If new columns show up while writing, the slices with the shorter rows
+    are padded (in parallel) when closing.
+    """
+    def __init__(
+            self,
+            outpath,
+            encoder: Optional[RowEncoder]=None,
+            batch_size: int=DEFAULT_BATCH_SIZE,
+            slice_rows: Optional[int]=None,
+            slice_bytes: Optional[int]=DEFAULT_SLICE_BYTES,
+            workers: int=1,
+            compresslevel: int=DEFAULT_COMPRESSLEVEL,
+            slice_prefix: str=''):
+        super().__init__(outpath, encoder, batch_size)
+        self.slice_rows = slice_rows
+        self.slice_bytes = slice_bytes
+        self.workers = workers
+        self.compresslevel = compresslevel
+        self.slice_prefix = slice_prefix
+        self._batch_width = 0
+        self._lanes = None
+        self._next_lane = 0
+        self._pending = deque()
+        self._slices = []
+        self._slices_lock = threading.Lock()
+
+    @property
+    def slices(self):
+        return [slice_.path for slice_ in self._slices]
+
+    @property
+    def _started(self):
+        return self._lanes is not None
+
+    def _start(self):
+        outpath = str(self.outpath)
+        if os.path.isdir(outpath):
+            shutil.rmtree(outpath)
+        elif os.path.exists(outpath):
+            os.remove(outpath)
+        os.makedirs(outpath)
+        self._lanes = [_Lane(self) for _ in range(self.workers)]
+
+    def _new_slice(self):
+        with self._slices_lock:
+            path = os.path.join(str(self.outpath), '{}part-{:05d}.csv.gz'.format(
+                self.slice_prefix, len(self._slices)))
+            slice_ = _Slice(path, self.compresslevel)
+            self._slices.append(slice_)
+        return slice_
+
+    def _is_full(self, slice_):
+        return ((self.slice_rows is not None and slice_.rows >= self.slice_rows) or
+                (self.slice_bytes is not None and slice_.size >= self.slice_bytes))
+
+    def _buffer(self, encoded):
+        # the rows of a batch only get longer, the slices remember the
+        # shortest to know which ones to pad
+        if not self._batch:
+            self._batch_width = len(self.columns)
+        super()._buffer(encoded)
+
+    def _flush(self):
+        if not self._batch:
+            return
+        lane = self._lanes[self._next_lane % len(self._lanes)]
+        self._next_lane += 1
+        self._pending.append(lane.submit(self._batch, self._batch_width))
+        self._batch = []
+        while len(self._pending) > 2 * len(self._lanes):
+            self._pending.popleft().result()
+
+    def close(self):
+        """Finish the slices and the manifest, returns the outpath or None if
+        nothing was written"""
+        if self._lanes is None:
+            return None
+        if self._pending is None:
+            return self.outpath
+        self._flush()
+        for lane in self._lanes:
+            lane.close()
+        while self._pending:
+            self._pending.popleft().result()
+        self._pending = None
+        if self.schema_changed:
+            self._pad_short_slices()
+        self._write_manifest({'columns': self.columns})
+        return self.outpath
+
+    def abort(self):
+        """Stop the workers and leave the slices as they are"""
+        self._batch = []
+        if self._lanes is not None:
+            for future in self._pending or ():
+                future.cancel()
+            for lane in self._lanes:
+                lane.close()
+        self._pending = None
+
+    def _pad_short_slices(self):
+        width = len(self.columns)
+        short = [slice_.path for slice_ in self._slices if slice_.min_width < width]
+        logger.info("The schema of %s changed while writing, "
+                    "padding %s slices to %s columns",
+                    self.outpath, len(short), width)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda path: self._pad_slice(path, width), short))
+
+    def _pad_slice(self, path, width):
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8', newline='') as inf,\
+                 gzip.open(tmppath, 'wt', encoding='utf-8', newline='',
+                           compresslevel=self.compresslevel) as outf:
+                writer = csv.writer(outf)
+                for values in csv.reader(inf):
+                    if len(values) < width:
+                        values.extend([''] * (width - len(values)))
+                    writer.writerow(values)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+
+class NdjsonFileWriter(_BatchWriter):
+    """Write objects as they are into a newline delimited json file, one
+    object per line, plus a Keboola file manifest (`<outpath>.manifest`)
+
+    There are no columns to track and nothing to escape, each object is
+    dumped once by `dumps`, the `json_backend` of the run by default. Nothing
+    is written (and `close()` returns None) if there were no objects.
+
+    If the extraction fails the file is removed, a partial file can't be
+    resumed and it's not uploaded without its manifest anyway.
+    """
+    def __init__(
+            self,
+            outpath,
+            tags=(),
+            dumps=None,
+            batch_size: int=DEFAULT_BATCH_SIZE):
+        super().__init__(outpath, batch_size)
+        self.tags = list(tags)
+        self.dumps = dumps or get_dumps()
+        self._outf = None
+
+    def abort(self):
+        """Drop the buffered objects and remove the file, without a manifest"""
+        self._batch = []
+        if self._outf is not None and not self._outf.closed:
+            self._outf.close()
+            os.remove(str(self.outpath))
+
+    def write(self, obj):
+        self._buffer(self.dumps(obj))
+
+    def _flush(self):
+        if not self._batch:
+            return
+        if self._outf is None:
+            self._outf = open(str(self.outpath), 'w', encoding='utf-8')
+        self._batch.append('')
+        self._outf.write('\n'.join(self._batch))
+        self._batch = []
+
+    def close(self):
+        """Finish the file and the manifest, returns the outpath or None if
+        nothing was written"""
+        self._flush()
+        if self._outf is None:
+            return None
+        if not self._outf.closed:
+            self._outf.close()
+            self._write_manifest({'tags': self.tags})
+        return self.outpath
+
+
+def open_table_writer(outpath, sliced: Optional[dict]=None, resume_from: Optional[dict]=None):
+    """CsvTableWriter, or SlicedCsvTableWriter configured by the
+    `sliced_output` options"""
+    if sliced is None:
+        return CsvTableWriter(outpath, resume_from=resume_from)
+    if resume_from is not None:
+        raise ValueError("Sliced tables can't be resumed")
+    slice_mb = sliced.get('slice_mb')
+    return SlicedCsvTableWriter(
+        outpath,
+        slice_rows=sliced.get('slice_rows'),
+        slice_bytes=(int(slice_mb * 1024 * 1024) if slice_mb is not None
+                     else DEFAULT_SLICE_BYTES),
+        workers=sliced.get('writers', 1),
+        compresslevel=sliced.get('compresslevel', DEFAULT_COMPRESSLEVEL),
+        slice_prefix=sliced.get('slice_prefix', ''))